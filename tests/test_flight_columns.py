@@ -0,0 +1,13 @@
+import travel_agent as ta
+
+
+def test_strings_past_the_intern_cap_stay_local(monkeypatch):
+    monkeypatch.setattr(ta, "INTERNED_STRINGS", ta.StringTable(max_size=2))
+    columns = ta.FlightColumns()
+    columns.append("XX-1", "Air Nowhere", 120, "$120", "09:00 AM", "Atlantis", "El Dorado")
+    columns.append("XX-2", "Air Nowhere", 90, "$90", "10:00 AM", "Atlantis", "El Dorado")
+
+    assert len(ta.INTERNED_STRINGS) == 2
+    assert columns.airline_codes[0] == columns.airline_codes[1]
+    assert columns[1].destination == "El Dorado"
+    assert columns[1].raw_price == "$90"
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import travel_agent as ta
+
+
+class SlowModel:
+    """Counts concurrent generate_content calls; streams are lists of chunks."""
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return iter(["a", "b"]) if stream else prompt
+
+
+def test_pool_caps_in_flight_requests():
+    pool = ta.ModelClientPool(max_in_flight=2)
+    model = SlowModel()
+    pooled = ta.PooledModel(model, pool)
+    threads = [threading.Thread(target=pooled.generate_content, args=("hi",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert model.peak == 2
+
+
+def test_stream_holds_its_slot_until_exhausted():
+    pool = ta.ModelClientPool(max_in_flight=1)
+    pooled = ta.PooledModel(SlowModel(delay=0), pool)
+
+    stream = pooled.generate_content("hi", stream=True)
+    assert not pool.slot().acquire(blocking=False)
+    assert list(stream) == ["a", "b"]
+    assert pool.slot().acquire(blocking=False)
+    pool.slot().release()
+
+
+def test_abandoned_stream_releases_its_slot():
+    pool = ta.ModelClientPool(max_in_flight=1)
+    pooled = ta.PooledModel(SlowModel(delay=0), pool)
+
+    stream = pooled.generate_content("hi", stream=True)
+    del stream
+    assert pool.slot().acquire(blocking=False)
+    pool.slot().release()
+
+
+def test_stub_server_streams_through_the_sdk():
+    pool = ta.ModelClientPool()
+    with ta.StubModelServer() as stub:
+        pool.configure(transport="rest", api_endpoint=stub.url)
+        try:
+            response = pool.get().generate_content("CONTEXT: one two three four five six", stream=True)
+            chunks = [chunk.text for chunk in response]
+        finally:
+            pool.configure()
+
+    assert "".join(chunks) == "one two three four five six"
+    assert len(chunks) == 2
+    assert response.usage_metadata.candidates_token_count > 0
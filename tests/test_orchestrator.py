@@ -0,0 +1,34 @@
+import travel_agent as ta
+
+
+def make_agent():
+    # Every turn below hits the rule-based fast path and renders from templates: no model calls
+    return ta.TravelAgentSystem(inventory=ta.MockInventoryProvider(), nlg_modes=dict.fromkeys(ta.DEFAULT_NLG_MODES, "template"))
+
+
+def test_rebooking_the_current_flight_changes_nothing():
+    agent = make_agent()
+    agent.handle_request("Find me flights from London to Paris for tomorrow.")
+    booked = agent.handle_request("Book the Air France one for Robin")
+    pnr = agent.memory.bookings[-1].pnr
+
+    reply = agent.handle_request("switch me to Air France")
+    assert reply == ta.TravelAgentSystem.ALREADY_BOOKED_RESPONSE.format(flight_id="AF-1923", pnr=pnr)
+    assert "CONFIRMED" in booked
+    assert agent.usage["calls"] == 0
+
+
+def test_cancel_the_cheapest_resolves_against_the_bookings():
+    agent = make_agent()
+    agent.handle_request("Find me flights from London to Paris for tomorrow.")
+    agent.handle_request("Book the Lufthansa one for Robin")
+    agent.handle_request("Book the British Airways one for Kim")
+
+    reply = agent.handle_request("Cancel the cheapest one")
+    assert "BA-2847" in reply and "CANCELLED" in reply
+
+
+def test_failed_inventory_gives_a_user_facing_reply():
+    agent = ta.TravelAgentSystem(inventory=ta.SyntheticInventoryProvider(error_rate=1.0))
+    reply = agent.handle_request("Find me flights from London to Paris for tomorrow.")
+    assert reply == ta.TravelAgentSystem.SEARCH_UNAVAILABLE_RESPONSE
@@ -0,0 +1,26 @@
+import travel_agent as ta
+
+
+def test_workers_never_issue_the_same_code():
+    workers = [ta.PNRAllocator(block_size=64, seed=7, worker_id=i, worker_count=3) for i in range(3)]
+    issued = [worker.allocate() for worker in workers for _ in range(500)]
+
+    assert len(set(issued)) == len(issued)
+
+
+def test_reserved_codes_are_skipped():
+    first = ta.PNRAllocator(block_size=16, seed=7)
+    earlier_run = [first.allocate() for _ in range(40)]
+
+    restarted = ta.PNRAllocator(block_size=16, seed=7)
+    restarted.reserve(earlier_run)
+    assert not set(earlier_run) & {restarted.allocate() for _ in range(40)}
+
+
+def test_workers_need_a_shared_seed():
+    try:
+        ta.PNRAllocator(seed=None, worker_id=0, worker_count=2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
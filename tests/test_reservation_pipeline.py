@@ -0,0 +1,59 @@
+import travel_agent as ta
+
+
+class FlakyBackend:
+    """Refuses the first `failures` writes, then records what it is sent."""
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.records = []
+
+    def __call__(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("backend down")
+        self.records.extend((record["status"], record["pnr"]) for record in batch)
+
+
+def test_records_are_written_in_commit_order_despite_a_failed_write():
+    backend = FlakyBackend(failures=1)
+    pipeline = ta.ReservationPipeline(write_fn=backend, batch_size=4, window_seconds=0.01, backoff=0.01)
+    first = pipeline.commit(("s", "Robin", "TEST-1", "2030-01-01"), "TEST-1", "Robin", "2030-01-01")
+    others = [pipeline.commit(None, "TEST-1", f"P{i}", "2030-01-01") for i in range(9)]
+    pipeline.cancel(first["pnr"], "TEST-1", "2030-01-01")
+
+    assert pipeline.flush(timeout=5)
+    expected = [("CONFIRMED", r["pnr"]) for r in [first] + others] + [("CANCELLED", first["pnr"])]
+    assert backend.records == expected
+    assert pipeline.stats["write_failures"] == 1
+    pipeline.close()
+
+
+def test_repeated_idempotency_key_returns_the_first_reservation():
+    backend = FlakyBackend(failures=0)
+    pipeline = ta.ReservationPipeline(write_fn=backend, window_seconds=0.01)
+    key = ("s", "Kim", "TEST-2", "2030-01-01")
+    first = pipeline.commit(key, "TEST-2", "Kim", "2030-01-01")
+
+    assert pipeline.commit(key, "TEST-2", "Kim", "2030-01-01")["pnr"] == first["pnr"]
+    assert pipeline.flush(timeout=5)
+    assert backend.records == [("CONFIRMED", first["pnr"])]
+    pipeline.close()
+
+
+def test_unwritten_records_are_spilled_and_requeued(tmp_path):
+    spill = tmp_path / "spill.jsonl"
+
+    def down(batch):
+        raise OSError("backend down")
+
+    pipeline = ta.ReservationPipeline(write_fn=down, backoff=0.01, spill_path=str(spill))
+    result = pipeline.commit(None, "TEST-3", "Kim", "2030-01-01", route=("London", "Paris"))
+    pipeline.close(timeout=0.2)
+    assert spill.exists()
+
+    backend = FlakyBackend(failures=0)
+    restarted = ta.ReservationPipeline(write_fn=backend, window_seconds=0.01, spill_path=str(spill))
+    assert restarted.flush(timeout=5)
+    assert backend.records == [("CONFIRMED", result["pnr"])]
+    assert not spill.exists()
+    restarted.close()
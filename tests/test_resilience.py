@@ -0,0 +1,59 @@
+import travel_agent as ta
+
+
+def test_timer_wheel_expires_entries_once_their_deadline_passes():
+    wheel = ta.TimerWheel(tick=1.0, slots=4)
+    now = wheel._current * 1.0
+    wheel.schedule("soon", now + 1.5)
+    wheel.schedule("cancelled", now + 1.5)
+    wheel.schedule("next turn", now + 10.5)
+    wheel.cancel("cancelled", now + 1.5)
+
+    assert wheel.advance(now + 1.0) == []
+    assert wheel.advance(now + 2.0) == ["soon"]
+    # Shares a slot with earlier ticks but is more than a full turn ahead
+    assert wheel.advance(now + 8.0) == []
+    assert wheel.advance(now + 11.0) == ["next turn"]
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = ta.CircuitBreaker(failure_threshold=2, reset_seconds=3600)
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    assert breaker.trips == 1
+
+
+def test_breaker_lets_one_probe_through_when_half_open():
+    breaker = ta.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.failures == 0
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = ta.CircuitBreaker(failure_threshold=3, reset_seconds=0)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.trips == 2
+
+
+def test_released_probe_frees_the_half_open_slot():
+    breaker = ta.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.release_probe()
+    assert breaker.allow()
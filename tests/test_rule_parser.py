@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+import travel_agent as ta
+
+THRESHOLD = ta.NLU_CONFIDENCE_THRESHOLD
+
+
+@pytest.fixture(scope="module")
+def parser():
+    return ta.RuleBasedParser()
+
+
+def test_instead_alone_does_not_rebook_a_search(parser):
+    data, confidence = parser.parse("Show me Lufthansa flights from London to Rome instead.")
+    assert data["intent"] != "REBOOK" or confidence < THRESHOLD
+
+
+@pytest.mark.parametrize("text, target", [
+    ("Cancel the Air France booking for Robin and book Lufthansa instead", "Lufthansa"),
+    ("Book Air France instead for Robin", "Air France"),
+    ("rebook me on BA", "British Airways"),
+])
+def test_rebook_takes_the_target_after_the_book_verb(parser, text, target):
+    data, confidence = parser.parse(text)
+    assert data["intent"] == "REBOOK"
+    assert data["booking_target"] == target
+    assert confidence >= THRESHOLD
+
+
+def test_book_with_a_route_goes_to_the_llm(parser):
+    data, confidence = parser.parse("Book Lufthansa from London to Rome")
+    assert confidence < THRESHOLD
+
+
+@pytest.mark.parametrize("text, target", [
+    ("Cancel the cheapest one", "the cheapest one"),
+    ("Cancel the Air France booking for Robin", "Air France"),
+    ("cancel my booking", None),
+])
+def test_cancel_target(parser, text, target):
+    data, confidence = parser.parse(text)
+    assert data["intent"] == "CANCEL"
+    assert data["booking_target"] == target
+
+
+@pytest.mark.parametrize("text, date_reference", [
+    ("Find flights from London to Paris departing tomorrow", "tomorrow"),
+    ("flights from London to Paris leaving friday", "friday"),
+    ("flights from London to Paris with my wife", None),
+])
+def test_route_stops_at_verbs_and_prepositions(parser, text, date_reference):
+    data, confidence = parser.parse(text)
+    assert (data["origin"], data["destination"]) == ("London", "Paris")
+    assert data["date_reference"] == date_reference
+    assert confidence >= THRESHOLD
+
+
+def test_unknown_city_lowers_confidence(parser):
+    data, confidence = parser.parse("flights from Rome to New York John F Kennedy airport")
+    assert confidence < THRESHOLD
+
+
+def test_clock_time_is_not_a_date(parser):
+    data, _ = parser.parse("Find flights from London to Paris leaving at 10.30 on friday")
+    assert data["date_reference"] == "friday"
+
+
+@pytest.mark.parametrize("phrase, today, expected", [
+    ("leaving at 10.30", datetime.date(2026, 1, 5), None),
+    ("on 20.10", datetime.date(2026, 10, 15), datetime.date(2026, 10, 20)),
+    ("20/10", datetime.date(2026, 10, 1), datetime.date(2026, 10, 20)),
+    ("the 30th", datetime.date(2026, 1, 31), datetime.date(2026, 3, 30)),
+    ("the 15th", datetime.date(2026, 12, 20), datetime.date(2027, 1, 15)),
+])
+def test_date_resolver(phrase, today, expected):
+    resolved = ta.DateResolver().resolve(phrase, today)
+    assert (resolved.start if resolved else None) == expected
@@ -0,0 +1,51 @@
+import threading
+import time
+
+import travel_agent as ta
+
+
+def test_expired_hold_frees_its_flight_entry():
+    inventory = ta.SeatInventory(default_capacity=2)
+    inventory._wheel = ta.TimerWheel(tick=0.01)
+    assert inventory.hold("XX-1", "2026-01-01", ttl=0.01) is not None
+    assert inventory.available("XX-1", "2026-01-01") == 1
+
+    time.sleep(0.05)
+    assert inventory.available("XX-1", "2026-01-01") == 2
+    assert inventory._flights == {}
+    assert inventory.stats["expired"] == 1
+
+
+def test_released_and_cancelled_flights_are_dropped():
+    inventory = ta.SeatInventory()
+    hold_id = inventory.hold("XX-1", "2026-01-01")
+    inventory.release(hold_id)
+    assert inventory.book("XX-2", "2026-01-01")
+    assert inventory.cancel_sale("XX-2", "2026-01-01")
+
+    assert inventory._flights == {}
+
+
+def test_custom_capacity_is_kept():
+    inventory = ta.SeatInventory()
+    inventory.set_capacity("XX-1", "2026-01-01", 1)
+    hold_id = inventory.hold("XX-1", "2026-01-01")
+    inventory.release(hold_id)
+
+    assert inventory.available("XX-1", "2026-01-01") == 1
+
+
+def test_stats_are_exact_under_contention():
+    inventory = ta.SeatInventory(default_capacity=10**6, stripes=4)
+
+    def worker(n):
+        for i in range(2000):
+            inventory.release(inventory.hold(f"XX-{(n + i) % 8}", "2026-01-01"))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert inventory.stats["holds"] == inventory.stats["released"] == 16000
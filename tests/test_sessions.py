@@ -0,0 +1,34 @@
+import travel_agent as ta
+
+
+class EchoAgent:
+    """Stands in for TravelAgentSystem: answers with the session's ID."""
+    def for_session(self, memory):
+        return EchoView(memory)
+
+
+class EchoView:
+    def __init__(self, memory):
+        self.memory = memory
+
+    def handle_request(self, user_input):
+        return self.memory.session_id
+
+
+def test_checkout_sweeps_idle_sessions():
+    manager = ta.SessionManager(EchoAgent(), idle_ttl_seconds=0, sweep_interval_seconds=0)
+    manager.handle_request("a", "hello")
+    manager.handle_request("b", "hello")
+
+    assert list(manager._sessions) == ["b"]
+    assert manager.evictions == 1
+
+
+def test_sweep_is_rate_limited():
+    manager = ta.SessionManager(EchoAgent(), idle_ttl_seconds=0, sweep_interval_seconds=3600)
+    manager.handle_request("a", "hello")
+    manager.handle_request("b", "hello")
+
+    assert len(manager) == 2
+    assert manager.evict_idle() == 2
+    assert len(manager) == 0
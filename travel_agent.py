@@ -1,11 +1,40 @@
 import os
 import re
+import sys
+import atexit
+import copy
+import asyncio
 import json
 import logging
 import datetime
-from typing import List, Dict, Any, Optional
+import functools
+import sqlite3
+import threading
+import time
+import heapq
+import itertools
+import random
+import zlib
+import math
+import hashlib
+import tracemalloc
+import textwrap
+import http.server
+from array import array
+from calendar import monthrange
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from typing import List, Dict, Any, Optional, Tuple, Callable, Protocol, Iterator, Iterable
 from dataclasses import dataclass
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+# NumPy is optional: AgentMemory queries vectorize over the columns when it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ==============================================================================
 # 1. CONFIGURATION & LOGGING
@@ -25,6 +54,9 @@ try:
 except ImportError:
     API_KEY = os.environ.get("GEMINI_API_KEY")
 
+if not API_KEY and ("--stub" in sys.argv or "--bench" in sys.argv):
+    # Offline modes never reach the real API, but the SDK still needs a key to configure
+    API_KEY = "offline"
 if not API_KEY:
     logger.error("GEMINI_API_KEY not found. System cannot initialize.")
     exit(1)
@@ -32,12 +64,140 @@ if not API_KEY:
 genai.configure(api_key=API_KEY)
 MODEL_NAME = 'gemini-2.5-flash-lite' 
 
+# Rule-based NLU results at or above this confidence skip the LLM round trip
+NLU_CONFIDENCE_THRESHOLD = 0.8
+
+# NLU extraction cache (set NLU_CACHE_DB to persist it across restarts)
+NLU_CACHE_SIZE = 4096
+NLU_CACHE_TTL_SECONDS = 3600
+NLU_CACHE_DB_PATH = os.environ.get("NLU_CACHE_DB")
+
+# Micro-batching of LLM extractions across concurrent sessions (opt-in)
+NLU_BATCH_WINDOW_SECONDS = 0.01
+NLU_BATCH_MAX_SIZE = 16
+
+# Date grammar: memoized resolutions per (phrase, reference date); numeric dates read day-first (20/10)
+DATE_CACHE_SIZE = 4096
+DATE_DAY_FIRST = True
+# Parsed price labels ("$420"); labels repeat across fares, searches and dates
+PRICE_PARSE_CACHE_SIZE = 4096
+
+# NLG mode per intent: "template" renders locally, "polished" rewords via the LLM
+NLG_MODE_TEMPLATE = "template"
+NLG_MODE_POLISHED = "polished"
+DEFAULT_NLG_MODES = {"SEARCH": NLG_MODE_TEMPLATE, "BOOK": NLG_MODE_TEMPLATE,
+                     "CANCEL": NLG_MODE_TEMPLATE, "REBOOK": NLG_MODE_TEMPLATE}
+
+# Token budget for the NLG system context; search listings are cut to the top-k fares that fit
+NLG_CONTEXT_TOKEN_BUDGET = 400
+
+# Turn pipeline: "two_call" = NLU call + NLG call, "combined" = one tool-calling conversation
+PIPELINE_TWO_CALL = "two_call"
+PIPELINE_COMBINED = "combined"
+
+# Process-wide string interning; once full, new strings stay local to the search that brought them
+INTERNED_STRINGS_MAX = 65_536
+
+# Flexible-date search: date ranges ("next week") scan every day, up to a month, concurrently
+FLEX_MAX_DAYS = 31
+FLEX_SEARCH_WORKERS = 16
+
+# PNR allocation: codes drawn from an unambiguous alphabet (no I/O/0/1), handed out in per-thread blocks
+PNR_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+PNR_LENGTH = 6
+PNR_BLOCK_SIZE = 256
+PNR_BLOOM_CAPACITY = 1_000_000
+PNR_BLOOM_ERROR_RATE = 0.001
+# Worker processes must share one PNR_SEED (the same permutation) and each draws from its own slice of it;
+# a single process without a seed picks a random one
+PNR_SEED = int(os.environ["PNR_SEED"]) if os.environ.get("PNR_SEED") else None
+PNR_WORKER_ID = int(os.environ.get("PNR_WORKER_ID", "0"))
+PNR_WORKER_COUNT = int(os.environ.get("PNR_WORKER_COUNT", "1"))
+
+# Seat inventory: seats per flight/date/route, holds placed on the top fares at search time
+SEAT_DEFAULT_CAPACITY = 180
+SEAT_HOLD_TTL_SECONDS = 300.0
+SEARCH_HOLD_FARES = 5
+SEARCH_HOLD_MAX_SHARE = 0.1  # search-time holds never take more than this share of a flight's seats
+SEAT_LOCK_STRIPES = 64
+TIMER_WHEEL_TICK_SECONDS = 1.0
+TIMER_WHEEL_SLOTS = 512
+
+# Reservation pipeline: idempotency keys remembered per process, records written to the backend in batches
+RESERVATION_BATCH_SIZE = 64
+RESERVATION_FLUSH_SECONDS = 0.05
+RESERVATION_KEY_CACHE_SIZE = 100_000
+RESERVATION_RETRY_BACKOFF_SECONDS = 0.1
+RESERVATION_RETRY_MAX_SECONDS = 5.0
+RESERVATION_SHUTDOWN_SECONDS = 10.0
+# Records still unwritten at shutdown are saved here and queued again by the next process
+RESERVATION_SPILL_PATH = os.environ.get("RESERVATION_SPILL_PATH", "reservations.spill.jsonl")
+
+# Model transport: shared client pool; set GEMINI_API_ENDPOINT (e.g. a local stub) to redirect it
+MODEL_TRANSPORT = os.environ.get("GEMINI_TRANSPORT")
+MODEL_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT")
+MODEL_MAX_IN_FLIGHT = 32
+
+# Resilient model calls: per-attempt timeout inside an overall deadline, jittered retries
+# bounded by a process-wide budget, optional hedging at p95 latency, and a circuit breaker
+MODEL_ATTEMPT_TIMEOUT_SECONDS = 8.0
+MODEL_CALL_DEADLINE_SECONDS = 15.0
+MODEL_MAX_ATTEMPTS = 3
+MODEL_RETRY_BACKOFF_SECONDS = 0.25
+MODEL_RETRY_BUDGET_RATIO = 0.1
+MODEL_RETRY_BUDGET_BURST = 10
+MODEL_HEDGE_PERCENTILE = 0.95
+MODEL_HEDGE_MIN_SAMPLES = 20
+MODEL_BREAKER_FAILURES = 5
+MODEL_BREAKER_RESET_SECONDS = 30.0
+
+# Max in-flight model calls per event loop for AsyncTravelAgentSystem
+MODEL_CONCURRENCY_LIMIT = 64
+
+# Shared fare cache: entries are fresh for the TTL, then served stale while refreshing
+FARE_CACHE_SIZE = 10_000
+FARE_CACHE_TTL_SECONDS = 60
+FARE_CACHE_STALE_SECONDS = 300
+
+# Streaming search: fares shown as soon as the first batch arrives
+STREAM_PREVIEW_FARES = 5
+SYNTHETIC_STREAM_CHUNK = 50
+
+# Multi-provider fan-out search
+FANOUT_DEADLINE_SECONDS = 2.0
+FANOUT_MAX_WORKERS = 32
+
+# SessionManager limits
+MAX_RESIDENT_SESSIONS = 100_000
+SESSION_IDLE_TTL_SECONDS = 1800
+SESSION_MEMORY_BUDGET_BYTES = 512 * 1024 * 1024
+# Idle sessions are swept on checkout at most this often
+SESSION_SWEEP_INTERVAL_SECONDS = 60.0
+
+@dataclass
+class HitCounter:
+    """Hit/miss counter used to report fast-path and cache effectiveness."""
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / self.total if self.total else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.hits}/{self.total} hits ({self.hit_ratio:.1%})"
+
 # ==============================================================================
 # 2. SHARED MEMORY (STATE MANAGEMENT)
 # ==============================================================================
 
-@dataclass
+@dataclass(frozen=True)
 class FlightRecord:
+    __slots__ = ("flight_id", "airline", "price", "raw_price", "departure", "origin", "destination")
     flight_id: str
     airline: str
     price: int
@@ -46,26 +206,511 @@ class FlightRecord:
     origin: str
     destination: str
 
+@dataclass
+class Booking:
+    """One entry of a session's booking ledger."""
+    pnr: str
+    flight_id: str
+    airline: str
+    passenger: str
+    travel_date: Optional[str]
+    status: str = "CONFIRMED"
+    route: Optional[Tuple[str, str]] = None
+    price: Optional[int] = None
+    departure: Optional[str] = None
+
+    def as_result(self) -> Dict:
+        """The booking in the shape returned by the reservation tools."""
+        return {"status": self.status, "pnr": self.pnr, "flight_id": self.flight_id, "passenger": self.passenger}
+
+class StringTable:
+    """
+    Process-wide intern table mapping low-cardinality strings (airlines, cities,
+    departure times, price labels) to small integer codes shared by all sessions.
+    Codes are never reused, so the table is capped at max_size entries: city names
+    typed by users would otherwise grow it forever. code() returns None once full.
+    """
+    def __init__(self, max_size: int = INTERNED_STRINGS_MAX):
+        self.max_size = max_size
+        self._codes: Dict[str, int] = {}
+        self._values: List[str] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def code(self, value: str) -> Optional[int]:
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None and len(self._values) < self.max_size:
+                    code = len(self._values)
+                    self._values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def lookup(self, value: str) -> Optional[int]:
+        return self._codes.get(value)
+
+    def __getitem__(self, code: int) -> str:
+        return self._values[code]
+
+INTERNED_STRINGS = StringTable()
+
+def _parse_departure_minutes(departure: str) -> int:
+    """'02:00 PM' -> 840. Returns -1 when the time cannot be parsed."""
+    match = re.match(r'\s*(\d{1,2}):(\d{2})\s*([AaPp][Mm])?', departure)
+    if not match:
+        return -1
+    hours, minutes, meridiem = int(match.group(1)), int(match.group(2)), match.group(3)
+    if meridiem:
+        hours = hours % 12 + (12 if meridiem.upper() == "PM" else 0)
+    return hours * 60 + minutes
+
+@functools.lru_cache(maxsize=PRICE_PARSE_CACHE_SIZE)
+def _parse_price(raw_price: str) -> int:
+    """'$420' -> 420. Unparseable prices sort last."""
+    try:
+        return int(re.sub(r'[^\d]', '', raw_price))
+    except ValueError:
+        return 999999
+
+class PriceCalendar:
+    """
+    Cheapest fare per date over a flexible-date window for one route.
+    Fares are flattened into typed price and date-index columns; the per-date
+    minimum is a segmented reduction (numpy when installed), so only one fare
+    dict per date is kept once the calendar is built.
+    """
+    def __init__(self, origin: str, destination: str, dates: List[str]):
+        self.origin = origin
+        self.destination = destination
+        self.dates = dates
+        self.options = array('I', [0] * len(dates))
+        # Cheapest price and fare per date; 0 / None on days without fares
+        self.min_prices = array('I', [0] * len(dates))
+        self.best_fares: List[Optional[Dict]] = [None] * len(dates)
+
+    @classmethod
+    def build(cls, origin: str, destination: str, results: Dict[str, Dict]) -> "PriceCalendar":
+        """`results` maps date -> search result, in date order."""
+        calendar = cls(origin, destination, list(results))
+        fares: List[Dict] = []
+        prices = array('I')
+        for i, date_str in enumerate(calendar.dates):
+            flights = results[date_str]["flights"]
+            calendar.options[i] = len(flights)
+            fares.extend(flights)
+            prices.extend(_parse_price(f["price"]) for f in flights)
+
+        days = [i for i, count in enumerate(calendar.options) if count]
+        if not days:
+            return calendar
+        counts = [calendar.options[i] for i in days]
+        if np is not None:
+            price_col = np.frombuffer(prices, dtype=np.uint32)
+            offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            day_min = np.minimum.reduceat(price_col, offsets)
+            # First row of each day's segment that equals that day's minimum
+            at_min = np.flatnonzero(price_col == np.repeat(day_min, counts))
+            segment = np.repeat(np.arange(len(days)), counts)[at_min]
+            best_rows = at_min[np.unique(segment, return_index=True)[1]].tolist()
+        else:
+            best_rows, start = [], 0
+            for count in counts:
+                best_rows.append(min(range(start, start + count), key=prices.__getitem__))
+                start += count
+        for day, row in zip(days, best_rows):
+            calendar.min_prices[day] = prices[row]
+            calendar.best_fares[day] = fares[row]
+        return calendar
+
+    def ranked(self, limit: Optional[int] = None) -> List[int]:
+        """Date indexes with fares, cheapest first (ties keep date order)."""
+        days = [i for i, count in enumerate(self.options) if count]
+        if np is not None and days:
+            order = np.argsort(np.frombuffer(self.min_prices, dtype=np.uint32)[days], kind="stable")
+            days = [days[i] for i in order]
+        else:
+            days.sort(key=self.min_prices.__getitem__)
+        return days[:limit] if limit is not None else days
+
+    @property
+    def best_date(self) -> Optional[str]:
+        ranked = self.ranked(1)
+        return self.dates[ranked[0]] if ranked else None
+
+    def nbytes(self) -> int:
+        return (sys.getsizeof(self.dates) + self.options.buffer_info()[1] * self.options.itemsize * 2
+                + sys.getsizeof(self.best_fares))
+
+class FlightColumns(Sequence):
+    """
+    Columnar, array-backed store for one search's fares.
+    Numeric fields live in typed arrays and strings as interned codes, so a fare
+    costs a few dozen bytes instead of a dataclass plus its fields. Strings the
+    full intern table refuses get local codes from LOCAL_CODE_BASE up. Rows are
+    materialized as FlightRecord views only when accessed.
+    """
+    LOCAL_CODE_BASE = 1 << 31
+    __slots__ = ("flight_ids", "prices", "departure_minutes", "airline_codes", "origin_codes",
+                 "destination_codes", "raw_price_codes", "departure_codes", "_rows", "_local", "_local_codes")
+
+    def __init__(self):
+        self.flight_ids: List[str] = []
+        self.prices = array('i')
+        self.departure_minutes = array('h')
+        self.airline_codes = array('I')
+        self.origin_codes = array('I')
+        self.destination_codes = array('I')
+        self.raw_price_codes = array('I')
+        self.departure_codes = array('I')
+        # Row views already handed out; resolvers tend to hit the same few rows
+        self._rows: Dict[int, FlightRecord] = {}
+        self._local: List[str] = []
+        self._local_codes: Dict[str, int] = {}
+
+    def append(self, flight_id: str, airline: str, price: int, raw_price: str,
+               departure: str, origin: str, destination: str):
+        code = self._code
+        self.flight_ids.append(flight_id)
+        self.prices.append(price)
+        self.departure_minutes.append(_parse_departure_minutes(departure))
+        self.airline_codes.append(code(airline))
+        self.origin_codes.append(code(origin))
+        self.destination_codes.append(code(destination))
+        self.raw_price_codes.append(code(raw_price))
+        self.departure_codes.append(code(departure))
+
+    def _code(self, value: str) -> int:
+        code = INTERNED_STRINGS.code(value)
+        if code is None:
+            code = self._local_codes.get(value)
+            if code is None:
+                code = self._local_codes[value] = self.LOCAL_CODE_BASE + len(self._local)
+                self._local.append(value)
+        return code
+
+    def string(self, code: int) -> str:
+        return INTERNED_STRINGS[code] if code < self.LOCAL_CODE_BASE else self._local[code - self.LOCAL_CODE_BASE]
+
+    def __len__(self) -> int:
+        return len(self.flight_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._materialize(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        record = self._rows.get(index)
+        if record is None:
+            record = self._rows[index] = self._materialize(index)
+        return record
+
+    def __iter__(self):
+        # Full scans (rendering, benchmarks) materialize rows without pinning them
+        for index in range(len(self)):
+            yield self._rows.get(index) or self._materialize(index)
+
+    def _materialize(self, index: int) -> FlightRecord:
+        string = self.string
+        return FlightRecord(
+            flight_id=self.flight_ids[index],
+            airline=string(self.airline_codes[index]),
+            price=self.prices[index],
+            raw_price=string(self.raw_price_codes[index]),
+            departure=string(self.departure_codes[index]),
+            origin=string(self.origin_codes[index]),
+            destination=string(self.destination_codes[index])
+        )
+
+    def nbytes(self) -> int:
+        columns = (self.prices, self.departure_minutes, self.airline_codes, self.origin_codes,
+                   self.destination_codes, self.raw_price_codes, self.departure_codes)
+        size = sys.getsizeof(self.flight_ids) + sum(sys.getsizeof(fid) for fid in self.flight_ids)
+        size += sum(sys.getsizeof(value) for value in self._local)
+        return size + sum(sys.getsizeof(column) for column in columns)
+
+def _parse_clock(text: str) -> Optional[int]:
+    """'6pm' / '6:30 pm' / '18:00' / 'noon' -> minutes since midnight."""
+    text = text.strip().lower()
+    if text in ("noon", "midday"):
+        return 12 * 60
+    if text == "midnight":
+        return 0
+    match = re.fullmatch(r'(\d{1,2})(?::(\d{2}))?\s*(am|pm)?', text)
+    if not match or (match.group(2) is None and match.group(3) is None):
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2) or 0)
+    if match.group(3):
+        hours = hours % 12 + (12 if match.group(3) == "pm" else 0)
+    return hours * 60 + minutes if hours < 24 and minutes < 60 else None
+
+@dataclass
+class FlightQuery:
+    """
+    Filter predicates, a sort key and a top-k limit over the cached fares.
+    Prices are inclusive bounds; departure bounds are minutes since midnight.
+    """
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    earliest_departure: Optional[int] = None
+    latest_departure: Optional[int] = None
+    airline: Optional[str] = None
+    exclude_airline: Optional[str] = None
+    sort_by: str = "price"
+    descending: bool = False
+    limit: Optional[int] = None
+
+    _CLOCK = r'(\d{1,2}(?::\d{2})?\s*(?:am|pm)?|noon|midday|midnight)'
+    _AMOUNT = r'\$?\s*(\d[\d,]*)'
+    _UNDER_RE = re.compile(r'\b(?:under|below|less than|cheaper than)\s+' + _AMOUNT, re.IGNORECASE)
+    _AT_MOST_RE = re.compile(r'\b(?:up to|at most|max(?:imum)?|no more than)\s+' + _AMOUNT, re.IGNORECASE)
+    _OVER_RE = re.compile(r'\b(?:over|above|more than)\s+' + _AMOUNT, re.IGNORECASE)
+    _AFTER_RE = re.compile(r'\b(?:after|from)\s+' + _CLOCK, re.IGNORECASE)
+    _BEFORE_RE = re.compile(r'\b(?:before|by)\s+' + _CLOCK, re.IGNORECASE)
+    _EXCLUDE_RE = re.compile(r'\b(?:non-?|not\s+(?:on\s+)?|except\s+|excluding\s+|other than\s+)([a-z][a-z ]*?)(?=\s+(?:one|flight|option|fare|under|below|after|before)\b|[.,!?]|$)', re.IGNORECASE)
+    _SORT_WORDS = (
+        (re.compile(r'\b(?:most expensive|priciest|dearest)\b', re.IGNORECASE), "price", True),
+        (re.compile(r'\b(?:cheapest|lowest price|least expensive)\b', re.IGNORECASE), "price", False),
+        (re.compile(r'\b(?:earliest|first)\b', re.IGNORECASE), "departure", False),
+        (re.compile(r'\b(?:latest|last)\b', re.IGNORECASE), "departure", True),
+    )
+    QUALIFIER_RE = re.compile(
+        r'\b(?:cheapest|lowest price|least expensive|earliest|first|latest|last|most expensive|priciest|dearest|'
+        r'under|below|less than|cheaper than|up to|at most|no more than|over|above|more than|after|before|'
+        r'non-?|except|excluding|other than)\b',
+        re.IGNORECASE
+    )
+    # Words left over after the qualifiers that do not name an airline
+    _FILLER_WORDS = {"the", "a", "an", "one", "flight", "flights", "option", "options", "fare", "fares",
+                     "ticket", "seat", "on", "with", "by", "please", "me", "that", "this", "my",
+                     "booking", "bookings", "reservation"}
+
+    def __str__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items() if v not in (None, False))
+        return f"FlightQuery({fields})"
+
+    @property
+    def has_filters(self) -> bool:
+        return any(v is not None for v in (self.min_price, self.max_price, self.earliest_departure,
+                                            self.latest_departure, self.airline, self.exclude_airline))
+
+    @classmethod
+    def from_phrase(cls, phrase: str) -> Optional["FlightQuery"]:
+        """
+        Translates a booking target ("earliest", "under $400", "cheapest non-Lufthansa")
+        into a query. Returns None when the phrase has no ranking or filter words.
+        Whatever words remain ("earliest Lufthansa flight") are kept as the airline
+        reference, for the caller to resolve against the cached airlines.
+        """
+        if not phrase:
+            return None
+        query = cls(limit=1)
+        spans: List[Tuple[int, int]] = []
+
+        for pattern, sort_by, descending in cls._SORT_WORDS:
+            match = pattern.search(phrase)
+            if match:
+                query.sort_by, query.descending = sort_by, descending
+                spans.append(match.span())
+                break
+
+        for pattern, field, offset in ((cls._UNDER_RE, "max_price", -1), (cls._AT_MOST_RE, "max_price", 0),
+                                       (cls._OVER_RE, "min_price", 1)):
+            match = pattern.search(phrase)
+            if match:
+                setattr(query, field, int(match.group(1).replace(",", "")) + offset)
+                spans.append(match.span())
+
+        for pattern, field in ((cls._AFTER_RE, "earliest_departure"), (cls._BEFORE_RE, "latest_departure")):
+            match = pattern.search(phrase)
+            minutes = _parse_clock(match.group(1)) if match else None
+            if minutes is not None:
+                setattr(query, field, minutes)
+                spans.append(match.span())
+
+        exclude_match = cls._EXCLUDE_RE.search(phrase)
+        if exclude_match:
+            query.exclude_airline = exclude_match.group(1).strip()
+            spans.append(exclude_match.span())
+
+        if not spans:
+            return None
+        query.airline = cls.residue(phrase, spans) or None
+        return query
+
+    @classmethod
+    def residue(cls, phrase: str, spans: Iterable[Tuple[int, int]] = ()) -> str:
+        """The words of a phrase outside the given spans, minus filler words."""
+        for start, end in sorted(spans, reverse=True):
+            phrase = phrase[:start] + " " + phrase[end:]
+        words = re.findall(r"[a-z0-9][a-z0-9'&-]*", phrase.lower())
+        return " ".join(word for word in words if word not in cls._FILLER_WORDS)
+
+AIRLINE_ALIASES = {
+    "ba": "British Airways", "speedbird": "British Airways",
+    "af": "Air France",
+    "lh": "Lufthansa",
+    "kl": "KLM", "klm royal dutch airlines": "KLM",
+    "ib": "Iberia",
+    "ek": "Emirates",
+    "dl": "Delta", "delta air lines": "Delta",
+    "ua": "United", "united airlines": "United",
+}
+
+class AirlineResolver:
+    """
+    Ranks the airlines in a result set against a free-text reference.
+    Exact names, IATA codes and aliases score 1.0, substrings 0.9, and anything
+    else falls back to trigram similarity so typos like "Lufthanza" still resolve.
+    A single-best lookup that hits an exact name returns without any scoring, and
+    references shorter than MIN_SUBSTRING_LENGTH ("air") are not substring-matched.
+    Built once per search; airlines per result set are few, so lookups stay sub-millisecond.
+    """
+    MIN_SCORE = 0.45
+    FUZZY_WEIGHT = 0.85
+    MIN_SUBSTRING_LENGTH = 4
+
+    def __init__(self, airline_codes: Dict[str, str]):
+        """airline_codes maps each airline (in first-seen order) to its IATA code, or ''."""
+        self.airlines = list(airline_codes)
+        self._normalized = [(airline, self._normalize(airline)) for airline in self.airlines]
+        self._order = {airline: i for i, airline in enumerate(self.airlines)}
+        self._exact: Dict[str, str] = {}
+        for alias, airline in AIRLINE_ALIASES.items():
+            if airline in airline_codes:
+                self._exact[self._normalize(alias)] = airline
+        for airline, code in airline_codes.items():
+            if code:
+                self._exact.setdefault(code.lower(), airline)
+            self._exact[self._normalize(airline)] = airline
+        # References as typed ("Lufthansa", "LH") skip normalization
+        self._verbatim = {key: airline for airline, code in airline_codes.items()
+                          for key in (airline, airline.lower(), code, code.lower()) if key}
+
+        # Trigram postings over each airline's full name and its individual words
+        self._variants: List[Tuple[str, int]] = []
+        self._postings: Dict[str, List[int]] = {}
+        for airline in self.airlines:
+            words = airline.lower().split()
+            for variant in {self._normalize(airline), *words}:
+                grams = self._trigrams(variant)
+                variant_id = len(self._variants)
+                self._variants.append((airline, len(grams)))
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(variant_id)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return re.sub(r'[^a-z0-9]', '', text.lower())
+
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def exact(self, query: str) -> Optional[str]:
+        """The airline a name, IATA code or alias refers to exactly, else None."""
+        airline = self._verbatim.get(query)
+        if airline is None and query:
+            airline = self._exact.get(self._normalize(query))
+        return airline
+
+    def resolve(self, query: str, limit: int = 3) -> List[Tuple[str, float]]:
+        """Returns up to `limit` (airline, score) candidates, best first."""
+        exact = self.exact(query)
+        if exact and limit == 1:
+            return [(exact, 1.0)]
+        normalized = self._normalize(query or "")
+        if not normalized:
+            return []
+        scores: Dict[str, float] = {}
+        if exact:
+            scores[exact] = 1.0
+        if len(normalized) >= self.MIN_SUBSTRING_LENGTH:
+            for airline, name in self._normalized:
+                if airline not in scores and normalized in name:
+                    scores[airline] = 0.9
+
+        # Fuzzy scores stay below FUZZY_WEIGHT, so they cannot displace a full set of direct matches
+        grams = self._trigrams(normalized) if len(scores) < limit else set()
+        overlaps: Dict[int, int] = {}
+        for gram in grams:
+            for variant_id in self._postings.get(gram, ()):
+                overlaps[variant_id] = overlaps.get(variant_id, 0) + 1
+        for variant_id, overlap in overlaps.items():
+            airline, size = self._variants[variant_id]
+            # Dice coefficient between the query and this name variant
+            score = self.FUZZY_WEIGHT * 2 * overlap / (len(grams) + size)
+            if score >= self.MIN_SCORE and score > scores.get(airline, 0.0):
+                scores[airline] = score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self._order[item[0]]))
+        return [(airline, round(score, 3)) for airline, score in ranked[:limit]]
+
 class AgentMemory:
     """
     Central state store for the agent.
     Persists flight search results to allow for entity resolution in subsequent turns.
+    Fares are held column-wise in a FlightColumns store; indexes of row numbers are
+    maintained as fares arrive so every resolver is a dict lookup or a read from the
+    price-sorted view instead of a scan over the cache.
     """
-    def __init__(self):
-        self.flight_cache: List[FlightRecord] = []
+    _session_ids = itertools.count(1)
+
+    def __init__(self, session_id: Optional[str] = None):
+        # Part of the reservation idempotency key
+        self.session_id = session_id or f"local-{next(self._session_ids)}"
+        self.flight_cache = FlightColumns()
         self.last_search_context: Dict[str, Any] = {}
+        self._by_id: Dict[str, int] = {}
+        # Airline name -> first row in cache order
+        self._by_airline: Dict[str, int] = {}
+        self._iata_codes: Dict[str, str] = {}
+        self.airline_resolver = AirlineResolver({})
+        self._by_price = array('I')
+        self._route: Tuple[str, str] = ("", "")
+        # Travel date of the current search and the seat holds placed on its top fares (flight_id -> hold_id)
+        self.search_date: Optional[str] = None
+        self.holds: Dict[str, str] = {}
+        # Cheapest fare per date when the last search scanned a date window
+        self.price_calendar: Optional[PriceCalendar] = None
+        # Booking ledger, oldest first; cancelled entries are tombstoned and compacted in bulk
+        self.bookings: List[Booking] = []
+        self._booking_rows: Dict[str, int] = {}
+        self._cancelled_bookings = 0
+        # Approximate resident size, recomputed on every cache update
+        self.footprint_bytes: int = sys.getsizeof(self)
 
     def update_cache(self, raw_flights: List[Dict], origin: str, dest: str):
         """Parses and stores flight data."""
-        self.flight_cache = []
+        self.begin_update(origin, dest)
+        self.extend_cache(raw_flights)
+        logger.info(f"Memory updated with {len(self.flight_cache)} flight options.")
+
+    def begin_update(self, origin: str, dest: str):
+        """Clears the cache for a new search whose fares will arrive via extend_cache."""
+        self.flight_cache = FlightColumns()
+        self._by_id = {}
+        self._by_airline = {}
+        self._iata_codes = {}
+        self.airline_resolver = AirlineResolver({})
+        self._by_price = array('I')
+        self._route = (origin, dest)
+        self.price_calendar = None
+        self.footprint_bytes = self._estimate_footprint()
+
+    def extend_cache(self, raw_flights: List[Dict]):
+        """Appends a batch of fares to the current search and indexes just the new rows."""
+        origin, dest = self._route
+        start = len(self.flight_cache)
         for f in raw_flights:
             # Parse price string "$420" -> 420 for comparison logic
-            try:
-                price_int = int(re.sub(r'[^\d]', '', f['price']))
-            except ValueError:
-                price_int = 999999
+            price_int = _parse_price(f['price'])
 
-            record = FlightRecord(
+            self.flight_cache.append(
                 flight_id=f['flight_id'],
                 airline=f['airline'],
                 price=price_int,
@@ -74,29 +719,208 @@ class AgentMemory:
                 origin=origin,
                 destination=dest
             )
-            self.flight_cache.append(record)
         
-        logger.info(f"Memory updated with {len(self.flight_cache)} flight options.")
+        self._index_rows(start)
+        self.footprint_bytes = self._estimate_footprint()
+
+    def _index_rows(self, start: int):
+        columns = self.flight_cache
+        end = len(columns)
+        for row in range(start, end):
+            # Keep the first row for a duplicated ID, matching the old linear scan
+            self._by_id.setdefault(columns.flight_ids[row], row)
+
+        # Airlines are few, so the resolver is only rebuilt when a new one shows up
+        new_airline = False
+        for row in range(start, end):
+            airline = columns.string(columns.airline_codes[row])
+            if airline not in self._by_airline:
+                self._by_airline[airline] = row
+                # Flight IDs carry the carrier code ("LH-5614"), so "LH" resolves without a table entry
+                prefix = columns.flight_ids[row].split("-", 1)[0]
+                self._iata_codes[airline] = prefix if prefix.isalnum() and len(prefix) == 2 else ""
+                new_airline = True
+        if new_airline:
+            self.airline_resolver = AirlineResolver(self._iata_codes)
+
+        # Stable sort + merge keep cache order among equal prices, like min()
+        prices = columns.prices
+        new_rows = sorted(range(start, end), key=prices.__getitem__)
+        if start:
+            new_rows = heapq.merge(self._by_price, new_rows, key=prices.__getitem__)
+        self._by_price = array('I', new_rows)
+
+    def _estimate_footprint(self) -> int:
+        size = sys.getsizeof(self) + self.flight_cache.nbytes()
+        size += sys.getsizeof(self._by_id) + sys.getsizeof(self._by_price)
+        size += sys.getsizeof(self._by_airline)
+        if self.price_calendar is not None:
+            size += self.price_calendar.nbytes()
+        return size
+
+    def record_booking(self, booking: Booking):
+        if booking.pnr in self._booking_rows:
+            # A duplicate commit that the reservation pipeline resolved to an existing PNR
+            return
+        self._booking_rows[booking.pnr] = len(self.bookings)
+        self.bookings.append(booking)
+
+    def find_booking(self, passenger: Optional[str] = None, reference: Optional[str] = None,
+                     travel_date: Optional[str] = None) -> Optional[Booking]:
+        """
+        Latest confirmed booking, optionally for one passenger and travel date and
+        matching a reference (PNR, flight ID or airline name).
+        """
+        reference = (reference or "").strip().lower()
+        for booking in reversed(self.bookings):
+            if booking.status != "CONFIRMED" or (passenger and booking.passenger != passenger):
+                continue
+            if travel_date and booking.travel_date != travel_date:
+                continue
+            if not reference or reference in (booking.pnr.lower(), booking.flight_id.lower()) \
+                    or reference in booking.airline.lower():
+                return booking
+        return None
+
+    def rank_bookings(self, passenger: Optional[str], query: FlightQuery) -> Optional[Booking]:
+        """The confirmed booking a ranked reference picks out ("the cheapest one", "the non-Lufthansa one")."""
+        candidates = [b for b in self.bookings if b.status == "CONFIRMED" and (not passenger or b.passenger == passenger)]
+        if query.airline:
+            candidates = [b for b in candidates if query.airline.lower() in b.airline.lower()]
+        if query.exclude_airline:
+            candidates = [b for b in candidates if query.exclude_airline.lower() not in b.airline.lower()]
+        if query.max_price is not None:
+            candidates = [b for b in candidates if b.price is not None and b.price <= query.max_price]
+        if query.min_price is not None:
+            candidates = [b for b in candidates if b.price is not None and b.price >= query.min_price]
+        if not candidates:
+            return None
+        if query.sort_by == "departure":
+            key = lambda b: (b.travel_date or "", _parse_clock(b.departure or "") or 0)
+        else:
+            key = lambda b: b.price if b.price is not None else 0
+        return max(candidates, key=key) if query.descending else min(candidates, key=key)
+
+    def cancel_booking(self, pnr: str) -> Optional[Booking]:
+        """Marks a booking cancelled. The ledger is compacted once half of it is tombstones."""
+        row = self._booking_rows.get(pnr)
+        if row is None or self.bookings[row].status != "CONFIRMED":
+            return None
+        booking = self.bookings[row]
+        booking.status = "CANCELLED"
+        self._cancelled_bookings += 1
+        if self._cancelled_bookings * 2 > len(self.bookings):
+            self.bookings = [b for b in self.bookings if b.status == "CONFIRMED"]
+            self._booking_rows = {b.pnr: i for i, b in enumerate(self.bookings)}
+            self._cancelled_bookings = 0
+        return booking
 
     def find_flight_by_airline(self, airline_name: str) -> Optional[FlightRecord]:
         """Resolves fuzzy airline name match."""
-        normalized_query = airline_name.lower().replace(" ", "")
-        for flight in self.flight_cache:
-            if normalized_query in flight.airline.lower().replace(" ", ""):
-                return flight
-        return None
+        candidates = self.airline_resolver.resolve(airline_name, limit=1)
+        if not candidates:
+            return None
+        return self.flight_cache[self._by_airline[candidates[0][0]]]
+
+    def rank_airlines(self, airline_name: str, limit: int = 3) -> List[Tuple[str, float]]:
+        """Ranked (airline, score) candidates for a reference, for clarification prompts."""
+        return self.airline_resolver.resolve(airline_name, limit)
 
     def find_cheapest_flight(self) -> Optional[FlightRecord]:
         """Resolves 'cheapest' intent."""
-        if not self.flight_cache:
+        if not self._by_price:
             return None
-        return min(self.flight_cache, key=lambda x: x.price)
+        return self.flight_cache[self._by_price[0]]
 
     def get_flight_by_id(self, flight_id: str) -> Optional[FlightRecord]:
-        for flight in self.flight_cache:
-            if flight.flight_id == flight_id:
-                return flight
-        return None
+        row = self._by_id.get(flight_id)
+        return self.flight_cache[row] if row is not None else None
+
+    def query(self, query: FlightQuery) -> List[FlightRecord]:
+        """
+        Runs a filter + sort + top-k query over the cached columns.
+        Vectorized with NumPy when available; top-k uses partial selection
+        (argpartition / heapq) so only the returned rows are fully ordered.
+        """
+        n = len(self.flight_cache)
+        if not n:
+            return []
+        limit = n if query.limit is None else min(query.limit, n)
+
+        if not query.has_filters and query.sort_by == "price":
+            # Unfiltered price ranking is already precomputed
+            rows = self._by_price[n - limit:][::-1] if query.descending else self._by_price[:limit]
+        elif np is not None:
+            rows = self._query_rows_numpy(query, limit)
+        else:
+            rows = self._query_rows_python(query, limit)
+        return [self.flight_cache[row] for row in rows]
+
+    def _airline_codes_matching(self, name: str) -> List[int]:
+        """Codes of the cached airlines tied for the best resolver score."""
+        candidates = self.airline_resolver.resolve(name, limit=len(self._by_airline))
+        codes = self.flight_cache.airline_codes
+        return [codes[self._by_airline[airline]] for airline, score in candidates if score == candidates[0][1]]
+
+    def _query_rows_numpy(self, query: FlightQuery, limit: int) -> List[int]:
+        columns = self.flight_cache
+        prices = np.frombuffer(columns.prices, dtype=np.int32)
+        departures = np.frombuffer(columns.departure_minutes, dtype=np.int16)
+        airlines = np.frombuffer(columns.airline_codes, dtype=np.uint32)
+
+        mask = np.ones(len(prices), dtype=bool)
+        if query.min_price is not None:
+            mask &= prices >= query.min_price
+        if query.max_price is not None:
+            mask &= prices <= query.max_price
+        if query.sort_by == "departure" or query.earliest_departure is not None or query.latest_departure is not None:
+            # Unparseable departure times (-1) cannot satisfy a time constraint
+            mask &= departures >= 0
+        if query.earliest_departure is not None:
+            mask &= departures >= query.earliest_departure
+        if query.latest_departure is not None:
+            mask &= departures <= query.latest_departure
+        if query.airline is not None:
+            mask &= np.isin(airlines, self._airline_codes_matching(query.airline))
+        if query.exclude_airline is not None:
+            mask &= ~np.isin(airlines, self._airline_codes_matching(query.exclude_airline))
+
+        rows = np.flatnonzero(mask)
+        keys = (prices if query.sort_by == "price" else departures)[rows].astype(np.int64)
+        if query.descending:
+            keys = -keys
+        # Fold the row number into the key so ties keep cache order, like the precomputed price view
+        keys = keys * len(prices) + rows
+        if limit < len(rows):
+            part = np.argpartition(keys, limit - 1)[:limit]
+            rows, keys = rows[part], keys[part]
+        return rows[np.argsort(keys)].tolist()
+
+    def _query_rows_python(self, query: FlightQuery, limit: int) -> List[int]:
+        columns = self.flight_cache
+        prices, departures, airlines = columns.prices, columns.departure_minutes, columns.airline_codes
+
+        rows: Any = range(len(prices))
+        if query.min_price is not None:
+            rows = [r for r in rows if prices[r] >= query.min_price]
+        if query.max_price is not None:
+            rows = [r for r in rows if prices[r] <= query.max_price]
+        if query.sort_by == "departure" or query.earliest_departure is not None or query.latest_departure is not None:
+            rows = [r for r in rows if departures[r] >= 0]
+        if query.earliest_departure is not None:
+            rows = [r for r in rows if departures[r] >= query.earliest_departure]
+        if query.latest_departure is not None:
+            rows = [r for r in rows if departures[r] <= query.latest_departure]
+        if query.airline is not None:
+            wanted = set(self._airline_codes_matching(query.airline))
+            rows = [r for r in rows if airlines[r] in wanted]
+        if query.exclude_airline is not None:
+            unwanted = set(self._airline_codes_matching(query.exclude_airline))
+            rows = [r for r in rows if airlines[r] not in unwanted]
+
+        keys = prices if query.sort_by == "price" else departures
+        sign = -1 if query.descending else 1
+        return heapq.nsmallest(limit, rows, key=lambda r: (sign * keys[r], r))
 
 # ==============================================================================
 # 3. MOCK TOOLS (DATA LAYER)
@@ -115,164 +939,3476 @@ def _search_flight_inventory(origin: str, destination: str, date_str: str) -> Di
         ]
     }
 
-def _commit_reservation(flight_id: str, passenger_name: str) -> Dict:
-    """Mock booking tool."""
-    logger.info(f"TOOL CALL: CommitReservation [ID: {flight_id}, Passenger: {passenger_name}]")
-    import uuid
-    pnr = f"PNR{str(uuid.uuid4())[:6].upper()}"
-    return {
-        "status": "CONFIRMED",
-        "pnr": pnr,
-        "flight_id": flight_id,
-        "passenger": passenger_name
-    }
+class InventoryError(Exception):
+    """Raised by an inventory provider when the fare source fails."""
 
-# ==============================================================================
-# 4. ORCHESTRATOR (CONTROLLER LOGIC - AGENTIC DECISION ENGINE)
-# ==============================================================================
+class InventoryProvider(Protocol):
+    """
+    A fare source. search() returns {"flights": [{"flight_id", "airline", "departure_time", "price"}, ...]}.
+    Providers may also offer search_stream(), yielding lists of fares as they arrive,
+    and search_range(origin, destination, dates) answering a window of dates in one call.
+    """
+    def search(self, origin: str, destination: str, date_str: str) -> Dict:
+        ...
 
-class TravelAgentSystem:
-    def __init__(self):
-        self.memory = AgentMemory()
-        self.model = genai.GenerativeModel(MODEL_NAME)
-        
-    def _extract_parameters(self, user_input: str) -> Dict[str, Any]:
-        """
-        Uses LLM strictly for NLU (Natural Language Understanding) to parse intent and parameters.
-        Does NOT make decisions.
+class MockInventoryProvider:
+    """The fixed three-fare demo inventory."""
+    def search(self, origin: str, destination: str, date_str: str) -> Dict:
+        return _search_flight_inventory(origin, destination, date_str)
+
+    def search_stream(self, origin: str, destination: str, date_str: str) -> Iterator[List[Dict]]:
+        yield self.search(origin, destination, date_str)["flights"]
+
+SYNTHETIC_CITIES = (
+    "London", "Paris", "Frankfurt", "Amsterdam", "Madrid", "Rome", "Berlin", "Munich", "Zurich", "Vienna",
+    "Dublin", "Lisbon", "Barcelona", "Milan", "Brussels", "Copenhagen", "Stockholm", "Oslo", "Helsinki", "Warsaw",
+    "Prague", "Budapest", "Athens", "Istanbul", "Dubai", "Doha", "New York", "Boston", "Chicago", "Toronto",
+    "Los Angeles", "San Francisco", "Miami", "Atlanta", "Singapore", "Hong Kong", "Tokyo", "Seoul", "Sydney", "Mumbai",
+)
+SYNTHETIC_AIRLINES = (
+    ("BA", "British Airways"), ("AF", "Air France"), ("LH", "Lufthansa"), ("KL", "KLM"), ("IB", "Iberia"),
+    ("EK", "Emirates"), ("DL", "Delta"), ("UA", "United"), ("LX", "Swiss"), ("OS", "Austrian"),
+    ("SK", "SAS"), ("AY", "Finnair"), ("TP", "TAP Air Portugal"), ("EI", "Aer Lingus"), ("QR", "Qatar Airways"),
+)
+
+class SyntheticInventoryProvider:
+    """
+    Seeded generator of realistic, deterministic inventories for offline load tests.
+    The same (seed, origin, destination, date) always yields the same fares, so
+    runs are reproducible. Latency and failures can be injected per call.
+    """
+    def __init__(self, seed: int = 0, min_fares: int = 100, max_fares: int = 400,
+                 latency_seconds: float = 0.0, latency_jitter: float = 0.0, error_rate: float = 0.0):
+        self.seed = seed
+        self.min_fares = min_fares
+        self.max_fares = max_fares
+        self.latency_seconds = latency_seconds
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        # Shared by the latency/error draws only; fare generation uses a per-route RNG
+        self._chaos = random.Random(seed)
+
+    @staticmethod
+    def routes() -> List[Tuple[str, str]]:
+        """Every ordered city pair the generator knows about (1,560 routes)."""
+        return [(o, d) for o in SYNTHETIC_CITIES for d in SYNTHETIC_CITIES if o != d]
+
+    def search(self, origin: str, destination: str, date_str: str) -> Dict:
+        self._inject_faults(origin, destination, date_str, self._draw_latency())
+        return {"flights": self._generate(origin, destination, date_str)}
+
+    def search_range(self, origin: str, destination: str, dates: List[str]) -> Dict[str, Dict]:
+        """Several dates of one route in a single call (one latency draw), keyed by date."""
+        self._inject_faults(origin, destination, f"{dates[0]}..{dates[-1]}", self._draw_latency())
+        return {date_str: {"flights": self._generate(origin, destination, date_str)} for date_str in dates}
+
+    def search_stream(self, origin: str, destination: str, date_str: str,
+                      chunk_size: int = SYNTHETIC_STREAM_CHUNK) -> Iterator[List[Dict]]:
+        """Same fares as search(), delivered in chunks with the latency spread across them."""
+        latency = self._draw_latency()
+        flights = self._generate(origin, destination, date_str)
+        chunks = [flights[i:i + chunk_size] for i in range(0, len(flights), chunk_size)] or [[]]
+        self._inject_faults(origin, destination, date_str, latency / len(chunks))
+        for i, chunk in enumerate(chunks):
+            if i and latency:
+                time.sleep(latency / len(chunks))
+            yield chunk
+
+    def _draw_latency(self) -> float:
+        if not (self.latency_seconds or self.latency_jitter):
+            return 0.0
+        return max(0.0, self.latency_seconds + self._chaos.uniform(-self.latency_jitter, self.latency_jitter))
+
+    def _inject_faults(self, origin: str, destination: str, date_str: str, delay: float):
+        self.calls += 1
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and self._chaos.random() < self.error_rate:
+            raise InventoryError(f"Synthetic inventory failure for {origin}-{destination} on {date_str}")
+
+    def _generate(self, origin: str, destination: str, date_str: str) -> List[Dict]:
+        # zlib.crc32 is stable across processes, unlike hash()
+        route_seed = zlib.crc32(f"{self.seed}|{origin.lower()}|{destination.lower()}|{date_str}".encode())
+        rng = random.Random(route_seed)
+        # Each route/date gets its own base fare; individual fares scatter around it
+        base_fare = 80 + route_seed % 700
+        flights = []
+        for flight_number in rng.sample(range(100, 10000), rng.randint(self.min_fares, self.max_fares)):
+            code, airline = rng.choice(SYNTHETIC_AIRLINES)
+            minutes = rng.randrange(5 * 60, 23 * 60, 5)
+            price = int(base_fare * rng.lognormvariate(0, 0.35))
+            flights.append({
+                "flight_id": f"{code}-{flight_number}",
+                "airline": airline,
+                "departure_time": f"{(minutes // 60 - 1) % 12 + 1:02d}:{minutes % 60:02d} {'AM' if minutes < 720 else 'PM'}",
+                "price": f"${price}"
+            })
+        return flights
+
+class FanOutInventoryProvider:
+    """
+    Queries several providers concurrently and merges their fares.
+    Latency is the slowest provider that answers within the deadline; providers
+    that miss it or fail are dropped from this search. Duplicate fares (same flight
+    ID and departure) keep the copy from the earliest-listed provider.
+    """
+    def __init__(self, providers: List[InventoryProvider], deadline_seconds: float = FANOUT_DEADLINE_SECONDS,
+                 max_workers: int = FANOUT_MAX_WORKERS):
+        self.providers = providers
+        self.deadline_seconds = deadline_seconds
+        self.late_drops = 0
+        self.failures = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fanout")
+
+    def search(self, origin: str, destination: str, date_str: str) -> Dict:
+        futures = [self._executor.submit(p.search, origin, destination, date_str) for p in self.providers]
+        wait(futures, timeout=self.deadline_seconds)
+
+        flights: List[Dict] = []
+        seen = set()
+        answered = 0
+        for provider, future in zip(self.providers, futures):
+            name = type(provider).__name__
+            if not future.done():
+                # Cannot interrupt a running call; its result is simply ignored
+                future.cancel()
+                self.late_drops += 1
+                logger.warning(f"Fan-out: {name} missed the {self.deadline_seconds}s deadline, dropped")
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Fan-out: {name} failed: {e}")
+                continue
+            answered += 1
+            for fare in result.get("flights", []):
+                key = (fare["flight_id"], fare["departure_time"])
+                if key not in seen:
+                    seen.add(key)
+                    flights.append(fare)
+
+        if self.providers and not answered:
+            raise InventoryError(f"No provider answered for {origin}-{destination} on {date_str}")
+        return {"flights": flights}
+
+    def search_stream(self, origin: str, destination: str, date_str: str) -> Iterator[List[Dict]]:
         """
-        prompt = f"""
-        Analyze the following user input and extract structured data.
-        User Input: "{user_input}"
-        
-        Output valid JSON with these keys:
-        - "intent": "SEARCH", "BOOK", or "GENERAL"
-        - "origin": City name or null
-        - "destination": City name or null
-        - "date_reference": "tomorrow", "next monday", "specific date", or null
-        - "booking_target": If booking, the airline name (e.g., "Air France") or "cheapest", or null
-        - "passenger": Passenger name or "Guest"
-        
-        Return ONLY JSON.
+        Yields each provider's new (de-duplicated) fares in completion order, so the
+        fastest source is shown first. Duplicates keep the first copy to arrive.
         """
+        futures = {self._executor.submit(p.search, origin, destination, date_str): p for p in self.providers}
+        seen = set()
+        answered = 0
         try:
-            response = self.model.generate_content(prompt)
-            # Clean markdown code blocks if present
-            cleaned_text = response.text.replace("```json", "").replace("```", "").strip()
-            return json.loads(cleaned_text)
-        except Exception as e:
-            logger.error(f"NLU Extraction failed: {e}")
-            return {"intent": "GENERAL"}
+            for future in as_completed(futures, timeout=self.deadline_seconds):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning(f"Fan-out: {type(futures[future]).__name__} failed: {e}")
+                    continue
+                answered += 1
+                batch = []
+                for fare in result.get("flights", []):
+                    key = (fare["flight_id"], fare["departure_time"])
+                    if key not in seen:
+                        seen.add(key)
+                        batch.append(fare)
+                yield batch
+        except FuturesTimeoutError:
+            for future, provider in futures.items():
+                if not future.done():
+                    future.cancel()
+                    self.late_drops += 1
+                    logger.warning(f"Fan-out: {type(provider).__name__} missed the {self.deadline_seconds}s deadline, dropped")
+        if self.providers and not answered:
+            raise InventoryError(f"No provider answered for {origin}-{destination} on {date_str}")
 
-    def _resolve_date(self, date_ref: str) -> str:
-        """Python logic to calculate dates. No LLM guessing."""
-        today = datetime.date.today()
-        
-        if not date_ref:
-            return today.strftime("%Y-%m-%d")
-            
-        date_ref = date_ref.lower()
-        target_date = today
-
-        if "tomorrow" in date_ref:
-            target_date = today + datetime.timedelta(days=1)
-        elif "today" in date_ref:
-            target_date = today
-        # Add more logic here for "next week" etc if needed
-        # For this production snippet, we handle 'tomorrow' explicitly as requested.
-        
-        return target_date.strftime("%Y-%m-%d")
-
-    def _generate_response(self, context: str) -> str:
-        """Uses LLM strictly for NLG (Natural Language Generation)."""
-        prompt = f"""
-        You are a professional corporate travel assistant.
-        Based on the SYSTEM CONTEXT below, generate a concise, professional response to the user.
-        Do not make up new facts. Use the provided context.
-        
-        SYSTEM CONTEXT:
-        {context}
-        """
-        res = self.model.generate_content(prompt)
-        return res.text.strip()
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing of one blake2b digest)."""
+    def __init__(self, capacity: int = PNR_BLOOM_CAPACITY, error_rate: float = PNR_BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
 
-    def handle_request(self, user_input: str) -> str:
-        """Main orchestrator logic."""
-        
-        # Step 1: NLU - extract intent and parameters
-        nlu_data = self._extract_parameters(user_input)
-        intent = nlu_data.get("intent", "GENERAL")
-        logger.info(f"Intent Detected: {intent} | Data: {nlu_data}")
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
 
-        # Step 2: Route to appropriate handler based on intent
-        if intent == "SEARCH":
-            return self._handle_search(nlu_data)
-        elif intent == "BOOK":
-            return self._handle_booking(nlu_data)
-        else:
-            return "I am a Travel Agent system. I can help you search for and book flights. How may I assist?"
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
 
-    def _handle_search(self, data: Dict) -> str:
-        origin = data.get("origin", "Unknown")
-        dest = data.get("destination", "Unknown")
-        date_ref = data.get("date_reference")
-        
-        # Resolve date using deterministic Python logic
-        travel_date = self._resolve_date(date_ref)
-        
-        # Call search tool directly - no LLM involved
-        search_results = _search_flight_inventory(origin, dest, travel_date)
-        
-        # Update agent memory with search results
-        self.memory.update_cache(search_results['flights'], origin, dest)
-        
-        # Generate human-readable summary via NLG
-        flight_strings = [f"- {f.airline} ({f.flight_id}): {f.raw_price} at {f.departure}" for f in self.memory.flight_cache]
-        context_str = f"Search completed for {origin} to {dest} on {travel_date}. Found {len(flight_strings)} options:\n" + "\n".join(flight_strings)
-        
-        return self._generate_response(context_str)
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
 
-    def _handle_booking(self, data: Dict) -> str:
-        target = data.get("booking_target", "").lower()
-        passenger = data.get("passenger", "Guest")
-        
-        flight_record = None
+class PNRAllocator:
+    """
+    Collision-free record locators without per-booking randomness or retries.
+    A counter is mapped through a seeded affine permutation of the code space
+    (32^6 = 2^30, so any odd multiplier is a bijection), which makes codes
+    non-sequential. Workers share the seed and worker w of n only uses counter
+    values w, w + n, w + 2n, ..., so codes are unique across all of them.
+    Codes are generated a block at a time under a lock and then handed out from
+    a per-thread list with no locking. Codes issued elsewhere (e.g. by an earlier
+    run, loaded from the backend at startup via `reserve`) are kept in a Bloom
+    filter and skipped; a false positive only wastes one code.
+    """
+    SPACE = len(PNR_ALPHABET) ** PNR_LENGTH
 
-        # Entity resolution: map user reference to actual flight in memory
-        if "cheapest" in target:
-            flight_record = self.memory.find_cheapest_flight()
-            logger.info(f"Entity Resolution: 'cheapest' resolved to ID {flight_record.flight_id if flight_record else 'None'}")
-        else:
-            # Try matching by airline name first
-            flight_record = self.memory.find_flight_by_airline(target)
-            if not flight_record:
-                # Fallback: check if user provided raw flight ID
-                flight_record = self.memory.get_flight_by_id(target.upper())
-            logger.info(f"Entity Resolution: '{target}' resolved to ID {flight_record.flight_id if flight_record else 'None'}")
+    def __init__(self, block_size: int = PNR_BLOCK_SIZE, seed: Optional[int] = PNR_SEED,
+                 worker_id: int = PNR_WORKER_ID, worker_count: int = PNR_WORKER_COUNT):
+        if not 0 <= worker_id < worker_count:
+            raise ValueError(f"PNR worker id {worker_id} is outside 0..{worker_count - 1}")
+        if seed is None and worker_count > 1:
+            raise ValueError("Several PNR workers need a shared seed (set PNR_SEED)")
+        rng = random.Random(seed)
+        self.block_size = block_size
+        self.worker_id = worker_id
+        self.worker_count = worker_count
+        self._multiplier = rng.randrange(1, self.SPACE, 2)
+        self._offset = rng.randrange(self.SPACE)
+        self._issued = BloomFilter()
+        self._next_index = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.blocks = 0
+        self.skipped = 0
 
-        if not flight_record:
-            return "I could not identify the flight you wish to book. Please specify the airline name or flight ID from the search results."
+    def reserve(self, codes: Iterable[str]):
+        """Marks codes issued outside this allocator so they are never handed out."""
+        with self._lock:
+            for code in codes:
+                self._issued.add(code)
 
-        # Execute booking via tool call
-        booking_result = _commit_reservation(flight_record.flight_id, passenger)
-        
-        # Generate confirmation message
-        context_str = (
-            f"Booking successful.\n"
-            f"Airline: {flight_record.airline}\n"
-            f"Flight ID: {booking_result['flight_id']}\n"
-            f"Passenger: {booking_result['passenger']}\n"
-            f"PNR: {booking_result['pnr']}\n"
-            f"Status: {booking_result['status']}"
-        )
-        return self._generate_response(context_str)
+    def allocate(self) -> str:
+        block = getattr(self._local, "block", None)
+        if not block:
+            block = self._local.block = self._fill_block()
+        return block.pop()
 
-# ==============================================================================
-# 5. EXECUTION ENTRY POINT
-# ==============================================================================
+    def _fill_block(self) -> List[str]:
+        with self._lock:
+            start = self._next_index * self.worker_count + self.worker_id
+            stop = start + self.block_size * self.worker_count
+            if stop > self.SPACE:
+                raise RuntimeError("PNR code space exhausted")
+            self._next_index += self.block_size
+            self.blocks += 1
+            codes = []
+            for index in range(start, stop, self.worker_count):
+                code = self._encode((index * self._multiplier + self._offset) % self.SPACE)
+                if code in self._issued:
+                    self.skipped += 1
+                    continue
+                self._issued.add(code)
+                codes.append(code)
+        # Handed out from the end of the list
+        codes.reverse()
+        return codes or self._fill_block()
+
+    @staticmethod
+    def _encode(value: int) -> str:
+        chars = []
+        for _ in range(PNR_LENGTH):
+            value, digit = divmod(value, len(PNR_ALPHABET))
+            chars.append(PNR_ALPHABET[digit])
+        return "".join(chars)
+
+PNR_ALLOCATOR = PNRAllocator()
+
+@dataclass
+class SeatHold:
+    hold_id: str
+    key: Tuple[str, str, Optional[Tuple[str, str]]]
+    seats: int
+    expires_at: float
+
+SEAT_STATS = ("holds", "rejected", "confirmed", "released", "expired", "cancelled")
+
+class _FlightSeats:
+    __slots__ = ("capacity", "sold", "held")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.sold = 0
+        self.held = 0
+
+    @property
+    def available(self) -> int:
+        return self.capacity - self.sold - self.held
+
+class TimerWheel:
+    """
+    Hashed timer wheel for hold expiry: scheduling is O(1) and each tick only
+    looks at one slot. Entries go into the slot of the first tick at or after
+    their deadline, so a slot is fully due once the wheel reaches it. Entries
+    more than a full turn ahead stay in their slot until their deadline passes.
+    """
+    def __init__(self, tick: float = TIMER_WHEEL_TICK_SECONDS, slots: int = TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self._slots: List[Dict[str, float]] = [{} for _ in range(slots)]
+        self._current = int(time.monotonic() / tick)
+
+    def _slot(self, deadline: float) -> Dict[str, float]:
+        return self._slots[math.ceil(deadline / self.tick) % len(self._slots)]
+
+    def schedule(self, key: str, deadline: float):
+        self._slot(deadline)[key] = deadline
+
+    def cancel(self, key: str, deadline: float):
+        self._slot(deadline).pop(key, None)
+
+    def due(self, now: float) -> bool:
+        return int(now / self.tick) > self._current
+
+    def advance(self, now: float) -> List[str]:
+        """Moves the wheel to `now` and returns the keys whose deadline has passed."""
+        target = int(now / self.tick)
+        expired: List[str] = []
+        # After a long gap every slot is visited once, not once per missed tick
+        for tick in range(max(self._current + 1, target - len(self._slots) + 1), target + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key in [key for key, deadline in slot.items() if deadline <= now]:
+                del slot[key]
+                expired.append(key)
+        self._current = target
+        return expired
+
+class SeatInventory:
+    """
+    In-process seat inventory per (flight_id, date, route) with hold/confirm/release.
+    The route (origin, destination) is part of the key because providers may reuse
+    flight IDs across routes.
+    A hold takes seats out of availability until it is confirmed (sold), released,
+    or expires via the timer wheel. Flights are spread over striped locks so a hot
+    fare only contends with itself; each operation holds one lock for a few dict
+    updates, so it is safe to call from threads and directly from the event loop.
+    Expiry runs lazily on the next operation after a wheel tick, so no thread is needed.
+    Flights with nothing held or sold at the default capacity are dropped, and the
+    counters are kept per stripe (summed by `stats`), so neither grows nor races.
+    """
+    def __init__(self, default_capacity: int = SEAT_DEFAULT_CAPACITY, hold_ttl: float = SEAT_HOLD_TTL_SECONDS,
+                 stripes: int = SEAT_LOCK_STRIPES):
+        self.default_capacity = default_capacity
+        self.hold_ttl = hold_ttl
+        self._flights: Dict[Tuple[str, str, Optional[Tuple[str, str]]], _FlightSeats] = {}
+        self._holds: Dict[str, SeatHold] = {}
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        # Each stripe's counters are only updated under that stripe's lock
+        self._stripe_stats = [dict.fromkeys(SEAT_STATS, 0) for _ in range(stripes)]
+        self._wheel = TimerWheel()
+        self._wheel_lock = threading.Lock()
+        self._hold_ids = itertools.count(1)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {name: sum(stripe[name] for stripe in self._stripe_stats) for name in SEAT_STATS}
+
+    def _stripe(self, key: Tuple) -> Tuple[threading.Lock, Dict[str, int]]:
+        i = hash(key) % len(self._stripes)
+        return self._stripes[i], self._stripe_stats[i]
+
+    def _seats(self, key: Tuple) -> _FlightSeats:
+        # Called under the key's stripe lock
+        seats = self._flights.get(key)
+        if seats is None:
+            seats = self._flights[key] = _FlightSeats(self.default_capacity)
+        return seats
+
+    def _discard_if_empty(self, key: Tuple, flight: _FlightSeats):
+        # Called under the key's stripe lock; an untouched default entry is recreated on demand
+        if not flight.held and not flight.sold and flight.capacity == self.default_capacity:
+            del self._flights[key]
+
+    def set_capacity(self, flight_id: str, date: str, capacity: int, route: Optional[Tuple[str, str]] = None):
+        key = (flight_id, date, route)
+        with self._stripe(key)[0]:
+            self._seats(key).capacity = capacity
+
+    def available(self, flight_id: str, date: str, route: Optional[Tuple[str, str]] = None) -> int:
+        self._expire()
+        key = (flight_id, date, route)
+        with self._stripe(key)[0]:
+            flight = self._flights.get(key)
+            return flight.available if flight is not None else self.default_capacity
+
+    def hold(self, flight_id: str, date: str, seats: int = 1, ttl: Optional[float] = None,
+             route: Optional[Tuple[str, str]] = None, max_share: float = 1.0) -> Optional[str]:
+        """
+        Holds seats and returns the hold id, or None if not enough are available or
+        the flight's held seats would exceed `max_share` of its capacity.
+        """
+        self._expire()
+        key = (flight_id, date, route)
+        lock, stats = self._stripe(key)
+        with lock:
+            flight = self._seats(key)
+            if flight.available < seats or flight.held + seats > flight.capacity * max_share:
+                stats["rejected"] += 1
+                self._discard_if_empty(key, flight)
+                return None
+            flight.held += seats
+            hold = SeatHold(f"H{next(self._hold_ids)}", key, seats, time.monotonic() + (ttl or self.hold_ttl))
+            self._holds[hold.hold_id] = hold
+            stats["holds"] += 1
+        with self._wheel_lock:
+            self._wheel.schedule(hold.hold_id, hold.expires_at)
+        return hold.hold_id
+
+    def confirm(self, hold_id: str) -> bool:
+        """Turns a live hold into sold seats. False if it expired or was already used."""
+        return self._settle(hold_id, sold=True)
+
+    def release(self, hold_id: str) -> bool:
+        """Returns a hold's seats to availability. False if it was already settled."""
+        return self._settle(hold_id, sold=False)
+
+    def book(self, flight_id: str, date: str, seats: int = 1, route: Optional[Tuple[str, str]] = None) -> bool:
+        """Sells seats directly (hold and confirm in one step)."""
+        hold_id = self.hold(flight_id, date, seats, route=route)
+        return hold_id is not None and self.confirm(hold_id)
+
+    def cancel_sale(self, flight_id: str, date: str, seats: int = 1, route: Optional[Tuple[str, str]] = None) -> bool:
+        """Returns sold seats to availability (a cancelled reservation)."""
+        key = (flight_id, date, route)
+        lock, stats = self._stripe(key)
+        with lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.sold < seats:
+                return False
+            flight.sold -= seats
+            stats["cancelled"] += 1
+            self._discard_if_empty(key, flight)
+        return True
+
+    def _settle(self, hold_id: str, sold: bool, counter: Optional[str] = None) -> bool:
+        hold = self._holds.get(hold_id)
+        if hold is None:
+            return False
+        lock, stats = self._stripe(hold.key)
+        with lock:
+            # Whoever pops the hold settles it; a concurrent confirm/release/expiry sees None
+            if self._holds.pop(hold_id, None) is None:
+                return False
+            flight = self._flights[hold.key]
+            flight.held -= hold.seats
+            if sold:
+                flight.sold += hold.seats
+            stats[counter or ("confirmed" if sold else "released")] += 1
+            self._discard_if_empty(hold.key, flight)
+        if counter is None:
+            with self._wheel_lock:
+                self._wheel.cancel(hold_id, hold.expires_at)
+        return True
+
+    def _expire(self):
+        now = time.monotonic()
+        if not self._wheel.due(now) or not self._wheel_lock.acquire(blocking=False):
+            return
+        try:
+            expired = self._wheel.advance(now)
+        finally:
+            self._wheel_lock.release()
+        for hold_id in expired:
+            self._settle(hold_id, sold=False, counter="expired")
+
+SEAT_INVENTORY = SeatInventory()
+
+def _commit_reservation(flight_id: str, passenger_name: str, travel_date: Optional[str] = None,
+                        hold_id: Optional[str] = None, route: Optional[Tuple[str, str]] = None,
+                        idempotency_key: Optional[Tuple] = None) -> Dict:
+    """
+    Mock booking tool. Confirms the search-time hold when it is still live,
+    otherwise tries to sell a seat directly; SOLD_OUT when none is left.
+    A repeated idempotency key returns the original reservation.
+    """
+    logger.info(f"TOOL CALL: CommitReservation [ID: {flight_id}, Passenger: {passenger_name}]")
+    return RESERVATION_PIPELINE.commit(idempotency_key, flight_id, passenger_name, travel_date, hold_id, route)
+
+def _reserve_seat(flight_id: str, passenger_name: str, travel_date: Optional[str], hold_id: Optional[str],
+                  route: Optional[Tuple[str, str]]) -> Dict:
+    travel_date = travel_date or datetime.date.today().strftime("%Y-%m-%d")
+    if not (hold_id and SEAT_INVENTORY.confirm(hold_id)) and not SEAT_INVENTORY.book(flight_id, travel_date, route=route):
+        logger.info(f"TOOL RESULT: {flight_id} on {travel_date} is sold out")
+        return {"status": "SOLD_OUT", "pnr": None, "flight_id": flight_id, "passenger": passenger_name}
+    pnr = f"PNR{PNR_ALLOCATOR.allocate()}"
+    return {
+        "status": "CONFIRMED",
+        "pnr": pnr,
+        "flight_id": flight_id,
+        "passenger": passenger_name
+    }
+
+def _cancel_reservation(pnr: str, flight_id: str, travel_date: Optional[str],
+                        route: Optional[Tuple[str, str]] = None) -> Dict:
+    """Mock cancellation tool: the seat goes back to the inventory."""
+    logger.info(f"TOOL CALL: CancelReservation [PNR: {pnr}, ID: {flight_id}]")
+    RESERVATION_PIPELINE.cancel(pnr, flight_id, travel_date, route)
+    return {"status": "CANCELLED", "pnr": pnr, "flight_id": flight_id}
+
+def _swap_reservation(old_pnr: str, old_flight_id: str, old_travel_date: Optional[str], flight_id: str,
+                      passenger_name: str, travel_date: Optional[str] = None, hold_id: Optional[str] = None,
+                      old_route: Optional[Tuple[str, str]] = None, route: Optional[Tuple[str, str]] = None,
+                      idempotency_key: Optional[Tuple] = None) -> Dict:
+    """
+    Mock rebooking tool: one round trip that commits the new reservation and
+    only then cancels the old one, so a sold-out new flight leaves the old booking intact.
+    """
+    logger.info(f"TOOL CALL: SwapReservation [PNR: {old_pnr} -> ID: {flight_id}, Passenger: {passenger_name}]")
+    result = RESERVATION_PIPELINE.commit(idempotency_key, flight_id, passenger_name, travel_date, hold_id, route)
+    if result["status"] == "CONFIRMED":
+        RESERVATION_PIPELINE.cancel(old_pnr, old_flight_id, old_travel_date, old_route)
+        result["cancelled_pnr"] = old_pnr
+    return result
+
+def _release_holds(memory: "AgentMemory"):
+    """Returns a session's unused search-time holds to the seat inventory."""
+    for hold_id in memory.holds.values():
+        SEAT_INVENTORY.release(hold_id)
+    memory.holds = {}
+
+def _write_reservations(records: List[Dict]):
+    """Mock reservation backend: persists a batch of reservation records in one round trip."""
+    logger.info(f"TOOL CALL: WriteReservations [{len(records)} records]")
+
+class ReservationPipeline:
+    """
+    Idempotent reservation commits with write-behind persistence.
+    - A commit's idempotency key (session, passenger, flight, date) maps to one
+      reservation: a repeated key returns it, and concurrent duplicates wait for
+      the first commit instead of selling a second seat.
+    - Seats are settled synchronously in SEAT_INVENTORY, whose per-flight lock
+      stripes let a hot fare absorb a burst without overselling.
+    - Reservation records go into a FIFO queue that one writer thread drains in
+      batches, when a batch fills or after a short window, so bookings never wait
+      on the backend. A failed batch stays at the head of the queue and is retried
+      with backoff, so the backend sees records in commit order.
+    - close() drains the queue and saves anything still unwritten to `spill_path`,
+      which the next pipeline on that path queues again. Records carry their PNR
+      and status, so a replayed write is idempotent.
+    """
+    def __init__(self, write_fn: Callable[[List[Dict]], None] = _write_reservations,
+                 batch_size: int = RESERVATION_BATCH_SIZE, window_seconds: float = RESERVATION_FLUSH_SECONDS,
+                 max_keys: int = RESERVATION_KEY_CACHE_SIZE, backoff: float = RESERVATION_RETRY_BACKOFF_SECONDS,
+                 max_backoff: float = RESERVATION_RETRY_MAX_SECONDS, spill_path: Optional[str] = None):
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spill_path = spill_path
+        self.stats = {"commits": 0, "duplicates": 0, "cancels": 0, "written": 0, "batches": 0, "write_failures": 0}
+        # key -> confirmed result, least recently used first, and the reverse map for cancellations
+        self._results: "OrderedDict[Tuple, Dict]" = OrderedDict()
+        self._keys_by_pnr: Dict[str, Tuple] = {}
+        self._in_flight: Dict[Tuple, Future] = {}
+        self._queue: "deque[Dict]" = deque()
+        self._enqueued = 0
+        self._flushing = 0
+        self._closed = False
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        if spill_path and os.path.exists(spill_path):
+            self._load_spill()
+
+    def __str__(self) -> str:
+        return (f"{self.stats['commits']} commits, {self.stats['duplicates']} duplicates, {self.stats['cancels']} cancels | "
+                f"{self.stats['written']} records in {self.stats['batches']} writes, {len(self._queue)} pending")
+
+    def commit(self, key: Optional[Tuple], flight_id: str, passenger_name: str, travel_date: Optional[str],
+               hold_id: Optional[str] = None, route: Optional[Tuple[str, str]] = None) -> Dict:
+        """Reserves a seat once per key (None disables deduplication) and queues the record."""
+        if key is not None:
+            with self._lock:
+                result = self._results.get(key)
+                future = self._in_flight.get(key) if result is None else None
+                if result is None and future is None:
+                    self._in_flight[key] = Future()
+                else:
+                    self.stats["duplicates"] += 1
+            if result is not None or future is not None:
+                if hold_id:
+                    SEAT_INVENTORY.release(hold_id)
+                logger.info(f"Reservation key {key} already committed, returning the original")
+                return dict(result if result is not None else future.result())
+
+        try:
+            result = _reserve_seat(flight_id, passenger_name, travel_date, hold_id, route)
+        except BaseException as e:
+            if key is not None:
+                with self._lock:
+                    self._in_flight.pop(key).set_exception(e)
+            raise
+        with self._lock:
+            self.stats["commits"] += 1
+            if result["status"] == "CONFIRMED":
+                if key is not None:
+                    self._remember(key, result)
+                self._enqueue(dict(result, travel_date=travel_date, route=route))
+            future = self._in_flight.pop(key, None) if key is not None else None
+        if future is not None:
+            future.set_result(result)
+        return dict(result)
+
+    def cancel(self, pnr: str, flight_id: str, travel_date: Optional[str], route: Optional[Tuple[str, str]] = None):
+        """Returns the seat, frees the reservation's key and queues the cancellation record."""
+        SEAT_INVENTORY.cancel_sale(flight_id, travel_date or datetime.date.today().strftime("%Y-%m-%d"), route=route)
+        with self._lock:
+            key = self._keys_by_pnr.pop(pnr, None)
+            if key is not None:
+                self._results.pop(key, None)
+            self.stats["cancels"] += 1
+            self._enqueue({"status": "CANCELLED", "pnr": pnr, "flight_id": flight_id,
+                           "travel_date": travel_date, "route": route})
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every record queued so far is written. False if `timeout` passes first."""
+        with self._wakeup:
+            target = self._enqueued
+            self._flushing += 1
+            self._wakeup.notify_all()
+            try:
+                return self._wakeup.wait_for(lambda: self.stats["written"] >= target, timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout: float = RESERVATION_SHUTDOWN_SECONDS):
+        """Drains the queue for up to `timeout` seconds, then saves what is left to the spill file."""
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify_all()
+        if self.flush(timeout):
+            return
+        with self._lock:
+            remaining = list(self._queue)
+        if not self.spill_path:
+            logger.error(f"Reservation backend unavailable at shutdown: {len(remaining)} records not written")
+            return
+        with open(self.spill_path, "a") as f:
+            for record in remaining:
+                f.write(json.dumps(record) + "\n")
+        logger.error(f"Reservation backend unavailable at shutdown: {len(remaining)} records saved to {self.spill_path}")
+
+    def _remember(self, key: Tuple, result: Dict):
+        """Caller holds the lock."""
+        self._results[key] = result
+        self._keys_by_pnr[result["pnr"]] = key
+        while len(self._results) > self.max_keys:
+            _, evicted = self._results.popitem(last=False)
+            self._keys_by_pnr.pop(evicted["pnr"], None)
+
+    def _enqueue(self, record: Dict):
+        """Caller holds the lock."""
+        self._queue.append(record)
+        self._enqueued += 1
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name="reservation-writer", daemon=True)
+            self._writer.start()
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.notify_all()
+
+    def _run(self):
+        """Writer thread: writes the head of the queue in batches, in order, retrying until it succeeds."""
+        while True:
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._queue)
+                # Give a partial batch the window to fill unless someone is waiting on a flush
+                if len(self._queue) < self.batch_size and not (self._flushing or self._closed):
+                    self._wakeup.wait_for(lambda: len(self._queue) >= self.batch_size or self._flushing or self._closed,
+                                          self.window_seconds)
+                batch = list(itertools.islice(self._queue, self.batch_size))
+            self._write(batch)
+            with self._wakeup:
+                for _ in batch:
+                    self._queue.popleft()
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                self._wakeup.notify_all()
+
+    def _write(self, batch: List[Dict]):
+        attempt = 0
+        while True:
+            try:
+                self.write_fn(batch)
+                return
+            except Exception as e:
+                attempt += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                with self._lock:
+                    self.stats["write_failures"] += 1
+                logger.error(f"Reservation write of {len(batch)} records failed (attempt {attempt}), "
+                             f"retrying in {delay:.1f}s: {e!r}")
+                time.sleep(delay)
+
+    def _load_spill(self):
+        with open(self.spill_path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        os.remove(self.spill_path)
+        with self._lock:
+            for record in records:
+                if record.get("route") is not None:
+                    record["route"] = tuple(record["route"])
+                self._enqueue(record)
+        logger.info(f"Queued {len(records)} reservation records saved by a previous shutdown")
+
+RESERVATION_PIPELINE = ReservationPipeline(spill_path=RESERVATION_SPILL_PATH)
+# Queued reservation records are written (or saved) before the interpreter exits
+atexit.register(RESERVATION_PIPELINE.close)
+
+class FareCache:
+    """
+    Process-wide cache in front of a search tool, keyed on (origin, destination, date).
+    - Fresh entries are served directly.
+    - Stale entries (past the TTL but inside the stale window) are served immediately
+      while a single background refresh runs.
+    - Concurrent misses for the same key are coalesced onto one backend call.
+    """
+    def __init__(self, search_fn: Callable[[str, str, str], Dict], max_size: int = FARE_CACHE_SIZE,
+                 ttl_seconds: float = FARE_CACHE_TTL_SECONDS, stale_seconds: float = FARE_CACHE_STALE_SECONDS,
+                 stream_fn: Optional[Callable[[str, str, str], Iterator[List[Dict]]]] = None,
+                 range_fn: Optional[Callable[[str, str, List[str]], Dict[str, Dict]]] = None):
+        self.search_fn = search_fn
+        self.stream_fn = stream_fn
+        self.range_fn = range_fn
+        # Per-date fetches of a window search when the provider has no range call
+        self._executor = ThreadPoolExecutor(max_workers=FLEX_SEARCH_WORKERS, thread_name_prefix="fare-search")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.stats = HitCounter()
+        self.stale_served = 0
+        self.coalesced = 0
+        # key -> (fetched_at, result), least recently used first
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Dict]]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str, str], Future] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(origin: str, destination: str, date_str: str) -> Tuple[str, str, str]:
+        return (str(origin).strip().lower(), str(destination).strip().lower(), date_str)
+
+    def search(self, origin: str, destination: str, date_str: str) -> Dict:
+        key = self._key(origin, destination, date_str)
+        cached, future, owner = self._claim(key, origin, destination, date_str)
+        if cached is not None:
+            return cached
+        if owner:
+            self._fetch(key, origin, destination, date_str)
+        return future.result()
+
+    def search_stream(self, origin: str, destination: str, date_str: str) -> Iterator[List[Dict]]:
+        """
+        Yields fare batches as the backend produces them. Cache hits and searches
+        coalesced onto another caller's request arrive as a single batch.
+        """
+        if self.stream_fn is None:
+            yield self.search(origin, destination, date_str)["flights"]
+            return
+        key = self._key(origin, destination, date_str)
+        cached, future, owner = self._claim(key, origin, destination, date_str)
+        if cached is not None:
+            yield cached["flights"]
+            return
+        if not owner:
+            yield future.result()["flights"]
+            return
+
+        flights: List[Dict] = []
+        try:
+            for batch in self.stream_fn(origin, destination, date_str):
+                flights.extend(batch)
+                yield batch
+        except GeneratorExit:
+            # The consumer stopped early; don't cache a partial result, but release the waiters
+            self._fail(key, InventoryError(f"Search for {key} was abandoned"))
+            raise
+        except Exception as e:
+            self._fail(key, e)
+            raise
+        self._publish(key, {"flights": flights})
+
+    def search_range(self, origin: str, destination: str, dates: List[str]) -> Dict[str, Dict]:
+        """
+        Searches a window of dates on one route. Cached dates are served from the cache
+        and dates already in flight are coalesced. The rest go to the provider in a
+        single range call when it has one, otherwise they are fetched concurrently.
+        Dates whose search fails are left out of the result.
+        """
+        results: Dict[str, Dict] = {}
+        waiting: Dict[str, Future] = {}
+        owned: List[str] = []
+        for date_str in dates:
+            cached, future, owner = self._claim(self._key(origin, destination, date_str), origin, destination, date_str)
+            if cached is not None:
+                results[date_str] = cached
+                continue
+            waiting[date_str] = future
+            if owner:
+                owned.append(date_str)
+
+        if owned and self.range_fn is not None:
+            self._fetch_range(origin, destination, owned)
+        else:
+            for date_str in owned:
+                self._executor.submit(self._fetch, self._key(origin, destination, date_str), origin, destination, date_str)
+
+        for date_str, future in waiting.items():
+            try:
+                results[date_str] = future.result()
+            except Exception:
+                # Already logged by _fail; the window is served without this date
+                continue
+        return {date_str: results[date_str] for date_str in dates if date_str in results}
+
+    def _fetch_range(self, origin: str, destination: str, dates: List[str]):
+        try:
+            by_date = self.range_fn(origin, destination, dates)
+        except Exception as e:
+            for date_str in dates:
+                self._fail(self._key(origin, destination, date_str), e)
+            return
+        for date_str in dates:
+            self._publish(self._key(origin, destination, date_str), by_date.get(date_str, {"flights": []}))
+
+    def _claim(self, key: Tuple[str, str, str], origin: str, destination: str,
+               date_str: str) -> Tuple[Optional[Dict], Optional[Future], bool]:
+        """
+        Returns (result, None, False) for a fresh or stale hit, otherwise
+        (None, future, owner) where the owner must fetch and publish the result.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[0]
+                if age <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return entry[1], None, False
+                if age <= self.ttl_seconds + self.stale_seconds:
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    self.stale_served += 1
+                    if key not in self._in_flight:
+                        self._in_flight[key] = Future()
+                        threading.Thread(target=self._fetch, args=(key, origin, destination, date_str), daemon=True).start()
+                    return entry[1], None, False
+
+            self.stats.misses += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future, False
+            future = self._in_flight[key] = Future()
+            return None, future, True
+
+    def _fetch(self, key: Tuple[str, str, str], origin: str, destination: str, date_str: str):
+        """Runs the backend call and publishes the result to every waiter."""
+        try:
+            result = self.search_fn(origin, destination, date_str)
+        except Exception as e:
+            self._fail(key, e)
+            return
+        self._publish(key, result)
+
+    def _publish(self, key: Tuple[str, str, str], result: Dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            future = self._in_flight.pop(key)
+        future.set_result(result)
+
+    def _fail(self, key: Tuple[str, str, str], error: Exception):
+        logger.error(f"Fare search failed for {key}: {error}")
+        with self._lock:
+            future = self._in_flight.pop(key)
+        future.set_exception(error)
+
+    def __str__(self) -> str:
+        return f"{self.stats} | stale served: {self.stale_served} | coalesced: {self.coalesced}"
+
+# ==============================================================================
+# 4. MODEL CLIENT POOL (TRANSPORT LAYER)
+# ==============================================================================
+
+class PooledStream:
+    """
+    A streamed response that keeps its pool slot until the stream is exhausted,
+    closed or dropped. Everything else is delegated to the wrapped response.
+    """
+    def __init__(self, response, release: Callable[[], None]):
+        self._response = response
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self._response
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __del__(self):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+class PooledModel:
+    """
+    A shared GenerativeModel handle that counts against the pool's in-flight limit.
+    Everything other than the request methods is delegated to the wrapped model.
+    """
+    def __init__(self, model: genai.GenerativeModel, pool: "ModelClientPool"):
+        self._model = model
+        self._pool = pool
+
+    def generate_content(self, *args, **kwargs):
+        if not kwargs.get("stream"):
+            with self._pool.slot():
+                return self._model.generate_content(*args, **kwargs)
+        # The request is still open while chunks arrive, so the slot is held until then
+        slot = self._pool.slot()
+        slot.acquire()
+        try:
+            return PooledStream(self._model.generate_content(*args, **kwargs), slot.release)
+        except BaseException:
+            slot.release()
+            raise
+
+    async def generate_content_async(self, *args, **kwargs):
+        async with self._pool.async_slot():
+            if self._pool.transport == "rest":
+                # The REST transport has no async client; keep the event loop free instead
+                return await asyncio.to_thread(self._model.generate_content, *args, **kwargs)
+            return await self._model.generate_content_async(*args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        with self._pool.slot():
+            return self._model.count_tokens(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+class ModelClientPool:
+    """
+    Process-wide pool of model handles. The SDK keeps one client (and so one gRPC
+    HTTP/2 channel or REST keep-alive session) per process; the pool makes every
+    TravelAgentSystem reuse the same handles on top of it, caps in-flight requests
+    and can warm the connection up before the first user turn.
+    """
+    def __init__(self, max_in_flight: int = MODEL_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.transport = MODEL_TRANSPORT
+        self._models: Dict[Tuple[str, str], PooledModel] = {}
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._async_slots: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, transport: Optional[str] = MODEL_TRANSPORT, api_endpoint: Optional[str] = MODEL_API_ENDPOINT):
+        """Points the SDK's shared client at a transport/endpoint. Drops cached handles."""
+        client_options = {"api_endpoint": api_endpoint} if api_endpoint else None
+        genai.configure(api_key=API_KEY, transport=transport, client_options=client_options)
+        self.transport = transport
+        if transport == "rest":
+            self._size_rest_session()
+        with self._lock:
+            self._models.clear()
+        logger.info(f"Model pool configured (transport: {transport or 'default'}, endpoint: {api_endpoint or 'default'})")
+
+    def get(self, model_name: str = MODEL_NAME, variant: str = "default", **model_kwargs) -> PooledModel:
+        """Returns the shared handle for (model_name, variant), creating it with model_kwargs once."""
+        key = (model_name, variant)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = PooledModel(genai.GenerativeModel(model_name, **model_kwargs), self)
+            return model
+
+    def _size_rest_session(self):
+        """Grows the REST keep-alive pool to max_in_flight so concurrent calls don't drop connections."""
+        from google.generativeai import client as genai_client
+        from requests.adapters import HTTPAdapter
+        try:
+            session = genai_client.get_default_generative_client()._transport._session
+        except AttributeError:
+            logger.warning("Model pool: REST session not found, keeping default connection pool size")
+            return
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def slot(self) -> threading.BoundedSemaphore:
+        return self._slots
+
+    def async_slot(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._async_slots.get(loop)
+            if semaphore is None:
+                semaphore = self._async_slots[loop] = asyncio.Semaphore(self.max_in_flight)
+            return semaphore
+
+    def warm_up(self) -> bool:
+        """Opens the connection with a cheap countTokens call so the first turn skips TLS setup."""
+        start = time.perf_counter()
+        try:
+            self.get().count_tokens("ping")
+        except Exception as e:
+            logger.warning(f"Model pool warm-up failed: {e}")
+            return False
+        logger.info(f"Model pool warmed up in {(time.perf_counter() - start) * 1e3:.0f} ms")
+        return True
+
+MODEL_POOL = ModelClientPool()
+
+def model_request_options(timeout: float) -> Dict[str, Any]:
+    """
+    SDK options for one attempt: its timeout, and no SDK-level retry. ResilientCaller
+    already retries; an abandoned attempt left retrying inside the SDK would keep its
+    worker thread, and interpreter exit, waiting for minutes.
+    """
+    return {"timeout": timeout, "retry": None}
+
+class ModelUnavailableError(Exception):
+    """The model could not answer: breaker open, deadline passed or retries exhausted."""
+
+# Transient failures worth retrying; anything else (bad request, auth) propagates as-is.
+# Attempt timeouts are listed explicitly: they only subclass OSError from Python 3.11 on.
+RETRYABLE_MODEL_ERRORS = (OSError, FuturesTimeoutError, asyncio.TimeoutError,
+                          google_exceptions.ServerError, google_exceptions.TooManyRequests)
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls until
+    `reset_seconds` have passed, then lets a single probe call through (half-open).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold: int = MODEL_BREAKER_FAILURES, reset_seconds: float = MODEL_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state, self._probing = self.HALF_OPEN, False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state, self.failures, self._probing = self.CLOSED, 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logger.warning(f"Model circuit breaker opened after {self.failures} failures")
+                self.state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+
+    def release_probe(self):
+        """Ends a half-open probe that neither succeeded nor failed (cancelled, or a non-transient error)."""
+        with self._lock:
+            self._probing = False
+
+class RetryBudget:
+    """
+    Token bucket shared by all calls: every call deposits `ratio` tokens and every
+    retry or hedge spends one, so extra load stays near `ratio` of the traffic
+    (plus a burst) instead of multiplying during an outage.
+    """
+    def __init__(self, ratio: float = MODEL_RETRY_BUDGET_RATIO, burst: int = MODEL_RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, for the hedging threshold."""
+    def __init__(self, window: int = 200, min_samples: int = MODEL_HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: List[float] = []
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            if len(self._samples) > self._window:
+                del self._samples[0]
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+class ResilientCaller:
+    """
+    Wraps model calls with an overall deadline, per-attempt timeouts, jittered
+    exponential backoff under a shared retry budget, optional hedging (a second
+    attempt once the first outlives the p95 latency) and a circuit breaker.
+    Attempt functions receive their timeout in seconds, to forward to the SDK.
+    Raises ModelUnavailableError so callers can switch to local fallbacks.
+    """
+    def __init__(self, attempt_timeout: float = MODEL_ATTEMPT_TIMEOUT_SECONDS,
+                 deadline: float = MODEL_CALL_DEADLINE_SECONDS, max_attempts: int = MODEL_MAX_ATTEMPTS,
+                 backoff: float = MODEL_RETRY_BACKOFF_SECONDS, hedge: bool = False,
+                 breaker: Optional[CircuitBreaker] = None, budget: Optional[RetryBudget] = None):
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget or RetryBudget()
+        self.latency = LatencyTracker()
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.short_circuited = 0
+        self.fallbacks = 0
+        # Attempts that overrun their timeout keep a worker until the SDK gives up on them
+        self._executor = ThreadPoolExecutor(max_workers=MODEL_MAX_IN_FLIGHT * 2, thread_name_prefix="model-call")
+
+    def __str__(self) -> str:
+        return (f"breaker {self.breaker.state} | {self.calls} calls, {self.retries} retries, {self.hedges} hedges, "
+                f"{self.short_circuited} short-circuited, {self.fallbacks} local fallbacks")
+
+    def call(self, attempt_fn: Callable[[float], Any], hedge: Optional[bool] = None) -> Any:
+        deadline = self._admit()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = self._attempt(attempt_fn, self._timeout(deadline), self.hedge if hedge is None else hedge)
+                except RETRYABLE_MODEL_ERRORS as e:
+                    attempt += 1
+                    time.sleep(self._retry_delay(attempt, deadline, e))
+                else:
+                    self.breaker.record_success()
+                    return result
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+
+    async def call_async(self, attempt_fn: Callable[[float], Any], hedge: Optional[bool] = None) -> Any:
+        """Async counterpart of call: attempt_fn returns an awaitable."""
+        deadline = self._admit()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = await self._attempt_async(attempt_fn, self._timeout(deadline), self.hedge if hedge is None else hedge)
+                except RETRYABLE_MODEL_ERRORS as e:
+                    attempt += 1
+                    await asyncio.sleep(self._retry_delay(attempt, deadline, e))
+                else:
+                    self.breaker.record_success()
+                    return result
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+
+    def _admit(self) -> float:
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise ModelUnavailableError("circuit breaker open")
+        self.calls += 1
+        self.budget.deposit()
+        return time.monotonic() + self.deadline
+
+    def _timeout(self, deadline: float) -> float:
+        return max(0.0, min(self.attempt_timeout, deadline - time.monotonic()))
+
+    def _retry_delay(self, attempt: int, deadline: float, error: Exception) -> float:
+        """Records the failure and returns a full-jitter backoff, or raises when retrying is not allowed."""
+        self.breaker.record_failure()
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if attempt >= self.max_attempts:
+            raise ModelUnavailableError(f"{attempt} attempts failed, last: {error!r}") from error
+        if time.monotonic() + delay >= deadline:
+            raise ModelUnavailableError(f"deadline passed after {attempt} attempts, last: {error!r}") from error
+        if not self.breaker.allow():
+            raise ModelUnavailableError("circuit breaker open") from error
+        if not self.budget.withdraw():
+            raise ModelUnavailableError(f"retry budget exhausted, last: {error!r}") from error
+        self.retries += 1
+        logger.warning(f"Model call attempt {attempt} failed ({error!r}), retrying in {delay * 1e3:.0f} ms")
+        return delay
+
+    def _hedge_after(self, timeout: float, hedge: bool) -> Optional[float]:
+        if not hedge:
+            return None
+        threshold = self.latency.percentile(MODEL_HEDGE_PERCENTILE)
+        return threshold if threshold is not None and threshold < timeout else None
+
+    def _attempt(self, attempt_fn: Callable[[float], Any], timeout: float, hedge: bool) -> Any:
+        start = time.monotonic()
+        pending = {self._executor.submit(attempt_fn, timeout)}
+        hedge_after = self._hedge_after(timeout, hedge)
+        if hedge_after is not None and not wait(pending, timeout=hedge_after)[0] and self.budget.withdraw():
+            self.hedges += 1
+            pending.add(self._executor.submit(attempt_fn, timeout - hedge_after))
+
+        error: Exception = FuturesTimeoutError(f"model call exceeded {timeout:.1f}s")
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, start + timeout - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise FuturesTimeoutError(f"model call exceeded {timeout:.1f}s")
+            for future in done:
+                if future.exception() is None:
+                    self.latency.record(time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _attempt_async(self, attempt_fn: Callable[[float], Any], timeout: float, hedge: bool) -> Any:
+        start = time.monotonic()
+        pending = {asyncio.ensure_future(attempt_fn(timeout))}
+        hedge_after = self._hedge_after(timeout, hedge)
+        try:
+            if hedge_after is not None and not (await asyncio.wait(pending, timeout=hedge_after))[0] and self.budget.withdraw():
+                self.hedges += 1
+                pending.add(asyncio.ensure_future(attempt_fn(timeout - hedge_after)))
+
+            error: Exception = asyncio.TimeoutError(f"model call exceeded {timeout:.1f}s")
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, start + timeout - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError(f"model call exceeded {timeout:.1f}s")
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.record(time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The losing hedge, or an attempt past its timeout, is abandoned
+            for task in pending:
+                task.cancel()
+
+MODEL_RESILIENCE = ResilientCaller()
+
+class StubModelServer:
+    """
+    Local stand-in for the Gemini REST API, for exercising the pool offline.
+    Serves generateContent, streamGenerateContent (the reply in chunked word groups)
+    and countTokens. NLU prompts, single or batched, are answered by the rule-based
+    parser; everything else echoes the prompt's CONTEXT block. Tracks connections so
+    keep-alive reuse can be checked, and the peak number of concurrent requests.
+    Use with ModelClientPool.configure(transport="rest", api_endpoint=server.url).
+    """
+    STREAM_CHUNK_WORDS = 4
+
+    def __init__(self, port: int = 0, latency_seconds: float = 0.0):
+        stub = self
+        self.requests = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.latency_seconds = latency_seconds
+        self._parser = RuleBasedParser()
+        self._lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                stub.connections += 1
+
+            def do_POST(self):
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.peak_in_flight = max(stub.peak_in_flight, stub.in_flight)
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    prompt = "".join(part.get("text", "") for content in body.get("contents", [])
+                                     for part in content.get("parts", []))
+                    if self.path.split("?")[0].endswith(":countTokens"):
+                        self._send_json({"totalTokens": estimate_tokens(prompt)})
+                        return
+                    text = stub.reply(prompt)
+                    if not self.path.split("?")[0].endswith(":streamGenerateContent"):
+                        time.sleep(stub.latency_seconds)
+                        self._send_json(stub.candidate(text, prompt, usage_text=text))
+                        return
+                    # A JSON array of partial responses, one HTTP chunk each
+                    words = re.findall(r'\S+\s*', text)
+                    pieces = ["".join(words[i:i + stub.STREAM_CHUNK_WORDS])
+                              for i in range(0, len(words), stub.STREAM_CHUNK_WORDS)] or [""]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for i, piece in enumerate(pieces):
+                        time.sleep(stub.latency_seconds)
+                        chunk = stub.candidate(piece, prompt, usage_text=text if i == len(pieces) - 1 else None)
+                        self._send_chunk(("[" if i == 0 else ",\r\n") + json.dumps(chunk))
+                    self._send_chunk("]")
+                    self._send_chunk("")
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            def _send_json(self, payload: Dict):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_chunk(self, text: str):
+                data = text.encode()
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @staticmethod
+    def candidate(text: str, prompt: str, usage_text: Optional[str] = None) -> Dict:
+        """A GenerateContentResponse body; usage metadata is attached when usage_text is given."""
+        payload = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                   "finishReason": "STOP", "index": 0}]}
+        if usage_text is not None:
+            payload["usageMetadata"] = {"promptTokenCount": estimate_tokens(prompt),
+                                        "candidatesTokenCount": estimate_tokens(usage_text),
+                                        "totalTokenCount": estimate_tokens(prompt) + estimate_tokens(usage_text)}
+        return payload
+
+    def reply(self, prompt: str) -> str:
+        match = re.search(r'^Input: "(.*)"$', prompt, re.MULTILINE)
+        if match:
+            return json.dumps(self._parser.parse(match.group(1))[0])
+        # Batched NLU prompt: numbered inputs, answered as an array in the same order
+        batch = re.findall(r'^\d+\. "(.*)"$', prompt, re.MULTILINE)
+        if batch:
+            return json.dumps([self._parser.parse(text)[0] for text in batch])
+        return prompt.split("CONTEXT:", 1)[-1].strip()
+
+    def __enter__(self) -> "StubModelServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+# ==============================================================================
+# 5. NLU FAST PATH (RULE-BASED PARSER)
+# ==============================================================================
+
+KNOWN_AIRLINES = ("British Airways", "Air France", "Lufthansa", "KLM", "Iberia", "Emirates", "Delta", "United")
+# Routes between these skip the LLM; any other captured city goes to it at low confidence
+KNOWN_CITIES = frozenset(city.lower() for city in SYNTHETIC_CITIES)
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+MONTHS = ("january", "february", "march", "april", "may", "june", "july",
+          "august", "september", "october", "november", "december")
+
+@dataclass(frozen=True)
+class DateRange:
+    """A resolved date expression; single days have start == end."""
+    start: datetime.date
+    end: datetime.date
+
+    def days(self) -> List[datetime.date]:
+        return [self.start + datetime.timedelta(days=i) for i in range((self.end - self.start).days + 1)]
+
+def _easter(year: int) -> datetime.date:
+    """Gregorian Easter Sunday (anonymous Gregorian algorithm)."""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> datetime.date:
+    """n-th given weekday of a month (n = -1 for the last one)."""
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+# Holiday name -> date in a given year; the next occurrence on or after the reference date is used
+HOLIDAYS: Dict[str, Callable[[int], datetime.date]] = {
+    "new year's day": lambda y: datetime.date(y, 1, 1),
+    "valentine's day": lambda y: datetime.date(y, 2, 14),
+    "good friday": lambda y: _easter(y) - datetime.timedelta(days=2),
+    "easter": _easter,
+    "easter monday": lambda y: _easter(y) + datetime.timedelta(days=1),
+    "memorial day": lambda y: _nth_weekday(y, 5, 0, -1),
+    "independence day": lambda y: datetime.date(y, 7, 4),
+    "labor day": lambda y: _nth_weekday(y, 9, 0, 1),
+    "halloween": lambda y: datetime.date(y, 10, 31),
+    "thanksgiving": lambda y: _nth_weekday(y, 11, 3, 4),
+    "christmas eve": lambda y: datetime.date(y, 12, 24),
+    "christmas": lambda y: datetime.date(y, 12, 25),
+    "boxing day": lambda y: datetime.date(y, 12, 26),
+    "new year's eve": lambda y: datetime.date(y, 12, 31),
+}
+HOLIDAY_ALIASES = {
+    "new year": "new year's day", "new years": "new year's day", "new years day": "new year's day",
+    "new years eve": "new year's eve", "valentines": "valentine's day", "valentines day": "valentine's day",
+    "valentine's": "valentine's day", "easter sunday": "easter", "christmas day": "christmas", "xmas": "christmas",
+    "fourth of july": "independence day", "4th of july": "independence day", "july 4th": "independence day",
+    "labour day": "labor day", "thanksgiving day": "thanksgiving",
+}
+
+class DateResolver:
+    """
+    Deterministic grammar for travel date expressions, compiled once:
+    relative days ("today", "day after tomorrow"), offsets ("in 3 days",
+    "two weeks from today"), weekdays ("friday", "this friday", "next monday"),
+    periods ("this weekend", "next week", "next month"), explicit dates
+    ("2026-10-20", "20/10", "20 October", "Oct 20th, 2027", "the 20th") and
+    holidays. Bare weekdays mean the coming one (today included); "next <weekday>"
+    means that day in the following Monday-Sunday week. Dates without a year roll
+    over to next year once they have passed, and "the 30th" means the next month
+    that has a 30th. Dotted numbers are clock times ("leaving at 10.30") unless
+    they carry a year or follow "on"/"for". Results are memoized per
+    (phrase, reference date).
+    """
+    _NUMBER_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+                     "seven": 7, "eight": 8, "nine": 9, "ten": 10, "couple of": 2, "a couple of": 2}
+    _NUMBER = r'\d{1,3}|a couple of|couple of|an?|one|two|three|four|five|six|seven|eight|nine|ten'
+    _WEEKDAY = '|'.join(WEEKDAYS)
+    _MONTH = '|'.join(f"{m[:3]}(?:{m[3:]})?" for m in MONTHS) + r'|sept'
+    _HOLIDAY = '|'.join(re.escape(h).replace("'", "'?") for h in
+                        sorted(set(HOLIDAYS) | set(HOLIDAY_ALIASES), key=len, reverse=True))
+    _ORDINAL = r'(?:st|nd|rd|th)?'
+    # Apostrophe-free spelling -> HOLIDAYS key
+    _HOLIDAY_NAMES = {**{h.replace("'", ""): h for h in HOLIDAYS},
+                      **{a.replace("'", ""): h for a, h in HOLIDAY_ALIASES.items()}}
+
+    PATTERN = re.compile(
+        r'\b(?:'
+        r'(?P<relative>day after tomorrow|today|tonight|tomorrow)'
+        r'|(?P<offset>in\s+(?P<n>' + _NUMBER + r')\s+(?P<unit>days?|weeks?)'
+        r'|(?P<n2>' + _NUMBER + r')\s+(?P<unit2>days?|weeks?)\s+from\s+(?:now|today))'
+        r'|(?P<holiday>' + _HOLIDAY + r')'
+        r'|(?P<period>(?P<pmod>this|next|coming)\s+(?P<pspan>weekend|week|month))'
+        r'|(?P<weekday>(?:(?P<wmod>this|next|coming)\s+)?(?P<wday>' + _WEEKDAY + r'))'
+        r'|(?P<iso>(?P<iy>\d{4})-(?P<im>\d{1,2})-(?P<id>\d{1,2}))'
+        r'|(?P<numeric>(?:(?P<nctx>on|for)\s+)?(?P<a>\d{1,2})(?P<sep>[/.])(?P<b>\d{1,2})(?:[/.](?P<ny>\d{4}|\d{2}))?)'
+        r'|(?P<day_month>(?P<dm_day>\d{1,2})' + _ORDINAL + r'\s+(?:of\s+)?(?P<dm_month>' + _MONTH + r')\b(?:,?\s+(?P<dm_year>\d{4}))?)'
+        r'|(?P<month_day>(?P<md_month>' + _MONTH + r')\s+(?:the\s+)?(?P<md_day>\d{1,2})' + _ORDINAL + r'\b(?:,?\s+(?P<md_year>\d{4}))?)'
+        r'|(?P<day_only>the\s+(?P<do_day>\d{1,2})(?:st|nd|rd|th))'
+        r')(?![\w/.-]\d)',
+        re.IGNORECASE
+    )
+
+    def __init__(self, cache_size: int = DATE_CACHE_SIZE):
+        self._resolve_cached = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def resolve(self, phrase: Optional[str], today: Optional[datetime.date] = None) -> Optional[DateRange]:
+        """Resolves the first date expression in `phrase`; None when there is none."""
+        if not phrase:
+            return None
+        return self._resolve_cached(" ".join(phrase.lower().split()), today or datetime.date.today())
+
+    @classmethod
+    def find(cls, text: str) -> Optional[re.Match]:
+        """The first date expression in `text`, skipping clock times such as "at 10.30"."""
+        return next((m for m in cls.PATTERN.finditer(text)
+                     if not (m.group("sep") == "." and not m.group("ny") and not m.group("nctx"))), None)
+
+    def _resolve(self, phrase: str, today: datetime.date) -> Optional[DateRange]:
+        match = self.find(phrase)
+        if match is None:
+            return None
+        kind = next(name for name in ("relative", "offset", "holiday", "period", "weekday", "iso",
+                                      "numeric", "day_month", "month_day", "day_only") if match.group(name))
+        try:
+            result = getattr(self, f"_{kind}")(match, today)
+        except ValueError:
+            # Impossible calendar dates such as 31/02
+            return None
+        return result if isinstance(result, DateRange) else DateRange(result, result)
+
+    def _relative(self, m, today: datetime.date) -> datetime.date:
+        word = m.group("relative")
+        return today + datetime.timedelta(days={"tomorrow": 1, "day after tomorrow": 2}.get(word, 0))
+
+    def _offset(self, m, today: datetime.date) -> datetime.date:
+        n, unit = (m.group("n"), m.group("unit")) if m.group("n") else (m.group("n2"), m.group("unit2"))
+        count = int(n) if n.isdigit() else self._NUMBER_WORDS[n]
+        return today + datetime.timedelta(days=count * (7 if unit.startswith("week") else 1))
+
+    def _holiday(self, m, today: datetime.date) -> datetime.date:
+        name = self._HOLIDAY_NAMES[m.group("holiday").replace("'", "")]
+        day = HOLIDAYS[name](today.year)
+        return day if day >= today else HOLIDAYS[name](today.year + 1)
+
+    def _period(self, m, today: datetime.date) -> DateRange:
+        modifier, span = m.group("pmod"), m.group("pspan")
+        if span == "month":
+            if modifier == "this":
+                start = today
+            else:
+                start = datetime.date(today.year + today.month // 12, today.month % 12 + 1, 1)
+            end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1) - datetime.timedelta(days=1)
+            return DateRange(start, end)
+        monday = today - datetime.timedelta(days=today.weekday())
+        if modifier == "next" or (modifier == "coming" and span == "week"):
+            monday += datetime.timedelta(days=7)
+        if span == "week":
+            return DateRange(max(monday, today), monday + datetime.timedelta(days=6))
+        saturday = monday + datetime.timedelta(days=5)
+        return DateRange(max(saturday, today), saturday + datetime.timedelta(days=1))
+
+    def _weekday(self, m, today: datetime.date) -> datetime.date:
+        target = WEEKDAYS.index(m.group("wday"))
+        ahead = (target - today.weekday()) % 7
+        if m.group("wmod") == "next":
+            # The named day in next week's Monday-Sunday span
+            return today - datetime.timedelta(days=today.weekday()) + datetime.timedelta(days=7 + target)
+        return today + datetime.timedelta(days=ahead)
+
+    def _iso(self, m, today: datetime.date) -> datetime.date:
+        return datetime.date(int(m.group("iy")), int(m.group("im")), int(m.group("id")))
+
+    def _numeric(self, m, today: datetime.date) -> datetime.date:
+        a, b = int(m.group("a")), int(m.group("b"))
+        day, month = (a, b) if DATE_DAY_FIRST else (b, a)
+        if month > 12 >= day:
+            day, month = month, day
+        year = m.group("ny")
+        return self._with_year(today, month, day, (2000 + int(year) if len(year) == 2 else int(year)) if year else None)
+
+    def _day_month(self, m, today: datetime.date) -> datetime.date:
+        return self._with_year(today, self._month(m.group("dm_month")), int(m.group("dm_day")),
+                               int(m.group("dm_year")) if m.group("dm_year") else None)
+
+    def _month_day(self, m, today: datetime.date) -> datetime.date:
+        return self._with_year(today, self._month(m.group("md_month")), int(m.group("md_day")),
+                               int(m.group("md_year")) if m.group("md_year") else None)
+
+    def _day_only(self, m, today: datetime.date) -> datetime.date:
+        day = int(m.group("do_day"))
+        year, month = today.year, today.month
+        if day < today.day:
+            year, month = year + month // 12, month % 12 + 1
+        # Skip months without that day ("the 30th" asked on Jan 31 is March 30)
+        for _ in range(12):
+            if day <= monthrange(year, month)[1]:
+                return datetime.date(year, month, day)
+            year, month = year + month // 12, month % 12 + 1
+        raise ValueError(f"No month has a day {day}")
+
+    @staticmethod
+    def _month(name: str) -> int:
+        return next(i for i, m in enumerate(MONTHS, 1) if m.startswith(name[:3]))
+
+    @staticmethod
+    def _with_year(today: datetime.date, month: int, day: int, year: Optional[int]) -> datetime.date:
+        if year is not None:
+            return datetime.date(year, month, day)
+        candidate = datetime.date(today.year, month, day)
+        return candidate if candidate >= today else datetime.date(today.year + 1, month, day)
+
+DATE_RESOLVER = DateResolver()
+
+class RuleBasedParser:
+    """
+    Deterministic pre-parser for formulaic utterances.
+    Fills the same JSON schema as the LLM extractor and reports a confidence score,
+    so the orchestrator only pays for a model call when the grammar is unsure.
+    """
+    _BOOK_RE = re.compile(r'\b(?:book|reserve)\b', re.IGNORECASE)
+    _CANCEL_RE = re.compile(r'\bcancel\b', re.IGNORECASE)
+    _REBOOK_VERB = r'(?:rebook|switch\s+(?:it\s+|me\s+)?to|change\s+(?:it|my\s+booking|the\s+booking)\s+to)'
+    _REBOOK_RE = re.compile(r'\b' + _REBOOK_VERB + r'\b', re.IGNORECASE)
+    _INSTEAD_RE = re.compile(r'\binstead\b', re.IGNORECASE)
+    _SEARCH_VERB_RE = re.compile(r'\b(?:find|search|show|look(?:ing)? for)\b', re.IGNORECASE)
+    _PNR_RE = re.compile(r'\b(?P<pnr>PNR[A-Z0-9]{6})\b', re.IGNORECASE)
+    _SEARCH_RE = re.compile(r'\b(?:find|search|show|look(?:ing)? for|flights?|fly)\b', re.IGNORECASE)
+    _ROUTE_RE = re.compile(
+        r'\bfrom\s+(?P<origin>[a-z][a-z .\'-]*?)\s+to\s+(?P<dest>[a-z][a-z .\'-]*?)'
+        r'(?=\s+(?:for|on|at|in|by|with|and|via|around|after|before|please|departing|leaving|returning|arriving|'
+        r'flying|next|this|coming|the|day|tomorrow|today|tonight|' + '|'.join(WEEKDAYS) + r')\b|\s*[.,!?]|\s*$)',
+        re.IGNORECASE
+    )
+    # Date phrases are whatever the DateResolver grammar can resolve
+    _PASSENGER_RE = re.compile(r'\bfor\s+(?P<name>[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)\b')
+    _FLIGHT_ID_RE = re.compile(r'\b(?P<fid>[A-Z]{2}-\d{3,4})\b', re.IGNORECASE)
+    _AIRLINE_RE = re.compile(r'\b(?P<airline>' + '|'.join(re.escape(a) for a in KNOWN_AIRLINES) + r')\b', re.IGNORECASE)
+    _CHEAPEST_RE = re.compile(r'\b(?:cheapest|lowest price|least expensive)\b', re.IGNORECASE)
+    # The booking target is the phrase after the book/switch verb, and for cancellations after "cancel"
+    _TARGET_PHRASE_RE = re.compile(r'\b(?:book|reserve|' + _REBOOK_VERB + r')\s+(?:me\s+)?(?:on\s+|onto\s+)?'
+                                   r'(?P<target>.+?)(?=\s+for\s+[A-Z]|\s+instead\b|[.!?]|$)', re.IGNORECASE)
+    _CANCEL_PHRASE_RE = re.compile(r'\bcancel\s+(?P<target>.+?)(?=\s+for\s+[A-Z]|\s+and\b|[.!?,]|$)', re.IGNORECASE)
+    _NOT_NAMES = {d.title() for d in WEEKDAYS + MONTHS} | {"Today", "Tomorrow", "Tonight"} | \
+        {word.title() for name in list(HOLIDAYS) + list(HOLIDAY_ALIASES) for word in name.replace("'s", "s").split()[:1]}
+
+    def __init__(self):
+        self._airline_lookup = {a.lower(): a for a in KNOWN_AIRLINES}
+        # Typos and codes of the known airlines ("Lufthanza", "LH") resolve locally too
+        self._airline_resolver = AirlineResolver(dict.fromkeys(KNOWN_AIRLINES, ""))
+
+    def parse(self, user_input: str) -> Tuple[Dict[str, Any], float]:
+        """Returns (nlu_data, confidence). Confidence 0.0 means 'no idea, ask the LLM'."""
+        data: Dict[str, Any] = {
+            "intent": "GENERAL",
+            "origin": None,
+            "destination": None,
+            "date_reference": None,
+            "booking_target": None,
+            "passenger": "Guest"
+        }
+
+        date_match = DateResolver.find(user_input)
+        if date_match:
+            data["date_reference"] = date_match.group(0).lower()
+
+        passenger_match = self._PASSENGER_RE.search(user_input)
+        if passenger_match and passenger_match.group("name").split()[0] not in self._NOT_NAMES:
+            data["passenger"] = passenger_match.group("name")
+
+        cancel = self._CANCEL_RE.search(user_input)
+        book = self._BOOK_RE.search(user_input)
+        rebook = self._REBOOK_RE.search(user_input)
+        if book or rebook:
+            # "Cancel that, book the cheapest instead" replaces the last booking; "instead" without
+            # a book verb ("show me Lufthansa flights instead") is a new search, not a rebooking
+            data["intent"] = "REBOOK" if rebook or cancel or self._INSTEAD_RE.search(user_input) else "BOOK"
+            data["booking_target"] = self._match_booking_target(user_input)
+            # Search words or a route next to a book verb ("book a flight from London to Rome") are ambiguous
+            searching = self._SEARCH_VERB_RE.search(user_input) or self._ROUTE_RE.search(user_input)
+            if data["booking_target"] and not searching:
+                return data, 0.9
+            # Without a resolvable target (e.g. "book a trip to Rome") the LLM decides, but the raw
+            # phrase is kept for entity resolution if the model is unavailable
+            data["booking_target"] = data["booking_target"] or self._raw_booking_target(user_input)
+            return data, 0.3
+
+        if cancel:
+            data["intent"] = "CANCEL"
+            pnr_match = self._PNR_RE.search(user_input)
+            data["booking_target"] = pnr_match.group("pnr").upper() if pnr_match else \
+                self._match_booking_target(user_input, self._CANCEL_PHRASE_RE)
+            return data, 0.9
+
+        route_match = self._ROUTE_RE.search(user_input)
+        if route_match:
+            data["intent"] = "SEARCH"
+            data["origin"] = route_match.group("origin").strip().title()
+            data["destination"] = route_match.group("dest").strip().title()
+            known = data["origin"].lower() in KNOWN_CITIES and data["destination"].lower() in KNOWN_CITIES
+            return data, (0.9 if known else 0.5)
+
+        if self._SEARCH_RE.search(user_input):
+            data["intent"] = "SEARCH"
+            return data, 0.4
+
+        return data, 0.0
+
+    def extract_slots(self, user_input: str) -> Dict[str, str]:
+        """Returns the free-text entities (cities, passenger) found in the input."""
+        slots: Dict[str, str] = {}
+        route_match = self._ROUTE_RE.search(user_input)
+        if route_match:
+            slots["origin"] = route_match.group("origin").strip().title()
+            slots["destination"] = route_match.group("dest").strip().title()
+        passenger_match = self._PASSENGER_RE.search(user_input)
+        if passenger_match and passenger_match.group("name").split()[0] not in self._NOT_NAMES:
+            slots["passenger"] = passenger_match.group("name")
+        return slots
+
+    def _match_booking_target(self, user_input: str, phrase_re: Optional[re.Pattern] = None) -> Optional[str]:
+        # Only the phrase after the verb names the target: in "cancel the Air France booking and
+        # book Lufthansa instead" it is Lufthansa
+        phrase_match = (phrase_re or self._TARGET_PHRASE_RE).search(user_input)
+        scope = phrase_match.group("target") if phrase_match else user_input
+        # Ranked/filtered references ("the earliest one after 6pm") pass through as a phrase
+        if phrase_match and FlightQuery.QUALIFIER_RE.search(scope):
+            return scope.strip()
+        if self._CHEAPEST_RE.search(scope):
+            return "cheapest"
+        airline_match = self._AIRLINE_RE.search(scope)
+        if airline_match:
+            return self._airline_lookup[airline_match.group("airline").lower()]
+        fid_match = self._FLIGHT_ID_RE.search(scope)
+        if fid_match:
+            return fid_match.group("fid").upper()
+        candidates = self._airline_resolver.resolve(self._raw_booking_target(user_input, phrase_re) or "", limit=1)
+        if candidates:
+            return candidates[0][0]
+        return None
+
+    def _raw_booking_target(self, user_input: str, phrase_re: Optional[re.Pattern] = None) -> Optional[str]:
+        """The booking phrase minus filler words ("the Lufthanza one" -> "lufthanza"), unresolved."""
+        phrase_match = (phrase_re or self._TARGET_PHRASE_RE).search(user_input)
+        return FlightQuery.residue(phrase_match.group("target")) or None if phrase_match else None
+
+class NLUParseError(ValueError):
+    """Model output held no JSON value that passed validation."""
+
+NLU_INTENTS = ("SEARCH", "BOOK", "CANCEL", "REBOOK", "GENERAL")
+NLU_SLOT_FIELDS = ("origin", "destination", "date_reference", "booking_target")
+
+def validate_nlu_result(value: Any) -> Dict[str, Any]:
+    """
+    Checks an extracted object against the NLU schema and normalizes it:
+    intent upper-cased, blank slots to None, passenger defaulting to "Guest",
+    unknown keys dropped. Raises NLUParseError when it does not fit.
+    """
+    if not isinstance(value, dict):
+        raise NLUParseError(f"expected an object, got {type(value).__name__}")
+    intent = value.get("intent")
+    if not isinstance(intent, str) or intent.strip().upper() not in NLU_INTENTS:
+        raise NLUParseError(f"invalid intent {intent!r}")
+    result: Dict[str, Any] = {"intent": intent.strip().upper()}
+    for field in NLU_SLOT_FIELDS + ("passenger",):
+        slot = value.get(field)
+        if slot is not None and not isinstance(slot, str):
+            raise NLUParseError(f"{field} must be a string or null, got {type(slot).__name__}")
+        result[field] = slot.strip() or None if slot else None
+    result["passenger"] = result["passenger"] or "Guest"
+    return result
+
+def validate_nlu_batch(value: Any, size: int) -> List[Dict[str, Any]]:
+    if not isinstance(value, list) or len(value) != size:
+        raise NLUParseError(f"expected a JSON array of {size} objects")
+    return [validate_nlu_result(item) for item in value]
+
+class JSONExtractor:
+    """
+    Incremental scanner for the first valid JSON value in model output.
+    Text can be fed in chunks (e.g. from a stream); chatter, markdown fences and
+    candidates that fail `validate` are skipped. Brackets inside strings are
+    tracked so only balanced spans are handed to json.loads.
+    """
+    def __init__(self, validate: Callable[[Any], Any] = lambda value: value, opening: str = "{["):
+        self.validate = validate
+        self.opening = opening
+        self.result: Any = None
+        self.done = False
+        self._buffer = ""
+        self._pos = 0
+        self._start: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> Optional[Any]:
+        """Adds text; returns the validated value once one is complete, else None."""
+        if self.done:
+            return self.result
+        self._buffer += chunk
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+            self._pos += 1
+            if self._start is None:
+                if ch in self.opening:
+                    self._start, self._depth = self._pos - 1, 1
+                continue
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0 and self._try_candidate(self._buffer[self._start:self._pos]):
+                    return self.result
+        return None
+
+    def _try_candidate(self, span: str) -> bool:
+        try:
+            self.result = self.validate(json.loads(span))
+            self.done = True
+            return True
+        except ValueError:
+            # Not this span: rescan from just after its opening bracket for a nested candidate
+            self._pos, self._start, self._in_string, self._escaped = self._start + 1, None, False, False
+            return False
+
+def extract_json(text: str, validate: Callable[[Any], Any] = lambda value: value, opening: str = "{[") -> Any:
+    """First JSON value in `text` that passes `validate`. Raises NLUParseError if there is none."""
+    extractor = JSONExtractor(validate, opening)
+    if extractor.feed(text) is None and not extractor.done:
+        raise NLUParseError(f"no valid JSON value in model output: {text[:80]!r}")
+    return extractor.result
+
+class NLUCache:
+    """
+    LRU + TTL cache of LLM extraction results, keyed on a normalized form of the input.
+    City and passenger names are templated out of both the key and the stored result,
+    so "flights from London to Paris" and "Flights from Rome to Oslo!" share one entry.
+    Results whose slots disagree with the templated names are not cached.
+    An optional SQLite file backs the in-memory LRU so entries survive restarts.
+    """
+    _SLOT_KEYS = ("origin", "destination", "passenger")
+    _PUNCT_RE = re.compile(r"[^\w{}\s]")
+    _SPACE_RE = re.compile(r"\s+")
+
+    def __init__(self, parser: RuleBasedParser, max_size: int = NLU_CACHE_SIZE,
+                 ttl_seconds: float = NLU_CACHE_TTL_SECONDS, db_path: Optional[str] = NLU_CACHE_DB_PATH):
+        self.parser = parser
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stats = HitCounter()
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS nlu_cache (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            self._db.commit()
+
+    def _normalize(self, user_input: str, slots: Dict[str, str]) -> str:
+        text = user_input
+        for slot, value in slots.items():
+            text = re.sub(re.escape(value), "{" + slot + "}", text, flags=re.IGNORECASE)
+        text = self._PUNCT_RE.sub(" ", text.lower())
+        return self._SPACE_RE.sub(" ", text).strip()
+
+    def get(self, user_input: str) -> Optional[Dict[str, Any]]:
+        slots = self.parser.extract_slots(user_input)
+        key = self._normalize(user_input, slots)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                entry = self._load(key, now)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+
+        # Re-insert this utterance's names into the templated result
+        result = dict(entry[1])
+        for slot in self._SLOT_KEYS:
+            if result.get(slot) == "{" + slot + "}":
+                result[slot] = slots[slot]
+        return result
+
+    def put(self, user_input: str, nlu_data: Dict[str, Any]):
+        slots = self.parser.extract_slots(user_input)
+        key = self._normalize(user_input, slots)
+        templated = dict(nlu_data)
+        for slot, value in slots.items():
+            if not (isinstance(templated.get(slot), str) and templated[slot].lower() == value.lower()):
+                # The key generalizes this slot, so a literal value would leak into other utterances
+                logger.info(f"NLU cache skip: model {slot} {templated.get(slot)!r} differs from {value!r}")
+                return
+            templated[slot] = "{" + slot + "}"
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), templated)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO nlu_cache (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(templated), time.time())
+                )
+                self._db.commit()
+
+    def _load(self, key: str, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """Reads through to the SQLite backend. Caller holds the lock."""
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT value, created FROM nlu_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[1]
+        if age > self.ttl_seconds:
+            self._db.execute("DELETE FROM nlu_cache WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+        # Translate wall-clock age into the monotonic clock used by the LRU
+        return (now - age, json.loads(row[0]))
+
+class NLUBatcher:
+    """
+    Collects LLM extraction requests from concurrent sessions for up to a short
+    window (or until the batch is full) and sends them as one prompt that returns
+    a JSON array. Each caller gets a Future for its own entry.
+    """
+    def __init__(self, call_model: Callable[[str], str], build_prompt: Callable[[List[str]], str],
+                 window_seconds: float = NLU_BATCH_WINDOW_SECONDS, max_batch: int = NLU_BATCH_MAX_SIZE):
+        self.call_model = call_model
+        self.build_prompt = build_prompt
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self._pending: List[Tuple[str, Future]] = []
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def submit(self, user_input: str) -> Future:
+        future: Future = Future()
+        with self._lock:
+            self._pending.append((user_input, future))
+            self.requests += 1
+            if len(self._pending) >= self.max_batch:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window_seconds, self._flush_on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            # A full batch is sent on a worker thread so the submitter isn't charged the call
+            threading.Thread(target=self._send, args=(batch,), daemon=True).start()
+        return future
+
+    def extract(self, user_input: str) -> Dict[str, Any]:
+        return self.submit(user_input).result()
+
+    def _take_batch(self) -> List[Tuple[str, Future]]:
+        """Caller holds the lock."""
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+            batch, self._pending = self._pending, []
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch: List[Tuple[str, Future]]):
+        self.batches += 1
+        try:
+            text = self.call_model(self.build_prompt([user_input for user_input, _ in batch]))
+            results = extract_json(text, lambda value: validate_nlu_batch(value, len(batch)), opening="[")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        logger.info(f"NLU batch of {len(batch)} extracted in one call ({self.requests} requests / {self.batches} batches)")
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+# ==============================================================================
+# 6. NLG TEMPLATES (DETERMINISTIC RESPONSES)
+# ==============================================================================
+
+class TemplateRenderer:
+    """
+    Renders transactional messages locally.
+    Search results and booking confirmations are fully determined by tool output,
+    so rewording them through the LLM adds latency without adding information.
+    """
+    def render_search(self, origin: str, dest: str, travel_date: str, flights: List[FlightRecord]) -> str:
+        if not flights:
+            return f"No flights found from {origin} to {dest} on {self._format_date(travel_date)}."
+        lines = [f"Here are the flight options from {origin} to {dest} on {self._format_date(travel_date)}:", ""]
+        lines += [f"*   **{f.airline} ({f.flight_id}):** {f.raw_price} at {f.departure}" for f in flights]
+        return "\n".join(lines)
+
+    def render_search_preview(self, origin: str, dest: str, travel_date: str, flights: List[FlightRecord]) -> str:
+        """First chunk of a streamed search: the best fares received so far."""
+        lines = [f"Here are the best options so far from {origin} to {dest} on {self._format_date(travel_date)}:", ""]
+        lines += [f"*   **{f.airline} ({f.flight_id}):** {f.raw_price} at {f.departure}" for f in flights]
+        return "\n".join(lines)
+
+    def render_price_calendar(self, calendar: PriceCalendar, best: List[FlightRecord]) -> str:
+        """Flexible-date search: cheapest fare per day, then the best options on the cheapest day."""
+        if calendar.best_date is None:
+            return (f"No flights found from {calendar.origin} to {calendar.destination} between "
+                    f"{self._format_date(calendar.dates[0])} and {self._format_date(calendar.dates[-1])}.")
+        lines = [f"Cheapest fares from {calendar.origin} to {calendar.destination}, "
+                 f"{self._format_date(calendar.dates[0])} to {self._format_date(calendar.dates[-1])}:", ""]
+        for i, date_str in enumerate(calendar.dates):
+            day = datetime.datetime.strptime(date_str, "%Y-%m-%d").strftime("%a %b %d")
+            fare = calendar.best_fares[i]
+            if fare is None:
+                lines.append(f"*   {day}: no flights")
+            else:
+                marker = "  <- cheapest" if date_str == calendar.best_date else ""
+                lines.append(f"*   {day}: from {fare['price']} ({fare['airline']} {fare['flight_id']}), "
+                             f"{calendar.options[i]} options{marker}")
+        lines += ["", f"Best options on {self._format_date(calendar.best_date)}:", ""]
+        lines += [f"*   **{f.airline} ({f.flight_id}):** {f.raw_price} at {f.departure}" for f in best]
+        return "\n".join(lines)
+
+    def render_search_complete(self, total: int, flights: Optional[List[FlightRecord]]) -> str:
+        """Closing chunk of a streamed search. `flights` is None when the preview is still the best."""
+        if flights is None:
+            return f"\n\nSearch complete: {total} options found, and the fares above are still the best."
+        lines = [f"\n\nSearch complete: {total} options found. Updated best fares:", ""]
+        lines += [f"*   **{f.airline} ({f.flight_id}):** {f.raw_price} at {f.departure}" for f in flights]
+        return "\n".join(lines)
+
+    def render_booking(self, flight_record: FlightRecord, booking_result: Dict) -> str:
+        return (
+            f"Your booking is confirmed.\n"
+            f"Airline: {flight_record.airline}\n"
+            f"Flight ID: {booking_result['flight_id']}\n"
+            f"Passenger: {booking_result['passenger']}\n"
+            f"PNR: {booking_result['pnr']}\n"
+            f"Status: {booking_result['status']}"
+        )
+
+    def render_cancellation(self, booking: Booking) -> str:
+        return (
+            f"Your booking has been cancelled.\n"
+            f"Airline: {booking.airline}\n"
+            f"Flight ID: {booking.flight_id}\n"
+            f"Passenger: {booking.passenger}\n"
+            f"PNR: {booking.pnr}\n"
+            f"Status: CANCELLED"
+        )
+
+    def render_rebooking(self, flight_record: FlightRecord, booking_result: Dict, previous: Booking) -> str:
+        return (
+            f"Your booking has been changed.\n"
+            f"Airline: {flight_record.airline}\n"
+            f"Flight ID: {booking_result['flight_id']}\n"
+            f"Passenger: {booking_result['passenger']}\n"
+            f"PNR: {booking_result['pnr']}\n"
+            f"Status: {booking_result['status']}\n"
+            f"Replaces: {previous.pnr} ({previous.airline} {previous.flight_id}), now cancelled"
+        )
+
+    @staticmethod
+    def _format_date(date_str: str) -> str:
+        try:
+            d = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+        except ValueError:
+            return date_str
+        return f"{d.strftime('%B')} {d.day}, {d.year}"
+
+# ==============================================================================
+# 7. ORCHESTRATOR (CONTROLLER LOGIC - AGENTIC DECISION ENGINE)
+# ==============================================================================
+
+def _compile_prompt(template: str) -> str:
+    """Dedents a prompt template and drops blank lines so no padding is sent per call."""
+    lines = textwrap.dedent(template).strip().splitlines()
+    return "\n".join(line.rstrip() for line in lines if line.strip())
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (~4 characters per token) for budgeting before a call."""
+    return (len(text) + 3) // 4
+
+# Compiled once at import; placeholders are filled with str.format per call
+_NLU_SCHEMA = """
+    Keys:
+    intent: "SEARCH"|"BOOK"|"CANCEL"|"REBOOK"|"GENERAL" (REBOOK = replace the last booking, e.g. "book X instead")
+    origin, destination: city or null
+    date_reference: date phrase as said (e.g. "tomorrow") or null
+    booking_target: airline, flight ID or ranking (e.g. "cheapest") to book; PNR, airline or flight ID to cancel; else null
+    passenger: name or "Guest"
+    Return ONLY JSON.
+"""
+NLU_PROMPT = _compile_prompt("""
+    Extract a JSON object from the user input.
+    Input: "{user_input}"
+""" + _NLU_SCHEMA)
+NLU_BATCH_PROMPT = _compile_prompt("""
+    Extract one JSON object per numbered input; return a JSON array in the same order.
+    {numbered_inputs}
+""" + _NLU_SCHEMA)
+# Schema-constrained decoding for the NLU calls; replies are still validated locally
+NLU_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": list(NLU_INTENTS)},
+        "origin": {"type": "string", "nullable": True},
+        "destination": {"type": "string", "nullable": True},
+        "date_reference": {"type": "string", "nullable": True},
+        "booking_target": {"type": "string", "nullable": True},
+        "passenger": {"type": "string"}
+    },
+    "required": ["intent", "passenger"]
+}
+NLU_GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": NLU_RESPONSE_SCHEMA}
+NLU_BATCH_GENERATION_CONFIG = {"response_mime_type": "application/json",
+                               "response_schema": {"type": "array", "items": NLU_RESPONSE_SCHEMA}}
+NLG_PROMPT = _compile_prompt("""
+    You are a professional corporate travel assistant. Write a concise reply to the user
+    using only facts from CONTEXT.
+    CONTEXT:
+    {context}
+""")
+
+AGENT_TOOLS = [{"function_declarations": [
+    {
+        "name": "search_flights",
+        "description": "Search available flights between two cities.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "origin": {"type": "string", "description": "Departure city"},
+                "destination": {"type": "string", "description": "Arrival city"},
+                "date_reference": {"type": "string", "description": "Date as the user said it, e.g. 'tomorrow'", "nullable": True}
+            },
+            "required": ["origin", "destination"]
+        }
+    },
+    {
+        "name": "book_flight",
+        "description": "Book one of the flights from the most recent search.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "booking_target": {"type": "string", "description": "Airline name, flight ID, or a ranking such as 'cheapest'"},
+                "passenger": {"type": "string", "description": "Passenger name, or 'Guest'"}
+            },
+            "required": ["booking_target"]
+        }
+    },
+    {
+        "name": "rebook_flight",
+        "description": "Replace the passenger's last booking with another flight from the most recent search.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "booking_target": {"type": "string", "description": "Airline name, flight ID, or a ranking such as 'cheapest'"},
+                "passenger": {"type": "string", "description": "Passenger name, or 'Guest'"}
+            },
+            "required": ["booking_target"]
+        }
+    },
+    {
+        "name": "cancel_booking",
+        "description": "Cancel a booking made in this conversation.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "booking_target": {"type": "string", "description": "PNR, airline or flight ID of the booking; omit for the latest", "nullable": True},
+                "passenger": {"type": "string", "description": "Passenger name, or 'Guest'"}
+            }
+        }
+    }
+]}]
+TOOL_INTENTS = {"search_flights": "SEARCH", "book_flight": "BOOK", "rebook_flight": "REBOOK", "cancel_booking": "CANCEL"}
+
+COMBINED_SYSTEM_INSTRUCTION = (
+    "You are a professional corporate travel assistant. Use search_flights to find flights, book_flight "
+    "to book one from the last search, rebook_flight to replace a booking and cancel_booking to cancel one. Never invent flights, prices or PNRs; only report tool results. "
+    "If the request is unclear or unrelated to flights, reply briefly without calling a tool."
+)
+
+class TravelAgentSystem:
+    GENERAL_RESPONSE = "I am a Travel Agent system. I can help you search for and book flights. How may I assist?"
+    UNRESOLVED_BOOKING_RESPONSE = "I could not identify the flight you wish to book. Please specify the airline name or flight ID from the search results."
+    SOLD_OUT_RESPONSE = "Sorry, flight {flight_id} is sold out. Please choose another option from the search results."
+    NO_BOOKING_RESPONSE = "I could not find an active booking to cancel. Please give the PNR, airline or flight ID."
+    ALREADY_BOOKED_RESPONSE = "Flight {flight_id} is already your booking (PNR {pnr}), so nothing was changed."
+    SEARCH_UNAVAILABLE_RESPONSE = "Flight search is temporarily unavailable. Please try again in a few minutes."
+
+    def __init__(self, nlu_confidence_threshold: float = NLU_CONFIDENCE_THRESHOLD,
+                 nlg_modes: Optional[Dict[str, str]] = None, fare_cache: Optional[FareCache] = None,
+                 inventory: Optional[InventoryProvider] = None, pipeline_mode: str = PIPELINE_TWO_CALL,
+                 nlu_batching: bool = False, resilience: Optional[ResilientCaller] = None):
+        self.memory = AgentMemory()
+        # Handles come from the process-wide pool, so systems share one client and connection
+        self.model = MODEL_POOL.get(MODEL_NAME)
+        self.pipeline_mode = pipeline_mode
+        self.tool_model = MODEL_POOL.get(MODEL_NAME, variant="agent_tools", tools=AGENT_TOOLS,
+                                         system_instruction=COMBINED_SYSTEM_INSTRUCTION)
+        # Deadlines, retries, hedging and the circuit breaker; process-wide unless one is passed in
+        self.resilience = resilience or MODEL_RESILIENCE
+        # Model calls and tokens across all turns (shared by SessionManager views)
+        self.usage = {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+        # Shared by SessionManager views, so concurrent sessions land in the same batches
+        self.nlu_batcher = NLUBatcher(
+            lambda prompt: self._call_model_text(prompt, generation_config=NLU_BATCH_GENERATION_CONFIG),
+            self._nlu_batch_prompt
+        ) if nlu_batching else None
+        self.rule_parser = RuleBasedParser()
+        self.nlu_confidence_threshold = nlu_confidence_threshold
+        # hits = answered by the rule-based parser, misses = fell back to the LLM
+        self.nlu_fast_path_stats = HitCounter()
+        self.nlu_cache = NLUCache(self.rule_parser)
+        self.templates = TemplateRenderer()
+        self.nlg_modes = dict(DEFAULT_NLG_MODES, **(nlg_modes or {}))
+        # Pass one FareCache to several systems to share it; SessionManager views share it already
+        self.inventory = inventory or MockInventoryProvider()
+        self.fare_cache = fare_cache or FareCache(self.inventory.search,
+                                                  stream_fn=getattr(self.inventory, "search_stream", None),
+                                                  range_fn=getattr(self.inventory, "search_range", None))
+
+    def for_session(self, memory: AgentMemory) -> "TravelAgentSystem":
+        """
+        Returns a shallow view bound to another session's memory.
+        The view shares this system's model client, parser, caches and counters.
+        """
+        view = copy.copy(self)
+        view.memory = memory
+        return view
+
+    def _extract_parameters(self, user_input: str) -> Dict[str, Any]:
+        """
+        Tries the deterministic rule-based parser first and only falls back to
+        the LLM when its confidence is below the threshold.
+        """
+        nlu_data = self._extract_parameters_local(user_input)
+        if nlu_data is not None:
+            return nlu_data
+        return self._extract_parameters_llm(user_input)
+
+    def _extract_parameters_local(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """Rule-based fast path, then the NLU cache. Returns None when the LLM is needed."""
+        nlu_data, confidence = self.rule_parser.parse(user_input)
+        if confidence >= self.nlu_confidence_threshold:
+            self.nlu_fast_path_stats.hits += 1
+            logger.info(f"NLU fast path hit (confidence {confidence:.2f}) | {self.nlu_fast_path_stats}")
+            return nlu_data
+
+        self.nlu_fast_path_stats.misses += 1
+        logger.info(f"NLU fast path miss (confidence {confidence:.2f}) | {self.nlu_fast_path_stats}")
+
+        cached = self.nlu_cache.get(user_input)
+        if cached is not None:
+            logger.info(f"NLU cache hit | {self.nlu_cache.stats}")
+        return cached
+
+    def _extract_parameters_llm(self, user_input: str) -> Dict[str, Any]:
+        """
+        Uses LLM strictly for NLU (Natural Language Understanding) to parse intent and parameters.
+        Does NOT make decisions.
+        """
+        try:
+            if self.nlu_batcher is not None:
+                nlu_data = self.nlu_batcher.extract(user_input)
+                self.nlu_cache.put(user_input, nlu_data)
+                return nlu_data
+            response = self._call_model(self._nlu_prompt(user_input), generation_config=NLU_GENERATION_CONFIG)
+            return self._parse_nlu_response(user_input, response.text)
+        except Exception as e:
+            # Model down, SDK error, blocked reply or unparseable output: the rule-based parse still applies
+            return self._nlu_fallback(user_input, e)
+
+    def _nlu_fallback(self, user_input: str, error: Exception) -> Dict[str, Any]:
+        """Degraded NLU: the rule-based parse is used whatever its confidence."""
+        self.resilience.fallbacks += 1
+        logger.warning(f"No usable NLU from the model ({error!r}), using the rule-based parse")
+        return self.rule_parser.parse(user_input)[0]
+
+    def _nlg_fallback(self, context: str, fallback: Optional[Callable[[], str]], error: Exception) -> str:
+        """Degraded NLG: the template rendering if there is one, else the factual context itself."""
+        self.resilience.fallbacks += 1
+        logger.warning(f"No usable NLG from the model ({error!r}), rendering locally")
+        return fallback() if fallback else context
+
+    def _call_model(self, prompt: str, **kwargs):
+        """One model request through the resilience layer, with usage recorded."""
+        response = self.resilience.call(
+            lambda timeout: self.model.generate_content(prompt, request_options=model_request_options(timeout), **kwargs),
+            hedge=False if kwargs.get("stream") else None
+        )
+        if not kwargs.get("stream"):
+            self._record_usage(response)
+        return response
+
+    def _call_model_text(self, prompt: str, **kwargs) -> str:
+        return self._call_model(prompt, **kwargs).text
+
+    def _nlu_batch_prompt(self, user_inputs: List[str]) -> str:
+        numbered = "\n".join(f'{i}. "{text}"' for i, text in enumerate(user_inputs, 1))
+        return NLU_BATCH_PROMPT.format(numbered_inputs=numbered)
+
+    def _nlu_prompt(self, user_input: str) -> str:
+        return NLU_PROMPT.format(user_input=user_input)
+
+    def _parse_nlu_response(self, user_input: str, text: str) -> Dict[str, Any]:
+        # Schema-constrained output is plain JSON, but stray chatter or fences are tolerated
+        nlu_data = extract_json(text, validate_nlu_result, opening="{")
+        self.nlu_cache.put(user_input, nlu_data)
+        return nlu_data
+
+    def _resolve_date(self, date_ref: str) -> str:
+        """Python logic to calculate dates. No LLM guessing. Ranges resolve to their first day."""
+        today = datetime.date.today()
+        
+        if not date_ref:
+            return today.strftime("%Y-%m-%d")
+
+        resolved = DATE_RESOLVER.resolve(date_ref, today)
+        if resolved is None:
+            logger.warning(f"Unrecognized date reference '{date_ref}', searching today's flights")
+            return today.strftime("%Y-%m-%d")
+        return resolved.start.strftime("%Y-%m-%d")
+
+    def _generate_response(self, context: str, fallback: Optional[Callable[[], str]] = None) -> str:
+        """
+        Uses LLM strictly for NLG (Natural Language Generation). `fallback` renders locally
+        if the model is down or its reply is unusable (an SDK error, a blocked candidate).
+        """
+        try:
+            return self._call_model(self._nlg_prompt(context)).text.strip()
+        except Exception as e:
+            return self._nlg_fallback(context, fallback, e)
+
+    def _generate_response_stream(self, context: str, fallback: Optional[Callable[[], str]] = None) -> Iterator[str]:
+        """Streaming NLG: yields text chunks as the model produces them, stripped like _generate_response."""
+        try:
+            response = self._call_model(self._nlg_prompt(context), stream=True)
+        except Exception as e:
+            yield self._nlg_fallback(context, fallback, e)
+            return
+        started = False
+        pending_space = ""
+        try:
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. finish metadata) carry nothing to show
+                    continue
+                if not started:
+                    text = text.lstrip()
+                    started = bool(text)
+                # Hold trailing whitespace back until more text follows, so the stream ends stripped
+                body = text.rstrip()
+                if body:
+                    yield pending_space + body
+                    pending_space = text[len(body):]
+                else:
+                    pending_space += text
+        except Exception as e:
+            if isinstance(e, RETRYABLE_MODEL_ERRORS):
+                self.resilience.breaker.record_failure()
+            if not started:
+                yield self._nlg_fallback(context, fallback, e)
+            else:
+                logger.error(f"NLG stream interrupted: {e!r}")
+            return
+        # Usage metadata is complete once the stream has been consumed
+        self._record_usage(response)
+
+    def _nlg_prompt(self, context: str) -> str:
+        return NLG_PROMPT.format(context=context)
+
+    def _record_usage(self, response):
+        self.usage["calls"] += 1
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata is not None:
+            self.usage["prompt_tokens"] += metadata.prompt_token_count
+            self.usage["output_tokens"] += metadata.candidates_token_count
+            logger.info(f"Model call #{self.usage['calls']}: {metadata.prompt_token_count} prompt + "
+                        f"{metadata.candidates_token_count} output tokens")
+
+    def _use_templates(self, intent: str) -> bool:
+        return self.nlg_modes.get(intent, NLG_MODE_POLISHED) == NLG_MODE_TEMPLATE
+
+    def handle_request(self, user_input: str) -> str:
+        """Main orchestrator logic."""
+        
+        if self.pipeline_mode == PIPELINE_COMBINED:
+            nlu_data = self._extract_parameters_local(user_input)
+            if nlu_data is None:
+                return self._handle_request_combined(user_input)
+            return self._dispatch(nlu_data)
+
+        # Step 1: NLU - extract intent and parameters
+        nlu_data = self._extract_parameters(user_input)
+        return self._dispatch(nlu_data)
+
+    def _handle_request_combined(self, user_input: str) -> str:
+        """
+        Single-conversation pipeline: the model either answers directly (one call) or
+        calls a tool whose arguments replace the NLU step. Python still runs the tool;
+        template-mode intents are rendered locally, otherwise the tool result goes back
+        into the same chat for the reply.
+        """
+        chat = self.tool_model.start_chat()
+        try:
+            # Never hedged: two concurrent sends would interleave the chat history
+            response = self.resilience.call(
+                lambda timeout: chat.send_message(user_input, request_options=model_request_options(timeout)), hedge=False)
+            self._record_usage(response)
+            call = next((part.function_call for part in response.parts if part.function_call), None)
+            if call is None:
+                return response.text.strip()
+        except Exception as e:
+            # Unreachable model, SDK error or a blocked reply: answer from the rule-based parse
+            return self._dispatch(self._nlu_fallback(user_input, e))
+
+        intent = TOOL_INTENTS.get(call.name, "GENERAL")
+        nlu_data = {"intent": intent, "passenger": "Guest", **dict(call.args)}
+        logger.info(f"Intent Detected (tool call): {intent} | Data: {nlu_data}")
+
+        window = self._date_window(nlu_data) if intent == "SEARCH" else None
+        if intent == "SEARCH":
+            origin, dest, travel_date = self._search_params(nlu_data)
+            try:
+                if window:
+                    calendar = self._flexible_search(origin, dest, window)
+                else:
+                    search_results = self.fare_cache.search(origin, dest, travel_date)
+            except InventoryError as e:
+                logger.error(f"Search failed: {e}")
+                return self.SEARCH_UNAVAILABLE_RESPONSE
+            if window:
+                fallback = lambda: self._render_calendar(calendar)
+                if self._use_templates("SEARCH") or calendar.best_date is None:
+                    return fallback()
+                tool_result = {"result": self._calendar_context(calendar)}
+            else:
+                self.memory.update_cache(search_results['flights'], origin, dest)
+                self._hold_top_fares(travel_date)
+                fallback = lambda: self.templates.render_search(origin, dest, travel_date, self.memory.flight_cache)
+                if self._use_templates("SEARCH"):
+                    return fallback()
+                tool_result = {"result": self._search_context(origin, dest, travel_date)}
+        elif intent == "BOOK":
+            flight_record, booking_result = self._book(nlu_data)
+            failure = self._booking_failure(flight_record, booking_result)
+            if failure:
+                fallback = lambda: failure
+                tool_result = {"error": failure}
+            else:
+                fallback = lambda: self.templates.render_booking(flight_record, booking_result)
+                if self._use_templates("BOOK"):
+                    return fallback()
+                tool_result = {"result": self._booking_context(flight_record, booking_result)}
+        elif intent == "REBOOK":
+            flight_record, booking_result, previous = self._rebook(nlu_data)
+            failure = self._booking_failure(flight_record, booking_result)
+            if failure:
+                fallback = lambda: failure
+                tool_result = {"error": failure}
+            elif previous is None:
+                fallback = lambda: self.templates.render_booking(flight_record, booking_result)
+                if self._use_templates("BOOK"):
+                    return fallback()
+                tool_result = {"result": self._booking_context(flight_record, booking_result)}
+            else:
+                fallback = lambda: self.templates.render_rebooking(flight_record, booking_result, previous)
+                if self._use_templates("REBOOK"):
+                    return fallback()
+                tool_result = {"result": self._rebooking_context(flight_record, booking_result, previous)}
+        elif intent == "CANCEL":
+            booking = self._cancel(nlu_data)
+            if booking is None:
+                fallback = lambda: self.NO_BOOKING_RESPONSE
+                tool_result = {"error": self.NO_BOOKING_RESPONSE}
+            else:
+                fallback = lambda: self.templates.render_cancellation(booking)
+                if self._use_templates("CANCEL"):
+                    return fallback()
+                tool_result = {"result": self._cancellation_context(booking)}
+        else:
+            return self.GENERAL_RESPONSE
+
+        function_response = genai.protos.Content(parts=[genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(name=call.name, response=tool_result)
+        )])
+        try:
+            response = self.resilience.call(
+                lambda timeout: chat.send_message(function_response, request_options=model_request_options(timeout)), hedge=False)
+            self._record_usage(response)
+            return response.text.strip()
+        except Exception as e:
+            return self._nlg_fallback(str(tool_result), fallback, e)
+
+    def handle_request_stream(self, user_input: str) -> Iterator[str]:
+        """
+        Like handle_request, but yields the response in chunks. Searches show the
+        best fares from the first batch before the remaining batches have arrived.
+        """
+        if self.pipeline_mode == PIPELINE_COMBINED:
+            nlu_data = self._extract_parameters_local(user_input)
+            if nlu_data is None:
+                # The tool-calling chat is not streamed: its reply arrives as one chunk
+                yield self._handle_request_combined(user_input)
+                return
+        else:
+            nlu_data = self._extract_parameters(user_input)
+        intent = nlu_data.get("intent", "GENERAL")
+        if intent == "SEARCH":
+            logger.info(f"Intent Detected: {intent} | Data: {nlu_data}")
+            yield from self._handle_search_stream(nlu_data)
+        elif intent == "BOOK":
+            logger.info(f"Intent Detected: {intent} | Data: {nlu_data}")
+            yield from self._handle_booking_stream(nlu_data)
+        else:
+            yield self._dispatch(nlu_data)
+
+    def _dispatch(self, nlu_data: Dict[str, Any]) -> str:
+        intent = nlu_data.get("intent", "GENERAL")
+        logger.info(f"Intent Detected: {intent} | Data: {nlu_data}")
+
+        # Step 2: Route to appropriate handler based on intent
+        if intent == "SEARCH":
+            return self._handle_search(nlu_data)
+        elif intent == "BOOK":
+            return self._handle_booking(nlu_data)
+        elif intent == "REBOOK":
+            return self._handle_rebooking(nlu_data)
+        elif intent == "CANCEL":
+            return self._handle_cancellation(nlu_data)
+        else:
+            return self.GENERAL_RESPONSE
+
+    def _search_params(self, data: Dict) -> Tuple[str, str, str]:
+        origin = data.get("origin", "Unknown")
+        dest = data.get("destination", "Unknown")
+        # Resolve date using deterministic Python logic
+        travel_date = self._resolve_date(data.get("date_reference"))
+        return origin, dest, travel_date
+
+    def _date_window(self, data: Dict) -> Optional[List[str]]:
+        """The dates to scan when the date reference is a range ("this weekend", "next week"), else None."""
+        resolved = DATE_RESOLVER.resolve(data.get("date_reference"))
+        if resolved is None or resolved.end == resolved.start:
+            return None
+        return [d.strftime("%Y-%m-%d") for d in resolved.days()[:FLEX_MAX_DAYS]]
+
+    def _flexible_search(self, origin: str, dest: str, dates: List[str]) -> PriceCalendar:
+        """
+        Searches every date of the window (one range call or concurrent per-date calls),
+        builds the price calendar and loads the cheapest day's fares into memory, so
+        the next turn books against that day. Raises InventoryError when no date could be searched.
+        """
+        results = self.fare_cache.search_range(origin, dest, dates)
+        if not results:
+            raise InventoryError(f"No date answered for {origin}-{dest} between {dates[0]} and {dates[-1]}")
+        calendar = PriceCalendar.build(origin, dest, {d: results.get(d, {"flights": []}) for d in dates})
+        best_date = calendar.best_date or dates[0]
+        self.memory.update_cache(results.get(best_date, {"flights": []})["flights"], origin, dest)
+        self.memory.price_calendar = calendar
+        self._hold_top_fares(best_date)
+        logger.info(f"Flexible search over {len(dates)} dates: cheapest day {calendar.best_date}")
+        return calendar
+
+    def _render_calendar(self, calendar: PriceCalendar) -> str:
+        return self.templates.render_price_calendar(calendar, self.memory.query(FlightQuery(limit=STREAM_PREVIEW_FARES)))
+
+    def _calendar_context(self, calendar: PriceCalendar) -> str:
+        """System context for polished-mode NLG of a flexible-date search."""
+        lines = [f"Flexible-date search for {calendar.origin} to {calendar.destination}, "
+                 f"{calendar.dates[0]} to {calendar.dates[-1]}. Cheapest fare per day, cheapest days first:"]
+        for day in calendar.ranked(STREAM_PREVIEW_FARES):
+            fare = calendar.best_fares[day]
+            lines.append(f"- {calendar.dates[day]}: {fare['price']} ({fare['airline']} {fare['flight_id']})")
+        return "\n".join(lines)
+
+    def _handle_flexible_search(self, origin: str, dest: str, dates: List[str]) -> str:
+        calendar = self._flexible_search(origin, dest, dates)
+        render = lambda: self._render_calendar(calendar)
+        if self._use_templates("SEARCH") or calendar.best_date is None:
+            return render()
+        return self._generate_response(self._calendar_context(calendar), fallback=render)
+
+    def _handle_search(self, data: Dict) -> str:
+        origin, dest, travel_date = self._search_params(data)
+        window = self._date_window(data)
+        try:
+            if window:
+                return self._handle_flexible_search(origin, dest, window)
+
+            # Call search tool (through the shared fare cache) - no LLM involved
+            search_results = self.fare_cache.search(origin, dest, travel_date)
+        except InventoryError as e:
+            logger.error(f"Search failed: {e}")
+            return self.SEARCH_UNAVAILABLE_RESPONSE
+        
+        # Update agent memory with search results
+        self.memory.update_cache(search_results['flights'], origin, dest)
+        self._hold_top_fares(travel_date)
+        
+        render = lambda: self.templates.render_search(origin, dest, travel_date, self.memory.flight_cache)
+        if self._use_templates("SEARCH"):
+            return render()
+        return self._generate_response(self._search_context(origin, dest, travel_date), fallback=render)
+
+    def _handle_search_stream(self, data: Dict) -> Iterator[str]:
+        origin, dest, travel_date = self._search_params(data)
+        window = self._date_window(data)
+        if window:
+            yield self._handle_search(data)
+            return
+        self.memory.begin_update(origin, dest)
+        best_query = FlightQuery(limit=STREAM_PREVIEW_FARES)
+        preview: Optional[List[str]] = None
+
+        try:
+            for batch in self.fare_cache.search_stream(origin, dest, travel_date):
+                # Rows are parsed and indexed as each batch lands
+                self.memory.extend_cache(batch)
+                if preview is None and len(self.memory.flight_cache) and self._use_templates("SEARCH"):
+                    best = self.memory.query(best_query)
+                    preview = [f.flight_id for f in best]
+                    yield self.templates.render_search_preview(origin, dest, travel_date, best)
+        except InventoryError as e:
+            # Fares already shown stay in memory and can still be booked
+            logger.error(f"Search failed: {e}")
+            yield self.SEARCH_UNAVAILABLE_RESPONSE
+            return
+        logger.info(f"Memory updated with {len(self.memory.flight_cache)} flight options.")
+        self._hold_top_fares(travel_date)
+
+        if not self._use_templates("SEARCH"):
+            yield from self._generate_response_stream(
+                self._search_context(origin, dest, travel_date),
+                fallback=lambda: self.templates.render_search(origin, dest, travel_date, self.memory.flight_cache))
+        elif preview is None:
+            yield self.templates.render_search(origin, dest, travel_date, [])
+        else:
+            best = self.memory.query(best_query)
+            changed = [f.flight_id for f in best] != preview
+            yield self.templates.render_search_complete(len(self.memory.flight_cache), best if changed else None)
+
+    def _search_context(self, origin: str, dest: str, travel_date: str,
+                        token_budget: int = NLG_CONTEXT_TOKEN_BUDGET) -> str:
+        """
+        System context for polished-mode NLG of search results.
+        Only the cheapest fares that fit the token budget are listed.
+        """
+        total = len(self.memory.flight_cache)
+        header = f"Search completed for {origin} to {dest} on {travel_date}. Found {total} options"
+        budget = token_budget - estimate_tokens(header) - estimate_tokens(", cheapest 999 shown:")
+
+        # A fare line is never under ~8 tokens, which bounds how many candidates are worth ranking
+        candidates = self.memory.query(FlightQuery(limit=max(1, budget // 8))) if total else []
+        flight_strings: List[str] = []
+        for f in candidates:
+            line = f"- {f.airline} ({f.flight_id}): {f.raw_price} at {f.departure}"
+            budget -= estimate_tokens(line) + 1
+            if budget < 0:
+                break
+            flight_strings.append(line)
+
+        if len(flight_strings) < total:
+            header += f", cheapest {len(flight_strings)} shown"
+        context = header + ":\n" + "\n".join(flight_strings)
+        logger.info(f"NLG context: {len(flight_strings)}/{total} fares, ~{estimate_tokens(context)} tokens")
+        return context
+
+    def _resolve_booking_target(self, data: Dict) -> Optional[FlightRecord]:
+        """Entity resolution: map user reference to actual flight in memory."""
+        target = (data.get("booking_target") or "").lower()
+        query = FlightQuery.from_phrase(target)
+
+        if query is not None:
+            # Ranked/filtered references: "cheapest", "earliest", "under $400", "non-Lufthansa"
+            if query.airline:
+                # Leftover words ("earliest Lufthansa flight") only filter when they name a cached airline
+                candidates = self.memory.rank_airlines(query.airline, limit=1)
+                query.airline = candidates[0][0] if candidates else None
+            matches = self.memory.query(query)
+            flight_record = matches[0] if matches else None
+            logger.info(f"Entity Resolution: '{target}' resolved via {query} to ID {flight_record.flight_id if flight_record else 'None'}")
+        else:
+            # Try matching by airline name first
+            flight_record = self.memory.find_flight_by_airline(target)
+            if not flight_record:
+                # Fallback: check if user provided raw flight ID
+                flight_record = self.memory.get_flight_by_id(target.upper())
+            logger.info(f"Entity Resolution: '{target}' resolved to ID {flight_record.flight_id if flight_record else 'None'}")
+        return flight_record
+
+    def _handle_booking(self, data: Dict) -> str:
+        flight_record, booking_result = self._book(data)
+        failure = self._booking_failure(flight_record, booking_result)
+        if failure:
+            return failure
+        
+        return self._render_booking(flight_record, booking_result)
+
+    def _render_booking(self, flight_record: FlightRecord, booking_result: Dict) -> str:
+        render = lambda: self.templates.render_booking(flight_record, booking_result)
+        if self._use_templates("BOOK"):
+            return render()
+        return self._generate_response(self._booking_context(flight_record, booking_result), fallback=render)
+
+    def _handle_booking_stream(self, data: Dict) -> Iterator[str]:
+        flight_record, booking_result = self._book(data)
+        failure = self._booking_failure(flight_record, booking_result)
+        if failure:
+            yield failure
+        elif self._use_templates("BOOK"):
+            yield self.templates.render_booking(flight_record, booking_result)
+        else:
+            yield from self._generate_response_stream(
+                self._booking_context(flight_record, booking_result),
+                fallback=lambda: self.templates.render_booking(flight_record, booking_result))
+
+    def _book(self, data: Dict) -> Tuple[Optional[FlightRecord], Optional[Dict]]:
+        """Resolves the booking target and commits it. Returns (None, None) when unresolved."""
+        passenger = data.get("passenger", "Guest")
+        flight_record = self._resolve_booking_target(data)
+        if not flight_record:
+            return None, None
+        return flight_record, self._commit(flight_record, passenger)
+
+    def _commit(self, flight_record: FlightRecord, passenger: str) -> Dict:
+        """
+        Books a resolved flight and records it in the session ledger. Idempotent per
+        (session, passenger, flight, date): a repeated request returns the existing booking.
+        """
+        existing = self.memory.find_booking(passenger, flight_record.flight_id, self.memory.search_date)
+        if existing is not None:
+            logger.info(f"Booking {existing.pnr} already covers {passenger} on {flight_record.flight_id}")
+            return existing.as_result()
+
+        # Execute booking via tool call, confirming the seat held at search time
+        hold_id = self.memory.holds.pop(flight_record.flight_id, None)
+        result = _commit_reservation(flight_record.flight_id, passenger, self.memory.search_date, hold_id,
+                                     (flight_record.origin, flight_record.destination),
+                                     self._reservation_key(passenger, flight_record))
+        self._record_booking(flight_record, result)
+        return result
+
+    def _reservation_key(self, passenger: str, flight_record: FlightRecord) -> Tuple[str, str, str, Optional[str]]:
+        """Idempotency key of a reservation: retries and concurrent duplicates share its PNR."""
+        return (self.memory.session_id, passenger, flight_record.flight_id, self.memory.search_date)
+
+    def _record_booking(self, flight_record: FlightRecord, result: Dict):
+        if result["status"] == "CONFIRMED":
+            self.memory.record_booking(Booking(result["pnr"], flight_record.flight_id, flight_record.airline,
+                                               result["passenger"], self.memory.search_date,
+                                               route=(flight_record.origin, flight_record.destination),
+                                               price=flight_record.price, departure=flight_record.departure))
+
+    def _rebook(self, data: Dict) -> Tuple[Optional[FlightRecord], Optional[Dict], Optional[Booking]]:
+        """
+        Replaces the passenger's latest booking with the resolved flight in one swap
+        call. With nothing to replace it is a plain booking (previous booking None);
+        when the flight already is that booking the result's status is UNCHANGED.
+        """
+        passenger = data.get("passenger", "Guest")
+        flight_record = self._resolve_booking_target(data)
+        if not flight_record:
+            return None, None, None
+        previous = self.memory.find_booking(None if passenger == "Guest" else passenger)
+        if previous is None:
+            return flight_record, self._commit(flight_record, passenger), None
+        if (previous.flight_id, previous.travel_date) == (flight_record.flight_id, self.memory.search_date):
+            logger.info(f"Rebooking target {flight_record.flight_id} is already booking {previous.pnr}")
+            return flight_record, dict(previous.as_result(), status="UNCHANGED"), previous
+
+        passenger = previous.passenger
+        hold_id = self.memory.holds.pop(flight_record.flight_id, None)
+        result = _swap_reservation(previous.pnr, previous.flight_id, previous.travel_date, flight_record.flight_id,
+                                   passenger, self.memory.search_date, hold_id,
+                                   previous.route, (flight_record.origin, flight_record.destination),
+                                   self._reservation_key(passenger, flight_record))
+        if result["status"] == "CONFIRMED":
+            self.memory.cancel_booking(previous.pnr)
+            self._record_booking(flight_record, result)
+        return flight_record, result, previous
+
+    def _cancel(self, data: Dict) -> Optional[Booking]:
+        """Cancels the booking the user refers to (latest by default). None if there is none."""
+        passenger = None if data.get("passenger", "Guest") == "Guest" else data["passenger"]
+        target = data.get("booking_target")
+        # Ranked references ("the cheapest one") pick among the bookings, not the search results
+        query = FlightQuery.from_phrase((target or "").lower())
+        if query is not None:
+            booking = self.memory.rank_bookings(passenger, query)
+        else:
+            booking = self.memory.find_booking(passenger, target)
+        if booking is None:
+            return None
+        _cancel_reservation(booking.pnr, booking.flight_id, booking.travel_date, booking.route)
+        return self.memory.cancel_booking(booking.pnr)
+
+    def _handle_rebooking(self, data: Dict) -> str:
+        flight_record, booking_result, previous = self._rebook(data)
+        failure = self._booking_failure(flight_record, booking_result)
+        if failure:
+            return failure
+        if previous is None:
+            return self._render_booking(flight_record, booking_result)
+
+        render = lambda: self.templates.render_rebooking(flight_record, booking_result, previous)
+        if self._use_templates("REBOOK"):
+            return render()
+        return self._generate_response(self._rebooking_context(flight_record, booking_result, previous), fallback=render)
+
+    def _handle_cancellation(self, data: Dict) -> str:
+        booking = self._cancel(data)
+        if booking is None:
+            return self.NO_BOOKING_RESPONSE
+
+        render = lambda: self.templates.render_cancellation(booking)
+        if self._use_templates("CANCEL"):
+            return render()
+        return self._generate_response(self._cancellation_context(booking), fallback=render)
+
+    def _booking_failure(self, flight_record: Optional[FlightRecord], booking_result: Optional[Dict]) -> Optional[str]:
+        """The reply for a booking that did not go through, or None if it was confirmed."""
+        if not flight_record:
+            return self.UNRESOLVED_BOOKING_RESPONSE
+        if booking_result["status"] == "UNCHANGED":
+            return self.ALREADY_BOOKED_RESPONSE.format(flight_id=booking_result["flight_id"], pnr=booking_result["pnr"])
+        if booking_result["status"] != "CONFIRMED":
+            return self.SOLD_OUT_RESPONSE.format(flight_id=flight_record.flight_id)
+        return None
+
+    def _hold_top_fares(self, travel_date: str):
+        """
+        Holds a seat on each of the cheapest fares the user is about to see, so a
+        booking in the next turn confirms a seat instead of racing for one. The
+        previous search's unused holds go back to the inventory, and search holds
+        are capped at SEARCH_HOLD_MAX_SHARE of a flight so browsing cannot sell it out.
+        """
+        _release_holds(self.memory)
+        self.memory.search_date = travel_date
+        for flight in self.memory.query(FlightQuery(limit=SEARCH_HOLD_FARES)):
+            hold_id = SEAT_INVENTORY.hold(flight.flight_id, travel_date, route=(flight.origin, flight.destination),
+                                          max_share=SEARCH_HOLD_MAX_SHARE)
+            if hold_id is not None:
+                self.memory.holds[flight.flight_id] = hold_id
+
+    def _booking_context(self, flight_record: FlightRecord, booking_result: Dict) -> str:
+        """System context for polished-mode NLG of a booking confirmation."""
+        return (
+            f"Booking successful.\n"
+            f"Airline: {flight_record.airline}\n"
+            f"Flight ID: {booking_result['flight_id']}\n"
+            f"Passenger: {booking_result['passenger']}\n"
+            f"PNR: {booking_result['pnr']}\n"
+            f"Status: {booking_result['status']}"
+        )
+
+    def _rebooking_context(self, flight_record: FlightRecord, booking_result: Dict, previous: Booking) -> str:
+        """System context for polished-mode NLG of a rebooking."""
+        return (
+            self._booking_context(flight_record, booking_result) +
+            f"\nReplaces booking {previous.pnr} ({previous.airline} {previous.flight_id}), which is now cancelled."
+        )
+
+    def _cancellation_context(self, booking: Booking) -> str:
+        """System context for polished-mode NLG of a cancellation."""
+        return (
+            f"Booking cancelled.\n"
+            f"Airline: {booking.airline}\n"
+            f"Flight ID: {booking.flight_id}\n"
+            f"Passenger: {booking.passenger}\n"
+            f"PNR: {booking.pnr}\n"
+            f"Status: CANCELLED"
+        )
+
+class AsyncTravelAgentSystem(TravelAgentSystem):
+    """
+    Asyncio-native orchestrator running the same pipeline as TravelAgentSystem.
+    Model calls use the async generate API behind a semaphore (shareable across
+    instances, so many sessions on one event loop respect one concurrency limit),
+    and the blocking tools run in worker threads so they never stall the loop.
+    """
+    def __init__(self, max_concurrent_model_calls: int = MODEL_CONCURRENCY_LIMIT,
+                 model_semaphore: Optional[asyncio.Semaphore] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.model_semaphore = model_semaphore or asyncio.Semaphore(max_concurrent_model_calls)
+
+    async def _generate_content_async(self, prompt: str, **kwargs):
+        async def attempt(timeout: float):
+            async with self.model_semaphore:
+                return await self.model.generate_content_async(prompt, request_options=model_request_options(timeout), **kwargs)
+
+        response = await self.resilience.call_async(attempt)
+        self._record_usage(response)
+        return response
+
+    async def _extract_parameters_async(self, user_input: str) -> Dict[str, Any]:
+        nlu_data = self._extract_parameters_local(user_input)
+        if nlu_data is not None:
+            return nlu_data
+        try:
+            if self.nlu_batcher is not None:
+                nlu_data = await asyncio.wrap_future(self.nlu_batcher.submit(user_input))
+                self.nlu_cache.put(user_input, nlu_data)
+                return nlu_data
+            response = await self._generate_content_async(self._nlu_prompt(user_input), generation_config=NLU_GENERATION_CONFIG)
+            return self._parse_nlu_response(user_input, response.text)
+        except Exception as e:
+            return self._nlu_fallback(user_input, e)
+
+    async def _generate_response_async(self, context: str, fallback: Optional[Callable[[], str]] = None) -> str:
+        try:
+            return (await self._generate_content_async(self._nlg_prompt(context))).text.strip()
+        except Exception as e:
+            return self._nlg_fallback(context, fallback, e)
+
+    async def handle_request_async(self, user_input: str) -> str:
+        """Async counterpart of handle_request."""
+        if self.pipeline_mode == PIPELINE_COMBINED:
+            nlu_data = self._extract_parameters_local(user_input)
+            if nlu_data is None:
+                # The tool-calling chat is synchronous, so it runs off the event loop
+                return await asyncio.to_thread(self._handle_request_combined, user_input)
+        else:
+            nlu_data = await self._extract_parameters_async(user_input)
+        intent = nlu_data.get("intent", "GENERAL")
+        logger.info(f"Intent Detected: {intent} | Data: {nlu_data}")
+
+        if intent == "SEARCH":
+            return await self._handle_search_async(nlu_data)
+        elif intent == "BOOK":
+            return await self._handle_booking_async(nlu_data)
+        elif intent == "REBOOK":
+            return await self._handle_rebooking_async(nlu_data)
+        elif intent == "CANCEL":
+            return await self._handle_cancellation_async(nlu_data)
+        else:
+            return self.GENERAL_RESPONSE
+
+    async def _handle_search_async(self, data: Dict) -> str:
+        origin, dest, travel_date = self._search_params(data)
+        window = self._date_window(data)
+        try:
+            if window:
+                calendar = await asyncio.to_thread(self._flexible_search, origin, dest, window)
+            else:
+                search_results = await asyncio.to_thread(self.fare_cache.search, origin, dest, travel_date)
+        except InventoryError as e:
+            logger.error(f"Search failed: {e}")
+            return self.SEARCH_UNAVAILABLE_RESPONSE
+        if window:
+            render = lambda: self._render_calendar(calendar)
+            if self._use_templates("SEARCH") or calendar.best_date is None:
+                return render()
+            return await self._generate_response_async(self._calendar_context(calendar), fallback=render)
+        self.memory.update_cache(search_results['flights'], origin, dest)
+        self._hold_top_fares(travel_date)
+
+        render = lambda: self.templates.render_search(origin, dest, travel_date, self.memory.flight_cache)
+        if self._use_templates("SEARCH"):
+            return render()
+        return await self._generate_response_async(self._search_context(origin, dest, travel_date), fallback=render)
+
+    async def _handle_booking_async(self, data: Dict) -> str:
+        passenger = data.get("passenger", "Guest")
+        flight_record = self._resolve_booking_target(data)
+        if not flight_record:
+            return self.UNRESOLVED_BOOKING_RESPONSE
+
+        booking_result = await asyncio.to_thread(self._commit, flight_record, passenger)
+        failure = self._booking_failure(flight_record, booking_result)
+        if failure:
+            return failure
+
+        return await self._render_booking_async(flight_record, booking_result)
+
+    async def _render_booking_async(self, flight_record: FlightRecord, booking_result: Dict) -> str:
+        render = lambda: self.templates.render_booking(flight_record, booking_result)
+        if self._use_templates("BOOK"):
+            return render()
+        return await self._generate_response_async(self._booking_context(flight_record, booking_result), fallback=render)
+
+    async def _handle_rebooking_async(self, data: Dict) -> str:
+        flight_record, booking_result, previous = await asyncio.to_thread(self._rebook, data)
+        failure = self._booking_failure(flight_record, booking_result)
+        if failure:
+            return failure
+        if previous is None:
+            return await self._render_booking_async(flight_record, booking_result)
+
+        render = lambda: self.templates.render_rebooking(flight_record, booking_result, previous)
+        if self._use_templates("REBOOK"):
+            return render()
+        return await self._generate_response_async(
+            self._rebooking_context(flight_record, booking_result, previous), fallback=render)
+
+    async def _handle_cancellation_async(self, data: Dict) -> str:
+        booking = await asyncio.to_thread(self._cancel, data)
+        if booking is None:
+            return self.NO_BOOKING_RESPONSE
+
+        render = lambda: self.templates.render_cancellation(booking)
+        if self._use_templates("CANCEL"):
+            return render()
+        return await self._generate_response_async(self._cancellation_context(booking), fallback=render)
+
+# ==============================================================================
+# 8. SESSION MANAGEMENT (MULTI-TENANT ORCHESTRATION)
+# ==============================================================================
+
+class SessionManager:
+    """
+    Serves many conversations from one agent.
+    The model client, NLU layers and tools are shared; each session only keeps its
+    own AgentMemory. Sessions are held in LRU order and evicted when idle, when the
+    resident count exceeds max_sessions, or when total memory exceeds the budget.
+    Idle sessions are swept by the next checkout once sweep_interval_seconds have passed.
+    """
+    def __init__(self, agent: Optional[TravelAgentSystem] = None,
+                 max_sessions: int = MAX_RESIDENT_SESSIONS,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+                 memory_budget_bytes: int = SESSION_MEMORY_BUDGET_BYTES,
+                 sweep_interval_seconds: float = SESSION_SWEEP_INTERVAL_SECONDS):
+        self.agent = agent or TravelAgentSystem()
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.total_bytes = 0
+        self.evictions = 0
+        self._next_sweep = time.monotonic() + sweep_interval_seconds
+        # session_id -> (last_access, memory), least recently used first
+        self._sessions: "OrderedDict[str, Tuple[float, AgentMemory]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def handle_request(self, session_id: str, user_input: str) -> str:
+        memory, before = self._checkout(session_id)
+        try:
+            return self.agent.for_session(memory).handle_request(user_input)
+        finally:
+            self._checkin(session_id, memory, before)
+
+    async def handle_request_async(self, session_id: str, user_input: str) -> str:
+        """Requires the shared agent to be an AsyncTravelAgentSystem."""
+        memory, before = self._checkout(session_id)
+        try:
+            return await self.agent.for_session(memory).handle_request_async(user_input)
+        finally:
+            self._checkin(session_id, memory, before)
+
+    def end_session(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry:
+                self.total_bytes -= entry[1].footprint_bytes
+                _release_holds(entry[1])
+
+    def evict_idle(self) -> int:
+        """Drops sessions idle longer than the TTL. Returns the number evicted."""
+        with self._lock:
+            return self._evict_idle(time.monotonic())
+
+    def _evict_idle(self, now: float) -> int:
+        """Caller holds the lock."""
+        cutoff = now - self.idle_ttl_seconds
+        self._next_sweep = now + self.sweep_interval_seconds
+        evicted = 0
+        # LRU order means the idle sessions are all at the front
+        while self._sessions:
+            last_access, _ = next(iter(self._sessions.values()))
+            if last_access > cutoff:
+                break
+            self._evict_oldest()
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions ({len(self._sessions)} resident)")
+        return evicted
+
+    def _checkout(self, session_id: str) -> Tuple[AgentMemory, int]:
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._evict_idle(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                memory = AgentMemory(session_id)
+                self.total_bytes += memory.footprint_bytes
+            else:
+                memory = entry[1]
+            self._sessions[session_id] = (now, memory)
+            self._sessions.move_to_end(session_id)
+            return memory, memory.footprint_bytes
+
+    def _checkin(self, session_id: str, memory: AgentMemory, before: int):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            # The session may have been evicted or replaced while the request ran
+            if entry is None or entry[1] is not memory:
+                return
+            self.total_bytes += memory.footprint_bytes - before
+            self._enforce_limits()
+
+    def _enforce_limits(self):
+        """Caller holds the lock."""
+        while self._sessions and (len(self._sessions) > self.max_sessions
+                                  or self.total_bytes > self.memory_budget_bytes):
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        """Caller holds the lock."""
+        _, (_, memory) = self._sessions.popitem(last=False)
+        self.total_bytes -= memory.footprint_bytes
+        _release_holds(memory)
+        self.evictions += 1
+
+# ==============================================================================
+# 9. BENCHMARKS (OFFLINE, RUN WITH --bench)
+# ==============================================================================
+
+def _time_per_call(fn, repeat: int) -> float:
+    """Returns mean microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def _benchmark_raw_flights(n_records: int) -> List[Dict]:
+    airlines = ["British Airways", "Air France", "Lufthansa", "KLM", "Iberia", "Emirates", "Delta", "United"]
+    return [
+        {"flight_id": f"XX-{i:05d}", "airline": airlines[i % len(airlines)],
+         "departure_time": f"{1 + i % 12:02d}:{(i * 5) % 60:02d} {'AM' if i % 2 else 'PM'}",
+         "price": f"${100 + (i * 7919) % 900}"}
+        for i in range(n_records)
+    ]
+
+def benchmark_memory_index(n_records: int = 10_000, repeat: int = 200):
+    """Compares the indexed AgentMemory resolvers against linear scans over a record list."""
+    raw_flights = _benchmark_raw_flights(n_records)
+    memory = AgentMemory()
+    memory.update_cache(raw_flights, "London", "Paris")
+    records = list(memory.flight_cache)
+    last_id = raw_flights[-1]["flight_id"]
+
+    def scan_by_id():
+        return next((f for f in records if f.flight_id == last_id), None)
+
+    def scan_by_airline():
+        return next((f for f in records if "united" in f.airline.lower().replace(" ", "")), None)
+
+    def scan_airline_miss():
+        return next((f for f in records if "qantas" in f.airline.lower().replace(" ", "")), None)
+
+    def scan_cheapest():
+        return min(records, key=lambda x: x.price)
+
+    results = [
+        ("get_flight_by_id", scan_by_id, lambda: memory.get_flight_by_id(last_id)),
+        ("find_flight_by_airline", scan_by_airline, lambda: memory.find_flight_by_airline("United")),
+        ("find_flight_by_airline*", scan_airline_miss, lambda: memory.find_flight_by_airline("Qantas")),
+        ("find_cheapest_flight", scan_cheapest, memory.find_cheapest_flight),
+    ]
+    print(f"AgentMemory resolvers over {n_records} records (us/call):")
+    for name, scan, indexed in results:
+        assert scan() == indexed(), name
+        before, after = _time_per_call(scan, repeat), _time_per_call(indexed, repeat)
+        print(f"  {name:<24} scan {before:>10.2f}   indexed {after:>8.2f}   x{before / after:,.1f}")
+    print("  (* no matching airline: worst case for the scan)")
+
+def benchmark_memory_footprint(n_records: int = 50_000):
+    """Compares resident memory of the columnar store with a list of dict-backed records."""
+    @dataclass
+    class DictBackedRecord:
+        flight_id: str
+        airline: str
+        price: int
+        raw_price: str
+        departure: str
+        origin: str
+        destination: str
+
+    raw_flights = _benchmark_raw_flights(n_records)
+
+    def build_rows():
+        return [DictBackedRecord(f['flight_id'], f['airline'], int(f['price'][1:]), f['price'],
+                                 f['departure_time'], "London", "Paris") for f in raw_flights]
+
+    def build_columns():
+        columns = FlightColumns()
+        for f in raw_flights:
+            columns.append(f['flight_id'], f['airline'], int(f['price'][1:]), f['price'],
+                           f['departure_time'], "London", "Paris")
+        return columns
+
+    print(f"Resident memory for {n_records} fares (excluding indexes):")
+    sizes = []
+    for name, build in (("list of dataclasses", build_rows), ("FlightColumns", build_columns)):
+        tracemalloc.start()
+        kept = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sizes.append(size)
+        print(f"  {name:<22} {size / 1024:>10,.0f} KiB")
+        del kept
+    print(f"  reduction x{sizes[0] / sizes[1]:.1f}")
+
+def benchmark_memory_query(n_records: int = 100_000, repeat: int = 20):
+    """Compares the vectorized query path with the pure-Python fallback."""
+    global np
+    memory = AgentMemory()
+    memory.update_cache(_benchmark_raw_flights(n_records), "London", "Paris")
+    query = FlightQuery(max_price=400, earliest_departure=18 * 60, exclude_airline="Lufthansa", limit=5)
+
+    numpy_module = np
+    try:
+        np = None
+        python_us = _time_per_call(lambda: memory.query(query), repeat)
+        expected = memory.query(query)
+    finally:
+        np = numpy_module
+    print(f"AgentMemory.query over {n_records} records: {query}")
+    print(f"  python fallback   {python_us:>10.0f} us/call")
+    if np is None:
+        print("  numpy             not installed")
+        return
+    assert memory.query(query) == expected
+    numpy_us = _time_per_call(lambda: memory.query(query), repeat)
+    print(f"  numpy             {numpy_us:>10.0f} us/call   x{python_us / numpy_us:,.1f}")
+
+def benchmark_orchestrator(n_sessions: int = 500, seed: int = 7):
+    """Drives search + booking turns for many sessions against the synthetic inventory."""
+    inventory = SyntheticInventoryProvider(seed=seed)
+    manager = SessionManager(TravelAgentSystem(inventory=inventory))
+    rng = random.Random(seed)
+    routes = SyntheticInventoryProvider.routes()
+    turns = []
+    for i in range(n_sessions):
+        origin, dest = rng.choice(routes)
+        turns.append((f"s{i}", f"Find me flights from {origin} to {dest} for tomorrow."))
+        turns.append((f"s{i}", rng.choice(["Book the cheapest one for Robin.", "Book the earliest flight after 6pm for Robin.",
+                                           "Book the Lufthansa one for Robin.", "Book the cheapest non-Lufthansa one for Robin."])))
+
+    previous_level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        start = time.perf_counter()
+        for session_id, message in turns:
+            manager.handle_request(session_id, message)
+        elapsed = time.perf_counter() - start
+    finally:
+        logger.setLevel(previous_level)
+    agent = manager.agent
+    print(f"Orchestrator: {len(turns)} turns over {n_sessions} sessions on synthetic inventory")
+    print(f"  {len(turns) / elapsed:,.0f} turns/s   {elapsed / len(turns) * 1e3:.2f} ms/turn   "
+          f"{inventory.calls} inventory calls   {manager.total_bytes / 1024:,.0f} KiB resident")
+    print(f"  NLU fast path: {agent.nlu_fast_path_stats}")
+
+def benchmark_date_resolver(n: int = 20000):
+    """DateResolver cost per phrase, first resolution versus memoized."""
+    phrases = ["tomorrow", "next friday", "in 3 days", "this weekend", "20 October", "christmas eve", "2027-01-15", "the 20th"]
+    today = datetime.date.today()
+    cold = _time_per_call(lambda: [DateResolver().resolve(p, today) for p in phrases], n // 100) / len(phrases)
+    resolver = DateResolver()
+    warm = _time_per_call(lambda: [resolver.resolve(p, today) for p in phrases], n // len(phrases)) / len(phrases)
+    print(f"DateResolver over {len(phrases)} phrase shapes (us/call):")
+    print(f"  first resolution {cold:8.2f}   memoized {warm:8.2f}")
+
+def benchmark_flexible_search(days: int = 30, latency: float = 0.02):
+    """A 30-day window on the synthetic inventory: one range call versus concurrent per-date calls, and the calendar build."""
+    start_date = datetime.date.today() + datetime.timedelta(days=1)
+    dates = [(start_date + datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+    provider = SyntheticInventoryProvider(seed=11, latency_seconds=latency)
+    print(f"Flexible-date search over {days} dates ({latency * 1000:.0f}ms simulated latency per call):")
+    for label, range_fn in (("range call", provider.search_range), ("per-date, concurrent", None)):
+        cache = FareCache(provider.search, range_fn=range_fn)
+        start = time.perf_counter()
+        results = cache.search_range("London", "Tokyo", dates)
+        print(f"  {label:22s} {(time.perf_counter() - start) * 1000:8.1f} ms   "
+              f"{sum(len(r['flights']) for r in results.values())} fares")
+    global np
+    fares = sum(len(r["flights"]) for r in results.values())
+    numpy_module = np
+    try:
+        np = None
+        python_us = _time_per_call(lambda: PriceCalendar.build("London", "Tokyo", results), 20)
+    finally:
+        np = numpy_module
+    print(f"  calendar build over {fares} fares: python {python_us:>8.0f} us/call", end="")
+    if np is None:
+        print()
+        return
+    numpy_us = _time_per_call(lambda: PriceCalendar.build("London", "Tokyo", results), 20)
+    print(f"   numpy {numpy_us:>8.0f} us/call")
+
+def benchmark_reservation_pipeline(n_threads: int = 16, commits_per_thread: int = 500, write_latency: float = 0.002):
+    """Flash-sale commits on one fare: a backend write per booking versus the batched write-behind pipeline."""
+    def write(records: List[Dict]):
+        time.sleep(write_latency)
+
+    def run(commit: Callable[[Tuple, str], Dict]) -> Tuple[float, Dict[Tuple, set]]:
+        pnrs: Dict[Tuple, set] = {}
+
+        def worker(thread: int):
+            rng = random.Random(thread)
+            for i in range(commits_per_thread):
+                # One commit in ten is a client retry of an earlier key
+                n = rng.randrange(i) if i and rng.random() < 0.1 else i
+                key = ("bench", f"P{thread}-{n}", "FLASH-1", "2030-01-01")
+                result = commit(key, key[1])
+                pnrs.setdefault(key, set()).add(result["pnr"])
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(n_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, pnrs
+
+    SEAT_INVENTORY.set_capacity("FLASH-1", "2030-01-01", 10 * n_threads * commits_per_thread)
+
+    def direct(key: Tuple, passenger: str) -> Dict:
+        result = _reserve_seat("FLASH-1", passenger, "2030-01-01", None, None)
+        write([result])
+        return result
+
+    pipeline = ReservationPipeline(write_fn=write)
+    total = n_threads * commits_per_thread
+    print(f"Reservation commits: {n_threads} threads x {commits_per_thread} on one fare, "
+          f"{write_latency * 1000:.0f}ms per backend write, 10% retried keys")
+    for label, commit in (("write per commit", direct),
+                          ("pipeline", lambda key, passenger: pipeline.commit(key, "FLASH-1", passenger, "2030-01-01"))):
+        elapsed, pnrs = run(commit)
+        if commit is not direct:
+            pipeline.flush()
+        duplicates = sum(len(v) - 1 for v in pnrs.values())
+        print(f"  {label:18s} {total / elapsed:>10,.0f} commits/s   {duplicates} duplicate PNRs")
+    print(f"  {pipeline}")
+
+def benchmark_seat_inventory(n_threads: int = 16, ops_per_thread: int = 5000, n_tasks: int = 2000):
+    """Hold/confirm/release throughput on a handful of hot flights, from threads and from one event loop."""
+    inventory = SeatInventory(default_capacity=n_threads * ops_per_thread // 32)
+    flights = [(f"HOT-{i}", "2030-01-01") for i in range(4)]
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        for _ in range(ops_per_thread // 2):
+            hold_id = inventory.hold(*rng.choice(flights))
+            if hold_id is not None:
+                inventory.confirm(hold_id) if rng.random() < 0.5 else inventory.release(hold_id)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    sold = sum(inventory._flights[(*key, None)].sold for key in flights)
+    print(f"SeatInventory: {n_threads} threads x {ops_per_thread} hold/settle ops on {len(flights)} flights")
+    print(f"  {n_threads * ops_per_thread / elapsed:,.0f} ops/s   {sold} seats sold of {inventory.default_capacity * len(flights)}   {inventory.stats}")
+
+    # A sell-out under asyncio contention: more tasks than seats, no oversell
+    inventory = SeatInventory(default_capacity=n_tasks // 2)
+
+    async def book(i: int) -> bool:
+        hold_id = inventory.hold("HOT-0", "2030-01-01")
+        await asyncio.sleep(0)
+        return hold_id is not None and inventory.confirm(hold_id)
+
+    async def sell_out() -> int:
+        return sum(await asyncio.gather(*(book(i) for i in range(n_tasks))))
+
+    start = time.perf_counter()
+    confirmed = asyncio.run(sell_out())
+    elapsed = time.perf_counter() - start
+    print(f"  asyncio sell-out: {n_tasks} tasks, {confirmed} confirmed of {inventory.default_capacity} seats, "
+          f"{n_tasks * 2 / elapsed:,.0f} ops/s")
+
+def benchmark_pipeline_modes(messages: Optional[List[str]] = None):
+    """
+    Live benchmark (needs a real GEMINI_API_KEY): turn latency, model calls and tokens
+    for the two-call pipeline versus the combined tool-calling pipeline. The rule-based
+    fast path is disabled so every turn reaches the model.
+    """
+    messages = messages or [
+        "Hi, what can you do?",
+        "I need to get from London to Paris tomorrow, what's available?",
+        "Put Robin on the Lufthansa one.",
+        "Hmm, go with the cheapest option for Robin instead.",
+    ]
+    for mode in (PIPELINE_TWO_CALL, PIPELINE_COMBINED):
+        agent = TravelAgentSystem(nlu_confidence_threshold=float("inf"), pipeline_mode=mode,
+                                  nlg_modes={"SEARCH": NLG_MODE_POLISHED, "BOOK": NLG_MODE_POLISHED})
+        latencies = []
+        for message in messages:
+            start = time.perf_counter()
+            agent.handle_request(message)
+            latencies.append(time.perf_counter() - start)
+        usage = agent.usage
+        print(f"{mode:<9} {sum(latencies) / len(latencies) * 1e3:8.0f} ms/turn   "
+              f"{usage['calls'] / len(messages):.2f} calls/turn   "
+              f"{(usage['prompt_tokens'] + usage['output_tokens']) / len(messages):7.0f} tokens/turn")
+
+def run_benchmarks():
+    benchmark_memory_index()
+    benchmark_memory_footprint()
+    benchmark_memory_query()
+    benchmark_date_resolver()
+    benchmark_flexible_search()
+    benchmark_seat_inventory()
+    benchmark_reservation_pipeline()
+    benchmark_orchestrator()
+
+# ==============================================================================
+# 10. EXECUTION ENTRY POINT
+# ==============================================================================
+
+if __name__ == "__main__":
+    
+    if "--bench" in sys.argv:
+        run_benchmarks()
+        sys.exit(0)
+    if "--bench-live" in sys.argv:
+        benchmark_pipeline_modes()
+        sys.exit(0)
+
+    # --stub runs the demo against a local stand-in for the model API (no network)
+    stub = StubModelServer().__enter__() if "--stub" in sys.argv else None
+    if stub:
+        MODEL_POOL.configure(transport="rest", api_endpoint=stub.url)
+    MODEL_POOL.warm_up()
 
-if __name__ == "__main__":
-    
     agent = TravelAgentSystem()
     
     # Define a clean, professional scenario
@@ -294,4 +4430,12 @@ if __name__ == "__main__":
         except Exception as e:
             logger.error(f"Runtime error: {e}")
             
+    print(f"\n NLU fast path: {agent.nlu_fast_path_stats} | NLU cache: {agent.nlu_cache.stats} ")
+    print(f" Fare cache: {agent.fare_cache} ")
+    print(f" Model calls: {agent.resilience} ")
+    RESERVATION_PIPELINE.flush()
+    print(f" Reservations: {RESERVATION_PIPELINE} ")
+    if stub:
+        print(f" Stub model server: {stub.requests} requests over {stub.connections} connection(s) ")
+        stub.__exit__(None, None, None)
     print("\n END OF SESSION ")